@@ -13,6 +13,8 @@
 # copied, modified, propagated, or distributed except according to the terms
 # contained in the LICENSE.txt file.
 #-----------------------------------------------------------------------------
+import threading
+
 from pysmurf.client.command.cryo_card import CryoCard
 from pysmurf.client.util.pub import Publisher
 from .logger import SmurfLogger
@@ -184,6 +186,37 @@ class SmurfBase:
                           self.rtm_spi_cryo_root + 'write')
         self.freq_resp = {}
 
+        # Firmware constants, see get_hardware_constants
+        self._hardware_cache = {}
+
+        # Asynchronous take_debug_data, the StreamDataWriter is used by
+        # one acquisition at a time
+        self._debug_data_lock = threading.Lock()
+        self._debug_data_executor = None
+
+        # Spectra estimators of full_band_resp, by segment length and
+        # sampling frequency
+        self._welch_spectra = {}
+
+        # Results of estimate_phase_delay, by band and settings
+        self._phase_delay_cache = {}
+
+        # Sweep cache on disk, see enable_capture_cache
+        self._capture_cache = None
+        self._capture_cache_max_age = None
+
+        # Monitors of the DDR stream PVs, see read_stream_pvs
+        self._stream_sync_groups = {}
+
+        # Set while run_band_pipelines tunes bands concurrently, see
+        # save_tune
+        self._save_tune_deferred = False
+
+        # Staged channel register writes by band, and the bands whose
+        # single channel setters are staged, see staged_channel_writes
+        self._channel_stage = {}
+        self._channel_stage_bands = set()
+
         # RTM slow DAC parameters (used, e.g., for TES biasing). The
         # DACs are AD5790 chips
         self._rtm_slow_dac_max_volt = 10. # Max unipolar DAC voltage,
@@ -13,6 +13,7 @@
 # copied, modified, propagated, or distributed except according to the terms
 # contained in the LICENSE.txt file.
 #-----------------------------------------------------------------------------
+from contextlib import contextmanager
 import os
 import time
 
@@ -615,6 +616,7 @@ class SmurfCommandMixin(SmurfBase):
                 self.log(
                     'The system configuration did not finish after'
                     f' {max_timeout_sec} seconds.', self.LOG_ERROR)
+                self.clear_hardware_cache()
                 return False
 
             # At this point, we determine that the configuration
@@ -635,12 +637,15 @@ class SmurfCommandMixin(SmurfBase):
                 f' The final state was {success}.',
                 self.LOG_USER)
 
+            # The defaults may change the firmware constants
+            self.clear_hardware_cache()
             return success
 
         else:
             self._caput(
                 self.epics_root + ':AMCc:setDefaults', 1,
                 wait_after=wait_after_sec, **kwargs)
+            self.clear_hardware_cache()
             return None
 
     def set_read_all(self, **kwargs):
@@ -2388,6 +2393,134 @@ class SmurfCommandMixin(SmurfBase):
             self._band_root(band) + self._dsp_enable_reg,
             **kwargs)
 
+    # Staged channel writes. The per channel setters of a band are
+    # accumulated while staged_channel_writes is active for it, and
+    # written with one array put per register.
+    _staged_channel_registers = {
+        'amplitude_scale' : ('get_amplitude_scale_array',
+                             'set_amplitude_scale_array'),
+        'feedback_enable' : ('get_feedback_enable_array',
+                             'set_feedback_enable_array'),
+        'eta_phase' : ('get_eta_phase_array', 'set_eta_phase_array'),
+        'eta_mag' : ('get_eta_mag_array', 'set_eta_mag_array'),
+        'center_frequency' : ('get_center_frequency_array',
+                              'set_center_frequency_array'),
+    }
+
+    def stage_channels(self, band, channels, **values):
+        r"""
+        Stages new values of channel registers, without writing them.
+        Call commit_staged_channels to write them.
+
+        Args
+        ----
+        band : int
+            The band.
+        channels : int or int array
+            The channels to change.
+        \**values
+            The new values, a scalar or one per channel, by register:
+            amplitude_scale, feedback_enable, eta_phase (in degrees),
+            eta_mag (scaled) or center_frequency (offset in MHz).
+        """
+        channels = np.ravel(np.asarray(channels, dtype=int))
+        n_channels = self.get_number_channels(band)
+        stage = self._channel_stage.setdefault(band, {})
+
+        for reg, val in values.items():
+            if val is None:
+                continue
+            if reg not in self._staged_channel_registers:
+                raise ValueError(f'Cannot stage channel register {reg}')
+            if reg not in stage:
+                stage[reg] = (np.zeros(n_channels),
+                              np.zeros(n_channels, dtype=bool))
+            staged, mask = stage[reg]
+            staged[channels] = val
+            mask[channels] = True
+
+    def commit_staged_channels(self, band=None, **kwargs):
+        r"""
+        Writes the staged channel values. Each register with staged
+        values is read and written back once with the changes, so
+        the channels which were not staged keep their current value.
+
+        Args
+        ----
+        band : int or None, optional, default None
+            The band to commit. If None, commits all the bands.
+        \**kwargs
+            Passed to the array sets.
+
+        Returns
+        -------
+        int
+            The number of registers written.
+        """
+        bands = list(self._channel_stage) if band is None else [band]
+        n_write = 0
+        for b in bands:
+            for reg, (staged, mask) in self._channel_stage.pop(b, {}).items():
+                get, put = self._staged_channel_registers[reg]
+                current = np.array(getattr(self, get)(b))
+                current[mask] = staged[mask]
+                getattr(self, put)(b, current, **kwargs)
+                n_write += 1
+
+        return n_write
+
+    def discard_staged_channels(self, band=None):
+        """
+        Drops the staged channel values without writing them.
+
+        Args
+        ----
+        band : int or None, optional, default None
+            The band to discard. If None, discards all the bands.
+        """
+        if band is None:
+            self._channel_stage.clear()
+        else:
+            self._channel_stage.pop(band, None)
+
+    @contextmanager
+    def staged_channel_writes(self, band, **kwargs):
+        r"""
+        Context manager which stages the single channel register
+        writes of a band, set_amplitude_scale_channel,
+        set_feedback_enable_channel, set_eta_phase_degree_channel,
+        set_eta_mag_scaled_channel and
+        set_center_frequency_mhz_channel, and commits them on exit
+        with one write per register. Nothing is written if the block
+        raises.
+
+        Args
+        ----
+        band : int
+            The band.
+        \**kwargs
+            Passed to commit_staged_channels.
+        """
+        self._channel_stage_bands.add(band)
+        try:
+            yield
+        except BaseException:
+            self.discard_staged_channels(band)
+            raise
+        finally:
+            self._channel_stage_bands.discard(band)
+        self.commit_staged_channels(band, **kwargs)
+
+    def _stage_channel_write(self, band, channel, reg, val):
+        """
+        Stages a single channel write if staged_channel_writes is
+        active for the band. Returns whether it was staged.
+        """
+        if band not in self._channel_stage_bands:
+            return False
+        self.stage_channels(band, channel, **{reg: val})
+        return True
+
     # Single channel commands
     _feedback_enable_reg = 'feedbackEnable'
 
@@ -2396,6 +2529,8 @@ class SmurfCommandMixin(SmurfBase):
         """
         Set the feedback for a single channel
         """
+        if self._stage_channel_write(band, channel, 'feedback_enable', val):
+            return
         self._caput(
             self._channel_root(band, channel) +
             self._feedback_enable_reg,
@@ -2416,6 +2551,8 @@ class SmurfCommandMixin(SmurfBase):
                                    **kwargs):
         """
         """
+        if self._stage_channel_write(band, channel, 'eta_mag', val):
+            return
         self._caput(
             self._channel_root(band, channel) +
             self._eta_mag_scaled_channel_reg,
@@ -2435,6 +2572,8 @@ class SmurfCommandMixin(SmurfBase):
                                          **kwargs):
         """
         """
+        if self._stage_channel_write(band, channel, 'center_frequency', val):
+            return
         self._caput(
             self._channel_root(band, channel) +
             self._center_frequency_mhz_channel_reg,
@@ -2456,6 +2595,8 @@ class SmurfCommandMixin(SmurfBase):
                                     **kwargs):
         """
         """
+        if self._stage_channel_write(band, channel, 'amplitude_scale', val):
+            return
         self._caput(
             self._channel_root(band, channel) +
             self._amplitude_scale_channel_reg,
@@ -2475,6 +2616,8 @@ class SmurfCommandMixin(SmurfBase):
                                      **kwargs):
         """
         """
+        if self._stage_channel_write(band, channel, 'eta_phase', val):
+            return
         self._caput(
             self._channel_root(band, channel) +
             self._eta_phase_degree_channel_reg,
@@ -24,13 +24,15 @@ except ModuleNotFoundError:
 This class is written by Mitch to read PVs simultanesouly
 """
 class SyncGroup(object):
-    def __init__(self, pvs, timeout=30.0, skip_first=True):
+    # count limits the number of elements of waveform PVs sent with
+    # each update, None gets all the elements
+    def __init__(self, pvs, timeout=30.0, skip_first=True, count=None):
         self.pvnames = pvs
         self.values = dict()
         self.timeout = timeout
         self.first = [skip_first] * len(pvs)
         self.pvs = [epics.PV(pv, callback=self.channel_changed,
-            auto_monitor=True) for pv in pvs]
+            auto_monitor=True, count=count) for pv in pvs]
 
     def channel_changed(self, pvname, value, *args, **kwargs):
         # don't fill on initial connection
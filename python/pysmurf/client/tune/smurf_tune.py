@@ -14,8 +14,11 @@
 # contained in the LICENSE.txt file.
 #----------------------------------------------------------------------------
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
 import glob
 import os
+import threading
 import time
 
 import matplotlib.pyplot as plt
@@ -30,6 +33,46 @@ from pysmurf.client.command.sync_group import SyncGroup as SyncGroup
 from pysmurf.client.util.pub import set_action
 from ..util import tools
 
+try:
+    import epics
+except ModuleNotFoundError:
+    print("smurf_tune.py - epics not found.")
+
+class _SharedLock:
+    """
+    Lock held either by one thread, or shared by several threads.
+    Threads waiting for exclusive access block new shared holders,
+    so they are not starved.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._shared = 0
+        self._exclusive = False
+        self._waiting = 0
+
+    @contextmanager
+    def hold(self, exclusive=True):
+        with self._cond:
+            if exclusive:
+                self._waiting += 1
+                self._cond.wait_for(lambda: not self._exclusive and
+                    self._shared == 0)
+                self._waiting -= 1
+                self._exclusive = True
+            else:
+                self._cond.wait_for(lambda: not self._exclusive and
+                    self._waiting == 0)
+                self._shared += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                if exclusive:
+                    self._exclusive = False
+                else:
+                    self._shared -= 1
+                self._cond.notify_all()
+
 class SmurfTuneMixin(SmurfBase):
     """
     This contains all the tuning scripts
@@ -39,7 +82,8 @@ class SmurfTuneMixin(SmurfBase):
              retune=False, f_min=.02, f_max=.3, df_max=.03,
              fraction_full_scale=None, make_plot=False,
              save_plot=True, show_plot=False,
-             new_master_assignment=False, track_and_check=True):
+             new_master_assignment=False, track_and_check=True,
+             concurrent=False, incremental_retune=False):
         """
         This runs a tuning, does tracking setup, and prunes bad
         channels using check lock. When this is done, we should
@@ -78,6 +122,13 @@ class SmurfTuneMixin(SmurfBase):
             resonators at a given frequency to a given channel.
         track_and_check : bool, optional, default True
             Whether or not after tuning to run track and check.
+        concurrent : bool, optional, default False
+            Whether to tune the bands concurrently with
+            run_band_pipelines instead of one after the other.
+        incremental_retune : bool, optional, default False
+            Whether to run retune_drifted on each band after loading
+            the tuning file, to only sweep again the resonators which
+            moved.
         """
         bands = self._bands
 
@@ -94,8 +145,39 @@ class SmurfTuneMixin(SmurfBase):
                 self.log(f'Loading default tune file: {tune_file}')
             self.load_tune(tune_file)
 
+        if concurrent:
+            stages = []
+            if not load_tune:
+                stages.append(('find_freq', 'flux_ramp_off',
+                    lambda band: self.find_freq(band,
+                        tone_power=self._amplitude_scale[band])))
+                stages.append(('setup_notches', 'flux_ramp_off',
+                    lambda band: self.setup_notches(band,
+                        tone_power=self._amplitude_scale[band],
+                        new_master_assignment=new_master_assignment)))
+            elif incremental_retune:
+                stages.append(('retune_drifted', 'flux_ramp_off',
+                    lambda band: self.retune_drifted(band)))
+            if retune:
+                stages.append(('tune_band_serial', ('bay', 'flux_ramp_off'),
+                    lambda band: self.tune_band_serial(band,
+                        from_old_tune=load_tune, old_tune=tune_file,
+                        make_plot=make_plot, show_plot=show_plot,
+                        save_plot=save_plot,
+                        new_master_assignment=new_master_assignment)))
+            if track_and_check:
+                stages.append(('track_and_check', ('bay', 'flux_ramp'),
+                    lambda band: self.track_and_check(band,
+                        fraction_full_scale=fraction_full_scale,
+                        f_min=f_min, f_max=f_max, df_max=df_max,
+                        make_plot=make_plot, save_plot=save_plot,
+                        show_plot=show_plot)))
+
+            self.run_band_pipelines(bands, stages)
+            return
+
         # Runs find_freq and setup_notches. This takes forever.
-        else:
+        if not load_tune:
             for band in bands:
                 tone_power = self._amplitude_scale[band]
                 self.find_freq(
@@ -104,6 +186,11 @@ class SmurfTuneMixin(SmurfBase):
                     band, tone_power=tone_power,
                     new_master_assignment=new_master_assignment)
 
+        # Only sweeps again the resonators which moved
+        elif incremental_retune:
+            for band in bands:
+                self.retune_drifted(band)
+
         # Runs tune_band_serial to re-estimate eta params
         if retune:
             for band in bands:
@@ -124,6 +211,125 @@ class SmurfTuneMixin(SmurfBase):
                     make_plot=make_plot, save_plot=save_plot,
                     show_plot=show_plot)
 
+    @set_action()
+    def run_band_pipelines(self, bands, stages, max_workers=None):
+        """
+        Runs a sequence of tuning stages on several bands
+        concurrently. The stages of each band run in order in their
+        own thread, so the total time is set by the slowest band
+        rather than the sum over the bands. Stages list the hardware
+        they share with other bands:
+
+        * 'bay' : the DAQ mux and triggers of the AMC bay, used by
+          full_band_resp, take_debug_data and the ADC/DAC reads.
+          Only one band of a bay holds it at a time. Bands in
+          different bays still run concurrently.
+        * 'flux_ramp' : the flux ramp, shared by all the bands. For
+          stages which turn it on or run with it on, such as
+          tracking_setup and check_lock. Only one band holds it at a
+          time.
+        * 'flux_ramp_off' : a shared hold of the flux ramp, for
+          stages which need it off or only turn it off, such as
+          find_freq, setup_notches and tune_band_serial. Several
+          bands can hold it at once, but not while another band
+          holds 'flux_ramp'.
+
+        The tune file is saved once when all the bands are done,
+        instead of after each stage. If a stage fails, the remaining
+        stages of that band are skipped, the other bands carry on
+        and the first error is raised at the end.
+
+        Args
+        ----
+        bands : list of int
+            The bands to run.
+        stages : list of (str, str or tuple of str or None, callable)
+            The (name, resources, function) of each stage. function
+            is called with the band. resources is one or several of
+            'bay', 'flux_ramp' and 'flux_ramp_off', or None for
+            stages which only use their band.
+        max_workers : int or None, optional, default None
+            The maximum number of bands run at the same time. If
+            None, runs all the bands at once.
+
+        Returns
+        -------
+        timing : dict
+            The time taken by each stage of each band in seconds, by
+            band and stage name, with the total under 'total'.
+        """
+        bands = [int(b) for b in np.ravel(bands)]
+        stages = [(name, () if resources is None else
+                   (resources,) if isinstance(resources, str) else
+                   tuple(resources), func)
+                  for name, resources, func in stages]
+        for _, resources, _ in stages:
+            for resource in resources:
+                if resource not in ('bay', 'flux_ramp', 'flux_ramp_off'):
+                    raise ValueError(f'Unknown stage resource {resource}')
+
+        flux_ramp_lock = _SharedLock()
+        bay_locks = {bay: threading.Lock()
+                     for bay in {self.band_to_bay(b) for b in bands}}
+
+        timing = {band: {} for band in bands}
+        errors = {}
+
+        def _pipeline(band):
+            # Each thread uses the CA context of the main thread. There
+            # is no context offline or without pyepics.
+            if not self.offline and 'epics' in globals():
+                epics.ca.use_initial_context()
+            bay = self.band_to_bay(band)
+            for name, resources, func in stages:
+                t0 = time.time()
+                try:
+                    # The flux ramp is always taken before the bay, so
+                    # two bands never wait on each other
+                    with ExitStack() as stack:
+                        if 'flux_ramp' in resources:
+                            stack.enter_context(flux_ramp_lock.hold())
+                        elif 'flux_ramp_off' in resources:
+                            stack.enter_context(
+                                flux_ramp_lock.hold(exclusive=False))
+                        if 'bay' in resources:
+                            stack.enter_context(bay_locks[bay])
+                        t0 = time.time()
+                        func(band)
+                except Exception as e:
+                    self.log(f'Band {band} {name} failed: {e}',
+                        self.LOG_ERROR)
+                    errors[band] = e
+                    return
+                finally:
+                    timing[band][name] = time.time() - t0
+                self.log(f'Band {band} {name} done in '
+                    f'{timing[band][name]:.1f} s', self.LOG_USER)
+
+        t_start = time.time()
+        self._save_tune_deferred = True
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers or
+                    len(bands) or 1) as pool:
+                jobs = [pool.submit(_pipeline, band) for band in bands]
+                for job in jobs:
+                    job.result()
+        finally:
+            self._save_tune_deferred = False
+            self.save_tune()
+
+        timing['total'] = time.time() - t_start
+        self.log(f'Ran {[s[0] for s in stages]} on bands {bands} in '
+            f'{timing["total"]:.1f} s', self.LOG_USER)
+        for band in bands:
+            self.log(f'Band {band} : ' + ', '.join(f'{k} {v:.1f} s'
+                for k, v in timing[band].items()), self.LOG_USER)
+
+        if errors:
+            raise errors[min(errors)]
+
+        return timing
+
     @set_action()
     def tune_band(self, band, freq=None, resp=None, nsamp=2**19,
             make_plot=False, show_plot=False, plot_chans=[],
@@ -578,7 +784,7 @@ class SmurfTuneMixin(SmurfBase):
             save_plot=True, show_plot=False, save_data=False, timestamp=None,
             save_raw_data=False, correct_att=True, swap=False, hw_trigger=True,
             write_log=False, return_plot_path=False,
-            check_if_adc_is_saturated=True):
+            check_if_adc_is_saturated=True, force_refresh=False):
         """
         Injects high amplitude noise with known waveform. The ADC measures it.
         The cross correlation contains the information about the resonances.
@@ -621,6 +827,9 @@ class SmurfTuneMixin(SmurfBase):
             Right after playing the noise file, checks if ADC for the
             requested band is saturated.  If it is saturated, gives up
             with an error.
+        force_refresh : bool, optional, default False
+            Whether to take new data even if the response is in the
+            capture cache, see enable_capture_cache.
 
         Returns
         -------
@@ -632,95 +841,15 @@ class SmurfTuneMixin(SmurfBase):
         if timestamp is None:
             timestamp = self.get_timestamp()
 
-        resp = np.zeros((int(n_scan), int(nsamp/2)), dtype=complex)
-        for n in np.arange(n_scan):
-            bay = self.band_to_bay(band)
-            # Default setup sets to 1
-            self.set_trigger_hw_arm(bay, 0, write_log=write_log)
-
-            self.set_noise_select(band, 1, wait_done=True, write_log=write_log)
-            # if true, checks whether or not playing noise file saturates the ADC.
-            #If ADC is saturated, throws an exception.
-            if check_if_adc_is_saturated:
-                adc_is_saturated = self.check_adc_saturation(band)
-                if adc_is_saturated:
-                    raise ValueError('Playing the noise file saturates the '+
-                        f'ADC for band {band}.  Try increasing the DC '+
-                        'attenuation for this band.')
-
-            # Take read the ADC data
-            try:
-                adc = self.read_adc_data(band, nsamp, hw_trigger=hw_trigger,
-                    save_data=False)
-            except Exception:
-                self.log('ADC read failed. Trying one more time', self.LOG_ERROR)
-                adc = self.read_adc_data(band, nsamp, hw_trigger=hw_trigger,
-                    save_data=False)
-            time.sleep(.05)  # Need to wait, otherwise dac call interferes with adc
-
-            try:
-                dac = self.read_dac_data(
-                    band, nsamp, hw_trigger=hw_trigger,
-                    save_data=False)
-            except BaseException:
-                self.log('ADC read failed. Trying one more time', self.LOG_ERROR)
-                dac = self.read_dac_data(
-                    band, nsamp, hw_trigger=hw_trigger,
-                    save_data=False)
-            time.sleep(.05)
-
-            self.set_noise_select(band, 0, wait_done=True, write_log=write_log)
-
-            # Account for the up and down converter attenuators
-            if correct_att:
-                att_uc = self.get_att_uc(band)
-                att_dc = self.get_att_dc(band)
-                self.log(f'UC (DAC) att: {att_uc}')
-                self.log(f'DC (ADC) att: {att_dc}')
-                if att_uc > 0:
-                    scale = (10**(-att_uc/2/20))
-                    self.log(f'UC attenuator > 0. Scaling by {scale:4.3f}')
-                    dac *= scale
-                if att_dc > 0:
-                    scale = (10**(att_dc/2/20))
-                    self.log(f'DC attenuator > 0. Scaling by {scale:4.3f}')
-                    adc *= scale
-
-            if save_raw_data:
-                self.log('Saving raw data...', self.LOG_USER)
-
-                path = os.path.join(self.output_dir, f'{timestamp}_adc')
-                np.save(path, adc)
-                self.pub.register_file(path, 'adc', format='npy')
-
-                path = os.path.join(self.output_dir,f'{timestamp}_dac')
-                np.save(path, dac)
-                self.pub.register_file(path, 'dac', format='npy')
-
-            # Swap frequency ordering of data of ADC relative to DAC
-            if swap:
-                adc = adc[::-1]
-
-            # Take PSDs of ADC, DAC, and cross
-            fs = self.get_digitizer_frequency_mhz() * 1.0E6
-            f, p_dac = signal.welch(dac, fs=fs, nperseg=nsamp/2,
-                                    return_onesided=True)
-            f, p_adc = signal.welch(adc, fs=fs, nperseg=nsamp/2,
-                                    return_onesided=True)
-            f, p_cross = signal.csd(dac, adc, fs=fs, nperseg=nsamp/2,
-                                    return_onesided=True)
-
-            # Sort frequencies
-            idx = np.argsort(f)
-            f = f[idx]
-            p_dac = p_dac[idx]
-            p_adc = p_adc[idx]
-            p_cross = p_cross[idx]
-
-            resp[n] = p_cross / p_dac
-
-        # Average over the multiple scans
-        resp = np.mean(resp, axis=0)
+        # Saving the raw data needs a new sweep
+        f, resp, p_dac, p_adc, p_cross = self._cached_capture(
+            'full_band_resp', band,
+            {'n_scan': n_scan, 'nsamp': nsamp, 'correct_att': correct_att,
+             'swap': swap, 'hw_trigger': hw_trigger},
+            lambda: self._full_band_resp_scans(band, n_scan, nsamp,
+                timestamp, save_raw_data, correct_att, swap, hw_trigger,
+                write_log, check_if_adc_is_saturated),
+            force_refresh=force_refresh or save_raw_data)
 
         plot_path = None
         if make_plot:
@@ -794,6 +923,125 @@ class SmurfTuneMixin(SmurfBase):
         else:
             return f, resp
 
+    def _full_band_resp_scans(self, band, n_scan, nsamp, timestamp,
+            save_raw_data, correct_att, swap, hw_trigger, write_log,
+            check_if_adc_is_saturated):
+        """
+        Takes and averages the full_band_resp scans. See
+        full_band_resp for the arguments.
+
+        Returns
+        -------
+        f : float array
+            The sorted frequencies.
+        resp : complex array
+            The response averaged over the scans.
+        p_dac : float array
+            The DAC spectrum of the last scan.
+        p_adc : float array
+            The ADC spectrum of the last scan.
+        p_cross : complex array
+            The cross spectrum of the last scan.
+        """
+        # The spectra estimator keeps its window and buffers between
+        # scans and calls
+        fs = (self.get_hardware_constants(band)['digitizer_frequency_mhz'] *
+              1.0E6)
+        key = (int(nsamp/2), fs)
+        if key not in self._welch_spectra:
+            self._welch_spectra[key] = tools.WelchSpectra(int(nsamp/2), fs)
+        welch = self._welch_spectra[key]
+
+        # Running mean of the response over the scans
+        resp = np.zeros(int(nsamp/2), dtype=complex)
+        for n in np.arange(n_scan):
+            bay = self.band_to_bay(band)
+            # Default setup sets to 1
+            self.set_trigger_hw_arm(bay, 0, write_log=write_log)
+
+            self.set_noise_select(band, 1, wait_done=True, write_log=write_log)
+            # if true, checks whether or not playing noise file saturates the ADC.
+            #If ADC is saturated, throws an exception.
+            if check_if_adc_is_saturated:
+                adc_is_saturated = self.check_adc_saturation(band)
+                if adc_is_saturated:
+                    raise ValueError('Playing the noise file saturates the '+
+                        f'ADC for band {band}.  Try increasing the DC '+
+                        'attenuation for this band.')
+
+            # Take read the ADC data
+            try:
+                adc = self.read_adc_data(band, nsamp, hw_trigger=hw_trigger,
+                    save_data=False)
+            except Exception:
+                self.log('ADC read failed. Trying one more time', self.LOG_ERROR)
+                adc = self.read_adc_data(band, nsamp, hw_trigger=hw_trigger,
+                    save_data=False)
+            time.sleep(.05)  # Need to wait, otherwise dac call interferes with adc
+
+            try:
+                dac = self.read_dac_data(
+                    band, nsamp, hw_trigger=hw_trigger,
+                    save_data=False)
+            except BaseException:
+                self.log('ADC read failed. Trying one more time', self.LOG_ERROR)
+                dac = self.read_dac_data(
+                    band, nsamp, hw_trigger=hw_trigger,
+                    save_data=False)
+            time.sleep(.05)
+
+            self.set_noise_select(band, 0, wait_done=True, write_log=write_log)
+
+            # Account for the up and down converter attenuators
+            if correct_att:
+                att_uc = self.get_att_uc(band)
+                att_dc = self.get_att_dc(band)
+                self.log(f'UC (DAC) att: {att_uc}')
+                self.log(f'DC (ADC) att: {att_dc}')
+                if att_uc > 0:
+                    scale = (10**(-att_uc/2/20))
+                    self.log(f'UC attenuator > 0. Scaling by {scale:4.3f}')
+                    dac *= scale
+                if att_dc > 0:
+                    scale = (10**(att_dc/2/20))
+                    self.log(f'DC attenuator > 0. Scaling by {scale:4.3f}')
+                    adc *= scale
+
+            if save_raw_data:
+                self.log('Saving raw data...', self.LOG_USER)
+
+                path = os.path.join(self.output_dir, f'{timestamp}_adc')
+                np.save(path, adc)
+                self.pub.register_file(path, 'adc', format='npy')
+
+                path = os.path.join(self.output_dir,f'{timestamp}_dac')
+                np.save(path, dac)
+                self.pub.register_file(path, 'dac', format='npy')
+
+            # Swap frequency ordering of data of ADC relative to DAC
+            if swap:
+                adc = adc[::-1]
+
+            # Take PSDs of ADC, DAC, and cross. The DAC and ADC data
+            # are complex, so the spectra are two sided.
+            f, p_dac, p_adc, p_cross = welch.spectra(dac, adc)
+
+            # Average over the multiple scans
+            delta = p_cross / p_dac
+            delta -= resp
+            delta /= n + 1
+            resp += delta
+
+        # Sort frequencies
+        idx = np.argsort(f)
+        f = f[idx]
+        p_dac = p_dac[idx]
+        p_adc = p_adc[idx]
+        p_cross = p_cross[idx]
+        resp = resp[idx]
+
+        return f, resp, p_dac, p_adc, p_cross
+
     @set_action()
     def find_peak(self, freq, resp, rolling_med=True, window=5000,
             grad_cut=.5, amp_cut=.25, freq_min=-2.5E8, freq_max=2.5E8,
@@ -2171,40 +2419,129 @@ class SmurfTuneMixin(SmurfBase):
         f, resp = self.fast_eta_scan(band, subband, f_sweep, 2, tone_power)
         # resp = rr + 1.j*ii
 
-        a_resp = np.abs(resp)
         if lock_max_derivative:
             self.log('Locking on max derivative instead of res min')
-            deriv = np.abs(np.diff(a_resp))
-            idx = np.ravel(np.where(deriv == np.max(deriv)))[0]
-        else:
-            idx = np.ravel(np.where(a_resp == np.min(a_resp)))[0]
-        f0 = f_sweep[idx]
+        eta = self._eta_from_sweep(f_sweep, resp, delta_freq,
+            lock_max_derivative=lock_max_derivative)
 
-        try:
-            left = np.where(f_sweep < f0 - delta_freq)[0][-1]
-        except IndexError:
-            left = 0
+        sb, sbc = self.get_subband_centers(band, as_offset=False)
 
-        try:
-            right = np.where(f_sweep > f0 + delta_freq)[0][0]
-        except BaseException:
-            right = len(f_sweep)-1
+        return f_sweep + sbc[subband], resp, eta
 
-        eta = (f_sweep[right]-f_sweep[left])/(resp[right]-resp[left])
+    @staticmethod
+    def _eta_from_sweep(f_sweep, resp, delta_freq, lock_max_derivative=False):
+        """
+        Estimates eta from a sweep across a resonance, see
+        eta_estimator. Does not access the hardware.
 
-        sb, sbc = self.get_subband_centers(band, as_offset=False)
+        Args
+        ----
+        f_sweep : float array
+            The swept frequencies.
+        resp : complex array
+            The response at f_sweep.
+        delta_freq : float
+            The frequency offset from the resonance at which to
+            measure the response.
+        lock_max_derivative : bool, optional, default False
+            Whether to center on the maximum derivative of the
+            amplitude instead of the resonance minimum.
 
-        return f_sweep + sbc[subband], resp, eta
+        Returns
+        -------
+        eta : complex
+            The eta parameter.
+        """
+        eta, _, _, _ = SmurfTuneMixin.eta_estimator_batch(f_sweep,
+            np.asarray(resp)[None, :], delta_freq=delta_freq,
+            lock_max_derivative=lock_max_derivative)
+
+        return eta[0]
+
+    @staticmethod
+    def eta_estimator_batch(freq, resp, delta_freq=.01,
+            lock_max_derivative=False):
+        """
+        Estimates the eta parameters of many resonators at once from
+        their sweeps, with the same method as eta_estimator. Does not
+        access the hardware.
+
+        Args
+        ----
+        freq : float array
+            The swept frequencies, either (n_freq,) if all the
+            resonators were swept at the same frequencies or
+            (n_res, n_freq). Must be increasing.
+        resp : complex array
+            The (n_res, n_freq) response of each resonator.
+        delta_freq : float, optional, default 0.01
+            The frequency offset from the resonance at which to
+            measure the response, in the units of freq.
+        lock_max_derivative : bool, optional, default False
+            Whether to center on the maximum derivative of the
+            amplitude instead of the resonance minimum.
+
+        Returns
+        -------
+        eta : complex array
+            The eta parameter of each resonator.
+        eta_mag : float array
+            The amplitude of eta.
+        eta_phase : float array
+            The angle of eta in degrees.
+        peak_freq : float array
+            The frequency of the resonance minimum.
+        """
+        resp = np.atleast_2d(resp)
+        n_res, n_freq = resp.shape
+        freq = np.broadcast_to(freq, resp.shape)
+        rows = np.arange(n_res)
+
+        a_resp = np.abs(resp)
+        i_min = np.argmin(a_resp, axis=1)
+        if lock_max_derivative:
+            idx = np.argmax(np.abs(np.diff(a_resp, axis=1)), axis=1)
+        else:
+            idx = i_min
+        f0 = freq[rows, idx]
+
+        # Last frequency below f0 - delta_freq, or the first one
+        left = np.sum(freq < (f0 - delta_freq)[:, None], axis=1) - 1
+        left[left < 0] = 0
+
+        # First frequency above f0 + delta_freq, or the last one
+        right = n_freq - np.sum(freq > (f0 + delta_freq)[:, None], axis=1)
+        right[right == n_freq] = n_freq - 1
+
+        eta = ((freq[rows, right] - freq[rows, left]) /
+               (resp[rows, right] - resp[rows, left]))
+
+        return eta, np.abs(eta), np.angle(eta)*180/np.pi, freq[rows, i_min]
 
     @set_action()
     def eta_scan(self, band, subband, freq, tone_power, write_log=False,
-                 sync_group=True):
+                 sync_group=True, force_refresh=False):
         """
         Same as slow eta scans
+
+        If the capture cache is enabled, see enable_capture_cache, a
+        scan with the same arguments and hardware state is not taken
+        again unless force_refresh is True.
         """
         if len(self.which_on(band)):
             self.band_off(band, write_log=write_log)
 
+        return self._cached_capture('eta_scan', band,
+            {'subband': subband, 'freq': freq, 'tone_power': tone_power},
+            lambda: self._eta_scan(band, subband, freq, tone_power,
+                write_log=write_log, sync_group=sync_group),
+            force_refresh=force_refresh)
+
+    def _eta_scan(self, band, subband, freq, tone_power, write_log=False,
+                  sync_group=True):
+        """
+        Takes the eta scan, see eta_scan.
+        """
         n_subband = self.get_number_sub_bands(band)
         n_channel = self.get_number_channels(band)
         channel_order = self.get_channel_order(band)
@@ -3291,21 +3628,22 @@ class SmurfTuneMixin(SmurfBase):
         low_cut = np.array([])
         df_cut = np.array([])
 
-        # Make cuts
-        for ch in channels:
-            f_chan = f[:,ch]
-            f_span = np.max(f_chan) - np.min(f_chan)
-            df_rms = np.std(df[:,ch])
-
-            if f_span > f_max:
-                self.set_amplitude_scale_channel(band, ch, 0, **kwargs)
-                high_cut = np.append(high_cut, ch)
-            elif f_span < f_min:
-                self.set_amplitude_scale_channel(band, ch, 0, **kwargs)
-                low_cut = np.append(low_cut, ch)
-            elif df_rms > df_max:
-                self.set_amplitude_scale_channel(band, ch, 0, **kwargs)
-                df_cut = np.append(df_cut, ch)
+        # Make cuts. The channels are turned off with one write.
+        with self.staged_channel_writes(band, **kwargs):
+            for ch in channels:
+                f_chan = f[:,ch]
+                f_span = np.max(f_chan) - np.min(f_chan)
+                df_rms = np.std(df[:,ch])
+
+                if f_span > f_max:
+                    self.set_amplitude_scale_channel(band, ch, 0, **kwargs)
+                    high_cut = np.append(high_cut, ch)
+                elif f_span < f_min:
+                    self.set_amplitude_scale_channel(band, ch, 0, **kwargs)
+                    low_cut = np.append(low_cut, ch)
+                elif df_rms > df_max:
+                    self.set_amplitude_scale_channel(band, ch, 0, **kwargs)
+                    df_cut = np.append(df_cut, ch)
 
         chan_after = self.which_on(band)
 
@@ -3346,7 +3684,7 @@ class SmurfTuneMixin(SmurfBase):
             tone_power=None, n_read=2, make_plot=False, save_plot=True,
             plotname_append='', window=50, rolling_med=True,
             make_subband_plot=False, show_plot=False, grad_cut=.05,
-            amp_cut=.25, pad=2, min_gap=2):
+            amp_cut=.25, pad=2, min_gap=2, force_refresh=False):
         '''
         Finds the resonances in a band (and specified subbands)
 
@@ -3389,6 +3727,9 @@ class SmurfTuneMixin(SmurfBase):
             search window
         min_gap : int, optional, default 2
             Minimum number of samples between resonances.
+        force_refresh : bool, optional, default False
+            Whether to sweep even if the sweep is in the capture
+            cache, see enable_capture_cache.
         '''
         band_center = self.get_band_center_mhz(band)
         if subband is None:
@@ -3414,7 +3755,10 @@ class SmurfTuneMixin(SmurfBase):
                      f'file: {tone_power}')
 
         self.log(f'Sweeping across frequencies {start_freq + band_center}MHz to {stop_freq + band_center}MHz')
-        f, resp = self.full_band_ampl_sweep(band, subband, tone_power, n_read)
+        f, resp = self._cached_capture('full_band_ampl_sweep', band,
+            {'subband': subband, 'tone_power': tone_power, 'n_read': n_read},
+            lambda: self.full_band_ampl_sweep(band, subband, tone_power,
+                n_read), force_refresh=force_refresh)
 
         timestamp = self.get_timestamp()
 
@@ -3801,33 +4145,37 @@ class SmurfTuneMixin(SmurfBase):
         input_res = input_res + band_center
 
         n_res = len(input_res)
+        if lock_max_derivative:
+            self.log('Locking on max derivative instead of res min')
+        sb, sbc = self.get_subband_centers(band, as_offset=False)
+
+        # Take all the sweeps first, the same as eta_estimator
+        sweeps = []
         for i, f in enumerate(input_res):
             self.log(f'freq {f:5.4f} - {i+1} of {n_res}')
-            freq, resp, eta = self.eta_estimator(band, f, tone_power,
-                f_sweep_half=sweep_width, df_sweep=df_sweep,
-                delta_freq=delta_freq, lock_max_derivative=lock_max_derivative)
-            eta_phase_deg = np.angle(eta)*180/np.pi
-            eta_mag = np.abs(eta)
-            eta_scaled = eta_mag / subband_half_width
-
-            abs_resp = np.abs(resp)
-            idx = np.ravel(np.where(abs_resp == np.min(abs_resp)))[0]
-
-            f_min = freq[idx]
-
-            resonances[i] = {
-                'freq' : f_min,
-                'eta' : eta,
-                'eta_scaled' : eta_scaled,
-                'eta_phase' : eta_phase_deg,
-                'r2' : 1,  # This is BS
-                'eta_mag' : eta_mag,
-                'latency': 0,  # This is also BS
-                'Q' : 1,  # This is also also BS
-                'freq_eta_scan' : freq,
-                'resp_eta_scan' : resp
-            }
-
+            subband, offset = self.freq_to_subband(band, f)
+            f_sweep = np.arange(offset-sweep_width, offset+sweep_width,
+                df_sweep)
+            _, resp = self.fast_eta_scan(band, subband, f_sweep, 2,
+                tone_power)
+            sweeps.append((f_sweep, f_sweep + sbc[subband], resp))
+
+        # Then estimate eta for all of them at once. The rounding in
+        # np.arange can add a point to some sweeps, the sweeps are
+        # grouped by length.
+        eta = np.zeros(n_res, dtype=complex)
+        n_freq = np.array([len(f_sweep) for f_sweep, _, _ in sweeps])
+        for n in np.unique(n_freq):
+            idx = np.flatnonzero(n_freq == n)
+            eta[idx], _, _, _ = self.eta_estimator_batch(
+                np.array([sweeps[i][0] for i in idx]),
+                np.array([sweeps[i][2] for i in idx]),
+                delta_freq=delta_freq,
+                lock_max_derivative=lock_max_derivative)
+
+        for i, (_, freq, resp) in enumerate(sweeps):
+            resonances[i] = self._notch_entry(freq, resp, eta[i],
+                subband_half_width)
 
         # Assign resonances to channels
         self.log('Assigning channels')
@@ -3849,6 +4197,223 @@ class SmurfTuneMixin(SmurfBase):
         self.relock(band)
 
 
+    @classmethod
+    def _notch_from_sweep(cls, f_sweep, freq, resp, delta_freq,
+            lock_max_derivative, subband_half_width):
+        """
+        Analyzes the sweep of one resonance for setup_notches.
+
+        Args
+        ----
+        f_sweep : float array
+            The swept frequencies, relative to the subband center.
+        freq : float array
+            The swept frequencies in MHz.
+        resp : complex array
+            The response at each frequency.
+        delta_freq : float
+            Passed to _eta_from_sweep.
+        lock_max_derivative : bool
+            Passed to _eta_from_sweep.
+        subband_half_width : float
+            The subband half width in MHz, to scale eta.
+
+        Returns
+        -------
+        dict
+            The resonance entry of freq_resp.
+        """
+        eta = cls._eta_from_sweep(f_sweep, resp, delta_freq,
+            lock_max_derivative=lock_max_derivative)
+
+        return cls._notch_entry(freq, resp, eta, subband_half_width)
+
+    @staticmethod
+    def _notch_entry(freq, resp, eta, subband_half_width):
+        """
+        Builds the resonance entry of freq_resp from the sweep of one
+        resonance and its eta parameter.
+
+        Args
+        ----
+        freq : float array
+            The swept frequencies in MHz.
+        resp : complex array
+            The response at each frequency.
+        eta : complex
+            The eta parameter.
+        subband_half_width : float
+            The subband half width in MHz, to scale eta.
+
+        Returns
+        -------
+        dict
+            The resonance entry of freq_resp.
+        """
+        eta_phase_deg = np.angle(eta)*180/np.pi
+        eta_mag = np.abs(eta)
+        eta_scaled = eta_mag / subband_half_width
+
+        abs_resp = np.abs(resp)
+        idx = np.ravel(np.where(abs_resp == np.min(abs_resp)))[0]
+
+        f_min = freq[idx]
+
+        return {
+            'freq' : f_min,
+            'eta' : eta,
+            'eta_scaled' : eta_scaled,
+            'eta_phase' : eta_phase_deg,
+            'r2' : 1,  # This is BS
+            'eta_mag' : eta_mag,
+            'latency': 0,  # This is also BS
+            'Q' : 1,  # This is also also BS
+            'freq_eta_scan' : freq,
+            'resp_eta_scan' : resp
+        }
+
+    @set_action()
+    def retune_drifted(self, band, sweep_width=.05, df_sweep=.002,
+            max_shift=.02, full_sweep_width=.3, tone_power=None,
+            delta_freq=None, lock_max_derivative=False, relock=True):
+        """
+        Incremental retune, starting from the resonances in
+        freq_resp, for example from load_tune. Each resonance is
+        swept over a narrow window around its previous frequency,
+        and eta is estimated for all of them at once. Only the
+        resonators which moved by more than max_shift, or which are
+        not found in the window, are swept again over the full
+        setup_notches window and updated. The other resonances are
+        kept as they are.
+
+        Resonators which are not found in the full window, or which
+        moved to another subband, are turned off. Run a full tuning
+        if many resonators are lost.
+
+        Args
+        ----
+        band : int
+            The band to retune.
+        sweep_width : float, optional, default 0.05
+            The half width of the narrow sweep in MHz.
+        df_sweep : float, optional, default 0.002
+            The sweep step size in MHz.
+        max_shift : float, optional, default 0.02
+            The shift of the resonance frequency in MHz above which
+            the resonator is swept again.
+        full_sweep_width : float, optional, default 0.3
+            The half width of the full sweep in MHz, see
+            setup_notches.
+        tone_power : int or None, optional, default None
+            The power to drive the resonators. If None, uses the
+            tone power of the tuning.
+        delta_freq : float or None, optional, default None
+            The frequency offset at which to measure the complex
+            transmission to compute the eta parameters. Units are
+            MHz. If None, takes value in config file.
+        lock_max_derivative : bool, optional, default False
+            Whether to center on the maximum derivative of the
+            amplitude instead of the resonance minimum.
+        relock : bool, optional, default True
+            Whether to relock the band with the new tuning.
+
+        Returns
+        -------
+        dict
+            The 'kept', 'updated' and 'lost' resonance numbers.
+        """
+        if 'resonances' not in self.freq_resp[band]:
+            self.log(f'No resonances stored in band {band}. Run ' +
+                     'setup_notches or load a tuning first.', self.LOG_ERROR)
+            return {'kept': [], 'updated': [], 'lost': []}
+
+        t0 = time.time()
+        resonances = self.freq_resp[band]['resonances']
+        if len(resonances) == 0:
+            self.log(f'No resonances to retune in band {band}')
+            return {'kept': [], 'updated': [], 'lost': []}
+
+        if tone_power is None:
+            tone_power = self.freq_resp[band].get('tone_power',
+                self._amplitude_scale[band])
+
+        if delta_freq is None:
+            delta_freq = self._delta_freq[band]
+
+        subband_half_width = \
+            self.get_hardware_constants(band)['subband_half_width_mhz']
+
+        self.band_off(band)
+        sb, sbc = self.get_subband_centers(band, as_offset=False)
+
+        # Narrow sweeps around the known resonances. They all have the
+        # same number of points so they are analyzed together.
+        keys = list(resonances.keys())
+        n_freq = int(round(2*sweep_width/df_sweep))
+        f_sweep = np.zeros((len(keys), n_freq))
+        resp = np.zeros((len(keys), n_freq), dtype=complex)
+        subbands = np.zeros(len(keys), dtype=int)
+        for i, k in enumerate(keys):
+            subbands[i], offset = self.freq_to_subband(band,
+                resonances[k]['freq'])
+            f_sweep[i] = offset - sweep_width + df_sweep*np.arange(n_freq)
+            _, resp[i] = self.fast_eta_scan(band, subbands[i], f_sweep[i],
+                2, tone_power)
+
+        eta, _, _, peak_freq = self.eta_estimator_batch(f_sweep, resp,
+            delta_freq=delta_freq, lock_max_derivative=lock_max_derivative)
+
+        # A minimum at the edge of the window means the resonance is
+        # outside of it
+        i_min = np.argmin(np.abs(resp), axis=1)
+        old_freq = np.array([resonances[k]['freq'] for k in keys])
+        shift = peak_freq + sbc[subbands] - old_freq
+        redo = ((i_min == 0) | (i_min == n_freq - 1) | ~np.isfinite(eta) |
+                (np.abs(shift) > max_shift))
+
+        kept = [k for k, r in zip(keys, redo) if not r]
+        updated = []
+        lost = []
+        for k in [k for k, r in zip(keys, redo) if r]:
+            subband, offset = self.freq_to_subband(band,
+                resonances[k]['freq'])
+            fs = np.arange(offset-full_sweep_width,
+                offset+full_sweep_width, df_sweep)
+            _, r = self.fast_eta_scan(band, subband, fs, 2, tone_power)
+            entry = self._notch_from_sweep(fs, fs + sbc[subband], r,
+                delta_freq, lock_max_derivative, subband_half_width)
+
+            idx = np.argmin(np.abs(r))
+            new_subband, _ = self.freq_to_subband(band, entry['freq'])
+            if idx in (0, len(fs) - 1) or \
+                    new_subband != resonances[k]['subband']:
+                self.log(f'Res {k:03} not found near ' +
+                    f'{resonances[k]["freq"]:4.3f} MHz, turning it off')
+                resonances[k]['channel'] = -1
+                lost.append(k)
+                continue
+
+            entry.update({
+                'subband': resonances[k]['subband'],
+                'channel': resonances[k]['channel'],
+                'offset': entry['freq'] - sbc[new_subband]
+            })
+            self.log(f'Res {k:03} moved from ' +
+                f'{resonances[k]["freq"]:4.3f} to {entry["freq"]:4.3f} MHz')
+            resonances[k] = entry
+            updated.append(k)
+
+        self.log(f'Retuned band {band} in {time.time() - t0:.1f} s : ' +
+            f'{len(kept)} kept, {len(updated)} updated, {len(lost)} lost',
+            self.LOG_USER)
+
+        self.save_tune()
+
+        if relock:
+            self.relock(band)
+
+        return {'kept': kept, 'updated': updated, 'lost': lost}
+
     def calculate_eta_svd(self, band, channel,
             nsamp=2**15, filter=True, N=4, Wn=50000, btype='lowpass',
             method='gust', make_plot=True, show_plot=False, save_plot=True,
@@ -3981,7 +4546,14 @@ class SmurfTuneMixin(SmurfBase):
     def save_tune(self, update_last_tune=True):
         """
         Saves the tuning information (self.freq_resp) to tuning directory
+
+        While run_band_pipelines runs, the tuning is only saved once
+        all the bands are done, and this returns the previous tune
+        file.
         """
+        if self._save_tune_deferred:
+            return getattr(self, 'tune_file', None)
+
         timestamp = self.get_timestamp()
         savedir = os.path.join(self.tune_dir, timestamp+"_tune")
         self.log(f'Saving to : {savedir}.npy')
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Title      : pysmurf file exporter class
+#-----------------------------------------------------------------------------
+# File       : pysmurf/util/SmurfFileExporter.py
+# Created    : 2026-10-18
+#-----------------------------------------------------------------------------
+# This file is part of the pysmurf software package. It is subject to
+# the license terms in the LICENSE.txt file found in the top-level directory
+# of this distribution and at:
+#    https://confluence.slac.stanford.edu/display/ppareg/LICENSE.html.
+# No part of the pysmurf software package, including this file, may be
+# copied, modified, propagated, or distributed except according to the terms
+# contained in the LICENSE.txt file.
+#-----------------------------------------------------------------------------
+import json
+import os
+
+import numpy
+
+from pysmurf.client.util.SmurfFileReader import decodeSmurfHeaders
+from pysmurf.client.util.SmurfFileReader import SmurfHeaderSize
+from pysmurf.client.util.SmurfFileReader import SmurfStreamReader
+
+# Layout of the exported files. Both formats use the same tree:
+#   data           : (n_frames, n_channels) int32, chunked per channel
+#   header/<field> : one column per SmurfHeader field, plus external_time
+#                    and tes_bias as decoded by decodeSmurfHeaders
+#   mask           : the channel mask from make_mask_lookup, if available
+# The attributes hold the source files and the number of frames exported,
+# which is used to resume an export.
+DataName   = 'data'
+HeaderName = 'header'
+MaskName   = 'mask'
+
+
+def _fileFormat(fn, fileFormat):
+    """
+    Return the output format, guessing it from the file extension if None
+    """
+    if fileFormat is None:
+        fileFormat = 'zarr' if fn.rstrip('/').endswith('.zarr') else 'hdf5'
+
+    if fileFormat not in ['hdf5', 'zarr']:
+        raise ValueError(f"Invalid export format {fileFormat}, must be 'hdf5' or 'zarr'")
+
+    return fileFormat
+
+
+def _openFile(fn, fileFormat, mode):
+    """
+    Open an exported file. The h5py and zarr packages are only required
+    when exporting to the respective format.
+    """
+    if fileFormat == 'hdf5':
+        import h5py
+        return h5py.File(fn, mode)
+
+    import zarr
+    return zarr.open_group(fn, mode=mode)
+
+
+def _createColumn(group, name, shape, dtype, chunks, fileFormat, compression):
+    """
+    Create an empty, growable and compressed dataset
+    """
+    if fileFormat == 'hdf5':
+        return group.create_dataset(name, shape=shape, dtype=dtype, chunks=chunks,
+                                    maxshape=(None,) + shape[1:],
+                                    compression=compression, shuffle=compression is not None)
+
+    # zarr uses its default compressor. zarr 3 renamed create_dataset.
+    create = getattr(group, 'create_array', None) or group.create_dataset
+    return create(name, shape=shape, dtype=dtype, chunks=chunks)
+
+
+def _appendColumn(column, values, pos):
+    """
+    Write values to a column at row pos, growing it if needed
+    """
+    end = pos + len(values)
+
+    if column.shape[0] < end:
+        column.resize((end,) + column.shape[1:])
+
+    column[pos:end] = values
+
+
+class SmurfStreamExporter(object):
+    """
+    Export SMuRF stream data files to chunked, compressed columns in an
+    HDF5 or Zarr file.
+
+    The data is stored with one chunk column per channel, so reading a few
+    channels out of an exported file only decompresses those channels.
+    Exporting again to the same output file resumes where the previous
+    export stopped, so a file which is still being written can be exported
+    incrementally.
+
+    Args
+    ----
+    files : str or list of str
+        The data file, or list of data file parts, to export.
+    outFile : str
+        The output file.
+    fileFormat : str or None, optional, default None
+        Either 'hdf5' or 'zarr'. If None, 'zarr' is used for outFile
+        ending with .zarr and 'hdf5' otherwise.
+    chunkFrames : int, optional, default 8192
+        The number of frames in each chunk.
+    compression : str or None, optional, default 'gzip'
+        The HDF5 compression filter. Zarr files use the default zarr
+        compressor.
+    useIndex : bool, optional, default False
+        Whether the reader keeps index sidecar files, see
+        SmurfStreamReader.
+    """
+
+    def __init__(self, files, outFile, *, fileFormat=None, chunkFrames=8192,
+                 compression='gzip', useIndex=False):
+        self._files       = files if isinstance(files, list) else [files]
+        self._outFile     = outFile
+        self._fileFormat  = _fileFormat(outFile, fileFormat)
+        self._chunkFrames = chunkFrames
+        self._compression = compression
+        self._useIndex    = useIndex
+
+    def export(self, mask=None, blockSize=None):
+        """
+        Export the frames which are not in the output file yet.
+
+        Args
+        ----
+        mask : numpy.ndarray or None, optional, default None
+            The channel mask, as returned by make_mask_lookup, to store
+            with the data.
+        blockSize : int or None, optional, default None
+            The number of frames converted at a time. If None, uses
+            chunkFrames. This sets the memory used by the export.
+
+        Returns
+        -------
+        int
+            The number of frames exported by this call.
+        """
+        if blockSize is None:
+            blockSize = self._chunkFrames
+
+        source = json.dumps([os.path.abspath(f) for f in self._files])
+        mode   = 'a' if os.path.exists(self._outFile) else 'w'
+
+        with _FileContext(_openFile(self._outFile, self._fileFormat, mode)) as out:
+
+            if DataName in out:
+                # The previous export must be from the same data, new roll
+                # over parts may have been added since
+                prev = json.loads(out.attrs['source'])
+                if prev != json.loads(source)[:len(prev)]:
+                    raise ValueError(f"{self._outFile} was exported from different files")
+                start = int(out.attrs['frames'])
+            else:
+                start = 0
+
+            out.attrs['source'] = source
+
+            if mask is not None:
+                mask = numpy.asarray(mask)
+                if MaskName in out:
+                    del out[MaskName]
+                _createColumn(out, MaskName, mask.shape, mask.dtype, mask.shape,
+                              self._fileFormat, None)[...] = mask
+
+            # The run may still be written, the incomplete record at the
+            # end is exported by the next call
+            reader = SmurfStreamReader(self._files, useIndex=self._useIndex, partial=True)
+            pos    = start
+
+            for header, data in reader.blocks(blockSize, start=start):
+                if DataName not in out:
+                    self._createColumns(out, data.shape[1])
+
+                if data.shape[1] != out[DataName].shape[1]:
+                    raise ValueError(f"Number of channels changes in {reader.currFName}")
+
+                _appendColumn(out[DataName], data, pos)
+
+                for k, v in decodeSmurfHeaders(header).items():
+                    _appendColumn(out[HeaderName][k], v, pos)
+
+                # Only count the frames once all the columns are written
+                pos += len(header)
+                out.attrs['frames'] = pos
+
+        return pos - start
+
+    def _createColumns(self, out, chanCount):
+        chunk = self._chunkFrames
+        _createColumn(out, DataName, (0, chanCount), numpy.int32,
+                      (chunk, 1), self._fileFormat, self._compression)
+
+        group  = out.require_group(HeaderName)
+        fields = decodeSmurfHeaders(numpy.zeros((1, SmurfHeaderSize), dtype=numpy.uint8))
+
+        for k, v in fields.items():
+            _createColumn(group, k, (0,) + v.shape[1:], v.dtype,
+                          (chunk,) + v.shape[1:], self._fileFormat, self._compression)
+
+        out.attrs['frames'] = 0
+
+
+class _FileContext(object):
+    """
+    Context manager which closes HDF5 files, zarr groups have no close
+    """
+    def __init__(self, f):
+        self._f = f
+
+    def __enter__(self):
+        return self._f
+
+    def __exit__(self, type, value, tb):
+        if hasattr(self._f, 'close'):
+            self._f.close()
+
+
+def readExported(fn, *, channels=None, start=None, stop=None, fileFormat=None):
+    """
+    Read a file written by SmurfStreamExporter.
+
+    Args
+    ----
+    fn : str
+        The exported file.
+    channels : int, list of int or None, optional, default None
+        The channels to read. None reads all the channels.
+    start : int or None, optional, default None
+        The first frame to read.
+    stop : int or None, optional, default None
+        Read up to this frame, not included.
+    fileFormat : str or None, optional, default None
+        Either 'hdf5' or 'zarr'. If None, it is guessed from fn.
+
+    Returns
+    -------
+    header : dict
+        The header columns of the selected frames.
+    data : numpy.ndarray
+        The (n_frames, n_channels) int32 data.
+    mask : numpy.ndarray or None
+        The stored channel mask, None if there is none.
+    """
+    fileFormat = _fileFormat(fn, fileFormat)
+
+    with _FileContext(_openFile(fn, fileFormat, 'r')) as f:
+        frames = int(f.attrs['frames'])
+        rows   = slice(*slice(start, stop).indices(frames))
+
+        if channels is None:
+            data = numpy.asarray(f[DataName][rows])
+        else:
+            # Channels are read one column at a time, so only their
+            # chunks are decompressed
+            channels = numpy.ravel(numpy.asarray(channels, dtype=int))
+            data = numpy.empty((len(range(frames)[rows]), len(channels)), dtype=numpy.int32)
+            for i, c in enumerate(channels):
+                data[:, i] = f[DataName][rows, int(c)]
+
+        header = {k: numpy.asarray(f[HeaderName][k][rows]) for k in f[HeaderName]}
+        mask   = numpy.asarray(f[MaskName][...]) if MaskName in f else None
+
+    return header, data, mask
@@ -15,8 +15,14 @@
 #-----------------------------------------------------------------------------
 from collections import namedtuple
 from collections import OrderedDict as odict
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import glob
+import mmap
 import os
 import struct
+import tempfile
+import time
 
 import numpy
 import yaml
@@ -34,7 +40,6 @@ RogueHeaderPack  = 'IHBB'
 # Note: This assumes that the header version is 1 (currently the only version available),
 # which has a length of 128 bytes. In the future, we should check first the version,
 # and then unpack the data base on the version number.
-# TO DO: Extract the TES BIAS values
 
 # Default header as a named tuple
 SmurfHeaderTuple = namedtuple( 'SmurfHeader',
@@ -73,6 +78,49 @@ RogueHeader = namedtuple( 'RogueHeader',
                            'error'               ,  # 1 bytes, uint8,  B
                            'channel' ])             # 1 bytes, uint8,  B
 
+# Numpy versions of the headers above. These are used by the bulk reader to
+# look at a whole memory mapped file at once, without creating per frame
+# python objects. The offsets match SmurfHeaderPack and RogueHeaderPack.
+RogueHeaderDtype = numpy.dtype([ ('size'    , '<u4'),
+                                 ('flags'   , '<u2'),
+                                 ('error'   , 'u1' ),
+                                 ('channel' , 'u1' ) ])
+
+SmurfHeaderDtype = numpy.dtype({
+    'names'    : [ 'protocol_version', 'crate_id', 'slot_number', 'timing_cond',
+                   'number_of_channels', 'tes_bias_raw', 'timestamp',
+                   'flux_ramp_increment', 'flux_ramp_offset', 'counter_0',
+                   'counter_1', 'counter_2', 'reset_bits', 'frame_counter',
+                   'tes_relays_config', 'external_time_raw', 'control_field',
+                   'test_params', 'num_rows', 'num_rows_reported', 'row_length',
+                   'data_rate' ],
+    'formats'  : [ 'u1', 'u1', 'u1', 'u1', '<u4', ('u1', (40,)), '<u8', '<u4',
+                   '<u4', '<u4', '<u4', '<u8', '<u4', '<u4', '<u4', '<u8', 'u1',
+                   'u1', '<u2', '<u2', '<u2', '<u2' ],
+    'offsets'  : [ 0, 1, 2, 3, 4, 8, 48, 56, 60, 64, 68, 72, 80, 84, 88, 96, 104,
+                   105, 112, 114, 120, 122 ],
+    'itemsize' : SmurfHeaderSize })
+
+# Index entry for one record in a file. The offset points to the start of the
+# record payload (right after the Rogue header), size is the payload size.
+# The header fields are only filled for data records (channel 0).
+RecordIndexDtype = numpy.dtype([ ('offset'             , '<u8'),
+                                 ('size'               , '<u4'),
+                                 ('channel'            , 'u1' ),
+                                 ('frame_counter'      , '<u4'),
+                                 ('timestamp'          , '<u8'),
+                                 ('number_of_channels' , '<u4') ])
+
+# Index sidecar files are saved next to the data file, hidden so they are not
+# picked up by the glob patterns used to find the data file parts.
+IndexFileFormat = '.{}.idx.npz'
+
+# Largest number of records checked at once when scanning a Rogue file
+ScanBlockMax = 65536
+
+# Number of parsed metadata records kept by SmurfStreamReader.configAt
+MetaCacheSize = 64
+
 
 class SmurfHeader(SmurfHeaderTuple):
 
@@ -83,18 +131,11 @@ class SmurfHeader(SmurfHeaderTuple):
         # 24 bit bias values
         #self.tesBias = [int.from_bytes(rawData[8+i*3:8+i*3+3], 'little', signed=True) for i in range(16)]
 
-        # 20 bit bias values
-        for i in range(16):
-            b = int(i/2)
+        # 20 bit bias values, packed back to back starting from byte 8
+        packed = int.from_bytes(rawData[8:48], 'little', signed=False)
 
-            # 2 TES value fit in 5 bytes, starting from byte 8
-            # Each pair (byte 0 - 4): 00 00 01 11 11
-            # Even: bytes 0 - 2: 00 00 0x
-            # Odd: bytes 2 - 4: x1 11 11
-            if i % 2 == 0: # Even
-                tmp = int.from_bytes(rawData[8+b*5:8+b*5+3],'little',signed=False) & 0xFFFFF
-            else: # Odd
-                tmp = (int.from_bytes(rawData[8+b*5+2:8+b*5+5],'little',signed=False) >> 4) & 0xFFFFF
+        for i in range(16):
+            tmp = (packed >> (20 * i)) & 0xFFFFF
 
             # Adjust negative values
             if tmp >= 0x80000:
@@ -102,20 +143,415 @@ class SmurfHeader(SmurfHeaderTuple):
 
             self.tesBias.append(tmp)
 
-class SmurfStreamReader(object):
 
-    def __init__(self, files, *, isRogue=True, metaEnable=False, chanCount=None):
+def decodeSmurfHeaders(headers):
+    """
+    Decode an array of SMuRF headers into column arrays.
+
+    Args
+    ----
+    headers : numpy.ndarray or bytes
+        Either a structured array of SmurfHeaderDtype, as returned by
+        SmurfStreamReader.readAll, an (n, 128) uint8 array of raw headers
+        or the raw headers as bytes.
+
+    Returns
+    -------
+    dict
+        One array per SmurfHeader field, plus 'external_time' (the lower
+        5 bytes of external_time_raw) and 'tes_bias', the (n, 16) int32
+        array of TES bias values.
+    """
+    if not isinstance(headers, numpy.ndarray):
+        headers = numpy.frombuffer(headers, dtype=numpy.uint8)
+
+    if headers.dtype != SmurfHeaderDtype:
+        headers = numpy.ascontiguousarray(headers, dtype=numpy.uint8)
+        headers = headers.reshape(-1, SmurfHeaderSize).view(SmurfHeaderDtype)[:, 0]
+
+    ret = {k: headers[k] for k in SmurfHeaderTuple._fields}
+    ret['external_time'] = headers['external_time_raw'] & 0xFFFFFFFFFF
+
+    # 2 TES value fit in 5 bytes, starting from byte 8
+    # Each pair (byte 0 - 4): 00 00 01 11 11
+    # Even: bytes 0 - 2: 00 00 0x
+    # Odd: bytes 2 - 4: x1 11 11
+    raw = headers['tes_bias_raw'].reshape(-1, 8, 5).astype(numpy.int32)
+    tes = numpy.empty((len(headers), 8, 2), dtype=numpy.int32)
+    tes[:, :, 0] = raw[:, :, 0] | (raw[:, :, 1] << 8) | ((raw[:, :, 2] & 0xF) << 16)
+    tes[:, :, 1] = (raw[:, :, 2] >> 4) | (raw[:, :, 3] << 4) | (raw[:, :, 4] << 12)
+
+    # Sign extend the 20 bit values
+    tes ^= 0x80000
+    tes -= 0x80000
+
+    ret['tes_bias'] = tes.reshape(-1, 16)
+    return ret
+
+
+def _scanRogueRecords(buf, fname, partial=False):
+    """
+    Build the record index of a memory mapped Rogue file. If partial is
+    set, an incomplete record at the end of the buffer is expected and
+    does not generate a warning.
+
+    Consecutive records with the same size and channel are located in
+    blocks: the Rogue headers of the candidate records are checked with a
+    single strided view and the matching prefix is accepted at once.
+    Interleaved metadata records only cost one python iteration each.
+    """
+    hdrStruct = struct.Struct('<' + RogueHeaderPack)
+    fileSize  = len(buf)
+    pos       = 0
+    block     = 16
+    offsets   = []
+    sizes     = []
+    channels  = []
+
+    while pos != fileSize:
+
+        # Not enough data left in the file
+        if (fileSize - pos) < RogueHeaderSize:
+            if not partial:
+                print(f"Warning: File under run reading {fname}")
+            break
+
+        size, _, _, channel = hdrStruct.unpack_from(buf, pos)
+        recLen = size + 4
+
+        # Sanity check
+        if size < 4 or pos + recLen > fileSize:
+            if size < 4 or not partial:
+                print(f"Warning: File under run reading {fname}")
+            break
+
+        # Check how many of the following records have the same layout
+        count = min((fileSize - pos) // recLen, block)
+        if count > 1:
+            hdrs = numpy.ndarray((count,), dtype=RogueHeaderDtype, buffer=buf,
+                                 offset=pos, strides=(recLen,))
+            bad  = (hdrs['size'] != size) | (hdrs['channel'] != channel)
+            run  = int(numpy.argmax(bad)) if bad.any() else count
+        else:
+            run = 1
+
+        # Grow the block while the records are regular, restart otherwise
+        block = min(block * 2, ScanBlockMax) if run == count else 16
+
+        offsets.append(pos + RogueHeaderSize + recLen * numpy.arange(run, dtype=numpy.uint64))
+        sizes.append(numpy.full(run, size - 4, dtype=numpy.uint32))
+        channels.append(numpy.full(run, channel, dtype=numpy.uint8))
+        pos += run * recLen
+
+    idx = numpy.zeros(sum(len(o) for o in offsets), dtype=RecordIndexDtype)
+    if offsets:
+        idx['offset']  = numpy.concatenate(offsets)
+        idx['size']    = numpy.concatenate(sizes)
+        idx['channel'] = numpy.concatenate(channels)
+
+    return idx
+
+
+def _strideRuns(offsets):
+    """
+    Split an increasing array of offsets into runs of constant stride.
+    Returns a list of (start, stop, stride) tuples.
+    """
+    runs  = []
+    n     = len(offsets)
+    steps = numpy.diff(offsets.astype(numpy.int64))
+    chg   = numpy.flatnonzero(steps[1:] != steps[:-1]) + 1
+    start = 0
+
+    while start < n:
+        if start == n - 1:
+            runs.append((start, n, 0))
+            break
+
+        # Index of the last record with the same stride as the first one
+        k    = numpy.searchsorted(chg, start, side='right')
+        stop = int(chg[k]) if k < len(chg) else n - 1
+
+        runs.append((start, stop + 1, int(steps[start])))
+        start = stop + 1
+
+    return runs
+
+
+def _fillIndex(buf, idx):
+    """
+    Copy the frame counter, timestamp and channel count of each data
+    record into the index.
+    """
+    raw  = numpy.frombuffer(buf, dtype=numpy.uint8)
+    data = (idx['channel'] == 0) & (idx['size'] >= SmurfHeaderSize)
+    offs = idx['offset'][data].astype(numpy.int64)[:, None]
+
+    for name in ['frame_counter', 'timestamp', 'number_of_channels']:
+        dtype, offset = SmurfHeaderDtype.fields[name]
+        idx[name][data] = raw[offs + offset + numpy.arange(dtype.itemsize)].view(dtype)[:, 0]
+
+
+def dataFileParts(fn):
+    """
+    Return the data file and its roll over parts (fn.1, fn.2, ...) which
+    exist on disk, in part order.
+    """
+    parts = []
+
+    if os.path.exists(fn):
+        parts.append(fn)
+
+    for part in glob.glob(glob.escape(fn) + '.*'):
+        suffix = part[len(fn)+1:]
+        if suffix.isdigit():
+            parts.append(part)
+
+    return sorted(parts, key=lambda p: -1 if p == fn else int(p[len(fn)+1:]))
+
+
+def indexFileName(fn):
+    """
+    Return the path of the index sidecar file for a data file
+    """
+    return os.path.join(os.path.dirname(fn), IndexFileFormat.format(os.path.basename(fn)))
+
+
+def _indexKey(size, st, isRogue, chanCount):
+    """
+    Values which must match for an index sidecar to be valid. The size is
+    the length of the mapped buffer and st the stat of the mapped file.
+    """
+    return numpy.array([size, st.st_mtime_ns, isRogue, -1 if chanCount is None else chanCount],
+                       dtype=numpy.int64)
+
+
+def _loadIndex(fn, key):
+    """
+    Load the index sidecar of a file, returns None if missing or out of date
+    """
+    try:
+        with numpy.load(indexFileName(fn)) as npz:
+            if numpy.array_equal(npz['key'], key) and npz['index'].dtype == RecordIndexDtype:
+                return npz['index']
+    except Exception:
+        pass
+
+    return None
+
+
+def _saveIndex(fn, key, idx):
+    """
+    Write the index sidecar of a file, failures only generate a warning
+    """
+    path = indexFileName(fn)
+    tmp  = path + f'.{os.getpid()}.tmp'
+
+    try:
+        with open(tmp, 'wb') as f:
+            numpy.savez(f, key=key, index=idx)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"Warning: Unable to write index file {path}: {e}")
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _unwrapFrameCounter(frameCounter):
+    """
+    Return the frame counters as int64, unwrapping the 32 bit roll overs
+    """
+    fc   = numpy.asarray(frameCounter).astype(numpy.int64)
+    wrap = numpy.diff(fc) < -2**31
+
+    if wrap.any():
+        fc[1:] += 2**32 * numpy.cumsum(wrap)
+
+    return fc
+
+
+def frameStatistics(frameCounter):
+    """
+    Compute frame statistics from the frame_counter header column.
+
+    These are the offline equivalent of the counters of the
+    FrameStatistics device in the SMuRF processor.
+
+    Args
+    ----
+    frameCounter : numpy.ndarray
+        The frame_counter of each frame, in file order.
+
+    Returns
+    -------
+    dict
+        'frameCnt', the number of frames, 'frameLossCnt', the number of
+        frames missing from the counter range, 'frameOutOrderCnt', the
+        number of frames with a counter lower than the previous one,
+        'frameDuplicateCnt', the number of frames with an already seen
+        counter, and the 'gapStart' and 'gapSize' arrays, the first
+        missing counter and the number of missing frames of each gap.
+    """
+    fc    = _unwrapFrameCounter(frameCounter)
+    delta = numpy.diff(fc)
+
+    if len(fc) == 0:
+        return { 'frameCnt'          : 0,
+                 'frameLossCnt'      : 0,
+                 'frameOutOrderCnt'  : 0,
+                 'frameDuplicateCnt' : 0,
+                 'gapStart'          : numpy.zeros(0, dtype=numpy.int64),
+                 'gapSize'           : numpy.zeros(0, dtype=numpy.int64) }
+
+    # Unique counters in increasing order. The frames are normally in order,
+    # in which case there is no need to sort.
+    if (delta >= 0).all():
+        uniq = fc[numpy.concatenate(([True], delta != 0))]
+    else:
+        uniq = numpy.unique(fc)
+
+    step = numpy.diff(uniq)
+    gaps = numpy.flatnonzero(step > 1)
+
+    return { 'frameCnt'          : len(fc),
+             'frameLossCnt'      : int(uniq[-1] - uniq[0] + 1 - len(uniq)),
+             'frameOutOrderCnt'  : int(numpy.count_nonzero(delta < 0)),
+             'frameDuplicateCnt' : len(fc) - len(uniq),
+             'gapStart'          : uniq[gaps] + 1,
+             'gapSize'           : step[gaps] - 1 }
+
+
+def fillFrameGaps(frameCounter, data):
+    """
+    Place the data on a uniform frame_counter grid.
+
+    Frames are sorted by frame counter, the first of duplicated frames is
+    kept and missing frames are filled with NaN.
+
+    Args
+    ----
+    frameCounter : numpy.ndarray
+        The frame_counter of each frame.
+    data : numpy.ndarray
+        The (n_frames, n_channels) data.
+
+    Returns
+    -------
+    grid : numpy.ndarray
+        The unwrapped frame counter of each output row.
+    filled : numpy.ndarray
+        The (n_grid, n_channels) float64 data, NaN for missing frames.
+    valid : numpy.ndarray
+        Boolean array, True for the rows which hold a frame.
+    """
+    fc = _unwrapFrameCounter(frameCounter)
+
+    if len(fc) == 0:
+        return fc, numpy.zeros((0,) + data.shape[1:]), numpy.zeros(0, dtype=bool)
+
+    uniq, first = numpy.unique(fc, return_index=True)
+    grid  = numpy.arange(uniq[0], uniq[-1] + 1)
+    valid = numpy.zeros(len(grid), dtype=bool)
+    valid[uniq - uniq[0]] = True
+
+    filled = numpy.full((len(grid),) + data.shape[1:], numpy.nan)
+    filled[uniq - uniq[0]] = data[first]
+
+    return grid, filled, valid
+
+
+def _sharedArrays(buf, count, width):
+    """
+    Header and data arrays for count frames in a shared output buffer
+    """
+    header = numpy.ndarray((count,), dtype=SmurfHeaderDtype, buffer=buf)
+    data   = numpy.ndarray((count, width), dtype=numpy.int32, buffer=buf,
+                           offset=count * SmurfHeaderSize)
+    return header, data
+
+
+def _indexWorker(args):
+    """
+    Process pool worker which returns the record index of a file
+    """
+    fn, kwargs = args
+    reader = SmurfStreamReader(fn, **kwargs)
+    buf    = reader._mapFile(fn)
+
+    if buf is None:
+        return numpy.zeros(0, dtype=RecordIndexDtype)
+
+    return reader._indexFile(buf, fn)
+
+
+def _decodeWorker(args):
+    """
+    Process pool worker which copies the selected records of a file into
+    the shared output arrays, starting at row. Returns the number of rows
+    written.
+    """
+    fn, kwargs, idx, channels, outName, count, width, row = args
+    reader = SmurfStreamReader(fn, **kwargs)
+    buf    = reader._mapFile(fn)
+    first  = row
+
+    # The output file is mapped shared, the writes are seen by the
+    # other processes mapping it
+    header, data = _sharedArrays(numpy.memmap(outName, dtype=numpy.uint8, mode='r+'), count, width)
+
+    for h, d in reader._fileSegments(buf, idx, fn):
+        header[row:row+len(h)] = h
+        data[row:row+len(h)]   = d[:, channels]
+        row += len(h)
+
+    return row - first
+
+
+class SmurfStreamReader(object):
+    """
+    Reader for the data files written by the SmurfProcessor.
+
+    Args
+    ----
+    files : str or list of str
+        The data file, or list of data file parts, to read.
+    isRogue : bool, optional, default True
+        Whether the files are in Rogue format, or legacy headers followed
+        by data.
+    metaEnable : bool, optional, default False
+        Whether to process the metadata records into configDict.
+    chanCount : int or None, optional, default None
+        The number of channels to read per frame. If None, it is taken
+        from the SMuRF headers.
+    useIndex : bool, optional, default False
+        Whether to keep a persistent index of the records of each file
+        in a hidden sidecar file next to it. See indexFileName.
+    partial : bool, optional, default False
+        Whether the files may still be written, in which case an
+        incomplete record at the end of a file is skipped without a
+        warning.
+    """
+
+    def __init__(self, files, *, isRogue=True, metaEnable=False, chanCount=None, useIndex=False,
+                 partial=False):
         self._isRogue    = isRogue
         self._metaEnable = metaEnable
         self._chanCount  = chanCount
-        self._currFile   = None
+        self._useIndex   = useIndex
+        self._partial    = partial
         self._currFName  = ''
-        self._fileSize   = 0
         self._header     = None
         self._data       = None
         self._config     = {}
         self._currCount  = 0
         self._totCount   = 0
+        self._frameCounter = numpy.zeros(0, dtype=numpy.uint32)
+        self._frameStats   = None
+        self._metaIndex    = None
+        self._metaCache    = odict()
+        self._metaConfig   = {}
+        self._metaApplied  = 0
+        self._mapStat      = {}
 
         if isinstance(files,list):
             self._fileList = files
@@ -127,150 +563,626 @@ class SmurfStreamReader(object):
             if not os.access(fn,os.R_OK):
                 raise Exception(f"Unable to read file {fn}")
 
-    def _parseRogueHeader(self):
-        return RogueHeader._make(struct.Struct(RogueHeaderPack).unpack(self._currFile.read(RogueHeaderSize)))
-
-    def _parseSmurfHeader(self):
-        data = self._currFile.read(SmurfHeaderSize)
-        ret = SmurfHeader._make(struct.Struct(SmurfHeaderPack).unpack(data))
-        ret.initialize(data)
-        return ret
+    def _mapFile(self, fn):
+        """
+        Memory map a file in read only mode, returns None for empty files.
+        The stat of the file, taken after mapping it, is kept for the index
+        sidecar key.
+        """
+        with open(fn,'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
 
-    def _readPayload(self,chanCount):
-        return numpy.fromfile(self._currFile, dtype=numpy.int32, count=chanCount)
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mapStat[fn] = os.fstat(f.fileno())
+            return buf
 
-    def _nextRecord(self):
+    def _indexFile(self, buf, fn):
         """
-        Process next record, return true on success
+        Return the index of all the records in a memory mapped file.
+
+        When useIndex is set, the index is loaded from the sidecar file next
+        to the data file. The sidecar is rebuilt if the size or modification
+        time of the data file changed. It is not saved if the file grew
+        while being mapped, as the key would not describe the mapped data.
         """
-        recEnd = 0
+        if self._useIndex:
+            st  = self._mapStat[fn]
+            key = _indexKey(len(buf), st, self._isRogue, self._chanCount)
+            idx = _loadIndex(fn, key)
 
-        # We are at the end of the file
-        if self._currFile.tell() == self._fileSize:
-            return False
+            # Never trust an index which points past the mapped data
+            if idx is not None and (len(idx) == 0 or
+                                    int(idx['offset'][-1]) + int(idx['size'][-1]) <= len(buf)):
+                return idx
 
-        # Use Rogue format
         if self._isRogue:
+            idx = _scanRogueRecords(buf, fn, partial=self._partial)
 
-            # keep reading until we get a data channel
-            while True:
+        # Legacy files have fixed size records, without Rogue headers. Use the
+        # defined channel count if it exists, otherwise the header value.
+        else:
+            if self._chanCount is not None:
+                chanCount = self._chanCount
+            else:
+                chanCount = struct.unpack_from('<I', buf, 4)[0]
 
-                # Hit end of file
-                if self._currFile.tell() == self._fileSize:
-                    return False
+            recLen = SmurfHeaderSize + chanCount * SmurfChannelSize
+            count  = len(buf) // recLen
 
-                # Not enough data left in the file
-                if (self._fileSize - self._currFile.tell()) < RogueHeaderSize:
-                    print(f"Waring: File under run reading {self._currFName}")
-                    return False
+            if count * recLen != len(buf) and not self._partial:
+                print(f"Warning: SMURF data overruns remaining file size in {fn}")
 
-                # Read in Rogue header data
-                rogueHeader  = self._parseRogueHeader()
-                roguePayload = rogueHeader.size - 4
+            idx = numpy.zeros(count, dtype=RecordIndexDtype)
+            idx['offset'] = recLen * numpy.arange(count, dtype=numpy.uint64)
+            idx['size']   = recLen
 
-                # Set next frame position
-                recEnd = self._currFile.tell() + roguePayload
+        _fillIndex(buf, idx)
 
-                # Sanity check
-                if recEnd > self._fileSize:
-                    print(f"Waring: File under run reading {self._currFName}")
-                    return False
+        if self._useIndex and st.st_size == len(buf):
+            _saveIndex(fn, key, idx)
 
-                # If this is a data channel, break
-                if rogueHeader.channel == 0:
-                    break
+        return idx
 
-                # Process meta data
-                elif self._metaEnable and rogueHeader.channel == 1:
-                    try:
-                        yamlUpdate(self._config, self._currFile.read(roguePayload).decode('utf-8'))
-                    except Exception as e:
-                        print(f"Waring: Error processing meta data in {self._currFName}: {e}")
+    def _processMeta(self, buf, offset, size, fn):
+        try:
+            yamlUpdate(self._config, buf[offset:offset+size].decode('utf-8'))
+        except Exception as e:
+            print(f"Warning: Error processing meta data in {fn}: {e}")
 
-                # Skip over meta data
-                else:
-                    self._currFile.seek(recEnd)
+    def _dataIndex(self, idx, fn):
+        """
+        Return the index entries of the data records which can hold a header
+        """
+        idx   = idx[idx['channel'] == 0]
+        valid = idx['size'] >= SmurfHeaderSize
 
-            # Check if there is enough room for the Smurf header
-            if SmurfHeaderSize > roguePayload:
-                print(f"Waring: SMURF header overruns remaining record size in {self._currFName}")
-                return False
+        if not valid.all():
+            print(f"Warning: SMURF header overruns remaining record size in {fn}")
+            idx = idx[valid]
 
-        # Non Rogue file, verify there is enough room in the file for the smurf header
-        elif SmurfHeaderSize + self._currFile.tell() > self._fileSize:
-            print(f"Warning: SMURF header overruns remaining file size in {self._currFName}")
-            return None
+        return idx
 
-        # Unpack header into named tuple
-        self._header = self._parseSmurfHeader()
+    def _selectRange(self, idx, base, start, stop, by):
+        """
+        Restrict a data index to the requested range. The base is the
+        number of data records in the previous files.
+        """
+        if start is None and stop is None:
+            return idx
+
+        if by == 'index':
+            lo = 0 if start is None else max(start - base, 0)
+            hi = len(idx) if stop is None else max(stop - base, 0)
+            return idx[lo:hi]
+
+        if by == 'frame':
+            col, scale = idx['frame_counter'], 1
+        elif by == 'time':
+            col, scale = idx['timestamp'], 1e9
+        else:
+            raise ValueError(f"Invalid range type {by}, must be 'index', 'frame' or 'time'")
 
-        # Number of data channels is taken from the header
-        chanCount = self._header.number_of_channels
-        dataSize  = chanCount * SmurfChannelSize
+        mask = numpy.ones(len(idx), dtype=bool)
+        if start is not None:
+            mask &= col >= start * scale
+        if stop is not None:
+            mask &= col < stop * scale
 
-        # Rogue raw data size is computed from rogue headers
-        if self._isRogue:
-            rawDataSize = recEnd - self._currFile.tell()
+        return idx[mask]
 
-        # Legacy File
-        else:
+    def _fileSegments(self, buf, idx, fn):
+        """
+        Return a list of (header, data) views into a memory mapped file, one
+        for each run of evenly spaced data records.
+        """
+        segments = []
+
+        for start, stop, stride in _strideRuns(idx['offset']):
+            offset = int(idx['offset'][start])
+            count  = stop - start
+
+            header = numpy.ndarray((count,), dtype=SmurfHeaderDtype, buffer=buf,
+                                   offset=offset, strides=(stride,))
+
+            if self._chanCount is not None:
+                chanCount = self._chanCount
+            else:
+                chanCount = int(header['number_of_channels'].min())
+                if chanCount != header['number_of_channels'].max():
+                    print(f"Warning: Number of channels changes within {fn}, using {chanCount}")
+
+            # Verify sizing
+            if chanCount * SmurfChannelSize > int(idx['size'][start:stop].min()) - SmurfHeaderSize:
+                print(f"Warning: SMURF read data size overruns raw data size in {fn}")
+                break
+
+            data = numpy.ndarray((count, chanCount), dtype=numpy.int32, buffer=buf,
+                                 offset=offset + SmurfHeaderSize,
+                                 strides=(stride, SmurfChannelSize))
+
+            segments.append((header, data))
+
+        return segments
+
+    def _segments(self, start, stop, by):
+        """
+        Generator which returns (header, data) views of the runs of evenly
+        spaced data records in the requested range. Files are mapped one
+        at a time, as the generator advances.
+        """
+        self._config    = {}
+        self._currCount = 0
+        self._totCount  = 0
+        base = 0
+
+        for fn in self._fileList:
+            self._currFName = fn
+            self._currCount = 0
+
+            # The requested range ends in a previous file
+            if by == 'index' and stop is not None and base >= stop:
+                break
+
+            buf = self._mapFile(fn)
+            if buf is None:
+                continue
+
+            idx = self._indexFile(buf, fn)
+
+            if self._metaEnable:
+                for offset, size in zip(*[idx[k][idx['channel'] == 1].tolist() for k in ['offset', 'size']]):
+                    self._processMeta(buf, offset, size, fn)
+
+            didx  = self._dataIndex(idx, fn)
+            sel   = self._selectRange(didx, base, start, stop, by)
+            base += len(didx)
+
+            for header, data in self._fileSegments(buf, sel, fn):
+                self._currCount += len(header)
+                self._totCount  += len(header)
+                yield header, data
+
+    def _readParallel(self, start, stop, by, channels, processes):
+        """
+        Index and decode the files in a pool of processes. The workers
+        write the output, in frame_counter order, to a temporary file
+        which all the processes map. The file is removed once mapped
+        here, the returned arrays are views of that mapping.
+        """
+        kwargs = { 'isRogue'   : self._isRogue,
+                   'chanCount' : self._chanCount,
+                   'useIndex'  : self._useIndex,
+                   'partial'   : self._partial }
+
+        self._config    = {}
+        self._currCount = 0
+        self._totCount  = 0
+
+        with ProcessPoolExecutor(processes) as pool:
+            indexes = list(pool.map(_indexWorker, [(fn, kwargs) for fn in self._fileList]))
+
+            parts = []
+            base  = 0
+            for fn, idx in zip(self._fileList, indexes):
+                if self._metaEnable and (idx['channel'] == 1).any():
+                    buf = self._mapFile(fn)
+                    for offset, size in zip(*[idx[k][idx['channel'] == 1].tolist() for k in ['offset', 'size']]):
+                        self._processMeta(buf, offset, size, fn)
+
+                didx  = self._dataIndex(idx, fn)
+                sel   = self._selectRange(didx, base, start, stop, by)
+                base += len(didx)
 
-            # Use defined size if exists.
-            if chanCount is not None:
-                rawDataSize = chanCount * SmurfChannelSize
+                if len(sel) > 0:
+                    parts.append((fn, sel))
 
-            # Otherwise use header value
+            # Stitch the files in frame_counter order
+            parts.sort(key=lambda p: int(p[1]['frame_counter'][0]))
+            count = sum(len(sel) for _, sel in parts)
+
+            if self._chanCount is not None:
+                chanCount = self._chanCount
+            elif count > 0:
+                chanCount = int(min(sel['number_of_channels'].min() for _, sel in parts))
+            else:
+                chanCount = 0
+
+            if channels is None:
+                width    = chanCount
+                channels = slice(0, chanCount)
             else:
-                rawDataSize = self._header.number_of_channels * SmurfChannelSize
+                width = len(channels)
+
+            fd, outName = tempfile.mkstemp(prefix='.smurf_read_')
+
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.truncate(max(1, count * (SmurfHeaderSize + width * SmurfChannelSize)))
+
+                jobs = []
+                row  = 0
+                for fn, sel in parts:
+                    jobs.append(pool.submit(_decodeWorker, (fn, kwargs, sel, channels, outName, count, width, row)))
+                    row += len(sel)
+
+                for (fn, sel), job in zip(parts, jobs):
+                    self._currFName = fn
+                    self._currCount = job.result()
+                    self._totCount += self._currCount
+
+                    if self._currCount != len(sel):
+                        raise RuntimeError(f"Unable to decode all the records in {fn}")
+
+                # The mapping keeps the data after the file is removed
+                header, data = _sharedArrays(numpy.memmap(outName, dtype=numpy.uint8, mode='r+'), count, width)
+
+            finally:
+                os.remove(outName)
 
-            # Compute legacy record end
-            recEnd = self._currFile.tell() + rawDataSize
+        return header, data
 
-            # File overrun
-            if recEnd > self._fileSize:
-                print(f"SMURF data overruns remaining file size in {self._currFName}")
-                return False
+    def _readBulk(self, start, stop, by, channels, processes):
+        """
+        Read the selected frames into a single header and data array
+        """
+        if processes is not None and processes > 1 and len(self._fileList) > 1:
+            return self._readParallel(start, stop, by, channels, processes)
+
+        return self._stitch(list(self._segments(start, stop, by)), channels)
+
+    def _stitch(self, segments, channels):
+        """
+        Join a list of (header, data) segments into single arrays
+        """
+        if len(segments) == 1:
+            header, data = segments[0]
+            if channels is not None:
+                data = data[:, channels]
+            return header, data
+
+        if len(segments) == 0:
+            chanCount = len(channels) if channels is not None else (self._chanCount or 0)
+            return (numpy.zeros(0, dtype=SmurfHeaderDtype),
+                    numpy.zeros((0, chanCount), dtype=numpy.int32))
+
+        # Stitch the segments together
+        chanCount = min(d.shape[1] for _, d in segments)
+        if chanCount != max(d.shape[1] for _, d in segments):
+            print(f"Warning: Number of channels changes between records, using {chanCount}")
+
+        if channels is None:
+            channels = slice(0, chanCount)
+            width    = chanCount
+        elif len(channels) > 0 and channels.max() >= chanCount:
+            raise IndexError(f"Channel {channels.max()} out of range for {chanCount} channels")
+        else:
+            width = len(channels)
+
+        count  = sum(len(h) for h, _ in segments)
+        header = numpy.empty(count, dtype=SmurfHeaderDtype)
+        data   = numpy.empty((count, width), dtype=numpy.int32)
+        pos    = 0
 
-        # Verify sizing
-        if dataSize > rawDataSize:
-            print(f"Warning: SMURF read data size overruns raw data size in {self._currFName}")
-            return False
+        for h, d in segments:
+            header[pos:pos+len(h)] = h
+            data[pos:pos+len(h)]   = d[:, channels]
+            pos += len(h)
 
-        # Read record data
-        self._data = self._readPayload(chanCount)
-        self._currCount += 1
-        self._totCount += 1
+        return header, data
 
-        # Jump forward if neccessary
-        if ( self._currFile.tell() != recEnd ):
-            self._currFile.seek(recEnd)
+    def readAll(self, start=None, stop=None, by='index', channels=None, processes=None,
+                fillGaps=False):
+        """
+        Read the data records of all the files in bulk.
+
+        The files are memory mapped and indexed in one pass, no python
+        object is created per frame. When metaEnable is set, the metadata
+        records are processed and configDict holds the last configuration.
+
+        Args
+        ----
+        start : int, float or None, optional, default None
+            First frame to read. None reads from the beginning.
+        stop : int, float or None, optional, default None
+            Read up to this frame, not included. None reads to the end.
+        by : str, optional, default 'index'
+            How start and stop are interpreted. 'index' is the position
+            of the frame in the files, 'frame' is the header
+            frame_counter and 'time' is the header timestamp as a ctime
+            in seconds. Only the selected records are read, using the
+            index to seek to them.
+        channels : int, list of int or None, optional, default None
+            The channels to read. None reads all the channels. Only the
+            requested channels are copied out of the files.
+        processes : int or None, optional, default None
+            If larger than 1 and there are several files, for example
+            the parts of a rolled over acquisition, the files are indexed
+            and decoded in a pool of this many processes. The workers
+            write straight into a shared mapping of a temporary file,
+            which backs the returned arrays, and the files are stitched
+            in frame_counter order.
+        fillGaps : bool, optional, default False
+            If True, the data is returned on a uniform frame_counter grid
+            as a float64 array, with missing frames filled with NaN. See
+            fillFrameGaps.
+
+        Returns
+        -------
+        header : numpy.ndarray
+            Structured array of SmurfHeaderDtype, one entry per frame.
+        data : numpy.ndarray
+            The (n_frames, n_channels) int32 data. When all the frames are
+            evenly spaced in a single file and all channels are read, this
+            is a read only view into the memory mapped file. Otherwise it
+            is a copy. When fillGaps is set, this is the float64 array
+            on the uniform frame grid and the header only holds the
+            frames which were found in the files.
+        """
+        if channels is not None:
+            channels = numpy.ravel(numpy.asarray(channels, dtype=int))
 
-        return True
+        header, data = self._readBulk(start, stop, by, channels, processes)
+
+        # Keep the frame counters to compute the frame statistics on demand
+        self._frameCounter = header['frame_counter']
+        self._frameStats   = None
+
+        if fillGaps:
+            _, data, _ = fillFrameGaps(self._frameCounter, data)
+
+        return header, data
+
+    def blocks(self, blockSize, start=None, stop=None, by='index', channels=None):
+        """
+        Generator which returns the data in fixed size blocks of frames.
+
+        Only one block is held in memory at a time, regardless of the
+        number and size of the files. Blocks continue across the
+        boundaries of the file parts, so all blocks but the last one hold
+        exactly blockSize frames.
+
+        Args
+        ----
+        blockSize : int
+            The number of frames in each block.
+        start, stop, by, channels :
+            Select the frames and channels to read, see readAll.
+
+        Yields
+        ------
+        header : numpy.ndarray
+            Structured array of SmurfHeaderDtype for the frames in the block.
+        data : numpy.ndarray
+            The (blockSize, n_channels) int32 data of the block.
+        """
+        if blockSize < 1:
+            raise ValueError(f"Invalid block size {blockSize}")
+
+        if channels is not None:
+            channels = numpy.ravel(numpy.asarray(channels, dtype=int))
+
+        header = None
+        width  = None
+        fill   = 0
+
+        for h, d in self._segments(start, stop, by):
+
+            # The block width is set by the first segment
+            if width is None:
+                if channels is None:
+                    width    = d.shape[1]
+                    channels = slice(0, width)
+                    chanMax  = width
+                else:
+                    width    = len(channels)
+                    chanMax  = channels.max() + 1 if width > 0 else 0
+
+            if d.shape[1] < chanMax:
+                raise ValueError(f"Number of channels changes in {self._currFName}")
+
+            pos = 0
+            while pos < len(h):
+                if header is None:
+                    header = numpy.empty(blockSize, dtype=SmurfHeaderDtype)
+                    data   = numpy.empty((blockSize, width), dtype=numpy.int32)
+
+                count = min(blockSize - fill, len(h) - pos)
+                header[fill:fill+count] = h[pos:pos+count]
+                data[fill:fill+count]   = d[pos:pos+count, channels]
+                fill += count
+                pos  += count
+
+                if fill == blockSize:
+                    yield header, data
+                    header = None
+                    fill   = 0
+
+        if fill > 0:
+            yield header[:fill], data[:fill]
+
+    def follow(self, pollInterval=0.1, timeout=None, fromEnd=False, channels=None):
+        """
+        Generator which returns the new frames of files which are still
+        being written, for example by the StreamWriter during an
+        acquisition.
+
+        The file is polled for appended data every pollInterval. Each
+        iteration returns all the complete frames written since the
+        previous one, an incomplete record at the end of the file is kept
+        for the next poll. When the writer rolls over to the next part
+        (file.1, file.2, ...), the reader moves to it once the current
+        part stops growing. Metadata records update configDict when
+        metaEnable is set.
+
+        Args
+        ----
+        pollInterval : float, optional, default 0.1
+            Time in seconds between checks for new data.
+        timeout : float or None, optional, default None
+            Stop after this many seconds without new data. If None,
+            follow the files until the generator is closed.
+        fromEnd : bool, optional, default False
+            Start from the end of the last existing part, only returning
+            frames written from now on. Otherwise start from the
+            beginning of the first file.
+        channels : int, list of int or None, optional, default None
+            The channels to read. None reads all the channels.
+
+        Yields
+        ------
+        header : numpy.ndarray
+            Structured array of SmurfHeaderDtype for the new frames.
+        data : numpy.ndarray
+            The (n_frames, n_channels) int32 data of the new frames.
+        """
+        if not self._isRogue:
+            raise ValueError("Following files requires Rogue format files")
+
+        if channels is not None:
+            channels = numpy.ravel(numpy.asarray(channels, dtype=int))
+
+        base  = self._fileList[0]
+        parts = dataFileParts(base) or [base]
+        fn    = parts[-1] if fromEnd else parts[0]
+        pos   = 0
+        last  = time.monotonic()
+
+        # Skip the complete records already in the file, the file size may
+        # end in the middle of a record
+        if fromEnd:
+            buf = self._mapFile(fn)
+            if buf is not None:
+                idx = _scanRogueRecords(buf, fn, partial=True)
+                if len(idx) > 0:
+                    pos = int(idx['offset'][-1]) + int(idx['size'][-1])
+
+        self._config    = {}
+        self._currFName = fn
+        self._currCount = 0
+        self._totCount  = 0
+
+        f = open(fn, 'rb')
+
+        try:
+            while True:
+                size = os.fstat(f.fileno()).st_size
+
+                if size > pos:
+                    f.seek(pos)
+                    buf = f.read(size - pos)
+                    idx = _scanRogueRecords(buf, fn, partial=True)
+
+                    if len(idx) > 0:
+                        _fillIndex(buf, idx)
+                        pos += int(idx['offset'][-1]) + int(idx['size'][-1])
+
+                        if self._metaEnable:
+                            for offset, msize in zip(*[idx[k][idx['channel'] == 1].tolist() for k in ['offset', 'size']]):
+                                self._processMeta(buf, offset, msize, fn)
+
+                        segments = self._fileSegments(buf, self._dataIndex(idx, fn), fn)
+
+                        if segments:
+                            header, data = self._stitch(segments, channels)
+                            self._currCount += len(header)
+                            self._totCount  += len(header)
+                            last = time.monotonic()
+                            yield header, data
+                            continue
+
+                # Move to the next part once this one stops growing
+                parts = dataFileParts(base)
+                if fn in parts and parts.index(fn) + 1 < len(parts) and os.path.getsize(fn) == size:
+                    if pos != size:
+                        print(f"Warning: Incomplete record at the end of {fn}")
+
+                    f.close()
+                    fn  = parts[parts.index(fn) + 1]
+                    pos = 0
+                    f   = open(fn, 'rb')
+                    self._currFName = fn
+                    self._currCount = 0
+                    continue
+
+                if timeout is not None and time.monotonic() - last > timeout:
+                    return
+
+                time.sleep(pollInterval)
+
+        finally:
+            f.close()
 
     def records(self):
         """
         Generator which returns (header, data) tuples
+
+        This is a compatibility wrapper around the bulk reader index, which
+        creates a SmurfHeader and a data array for every frame. Use readAll
+        for fast access to whole files.
         """
         self._config = {}
         self._currCount = 0
         self._totCount  = 0
+        hdrStruct = struct.Struct(SmurfHeaderPack)
 
         for fn in self._fileList:
-            self._fileSize = os.path.getsize(fn)
             self._currFName = fn
             self._currCount = 0
 
             print(f"Processing data records from {self._currFName}")
-            with open(fn,'rb') as f:
-                self._currFile = f
+            buf = self._mapFile(fn)
+
+            if buf is not None:
+                idx = self._indexFile(buf, fn)
+
+                for offset, size, channel in zip(*[idx[k].tolist() for k in ['offset', 'size', 'channel']]):
+
+                    # Process meta data
+                    if channel == 1 and self._metaEnable:
+                        self._processMeta(buf, offset, size, fn)
+
+                    # Skip over other channels
+                    if channel != 0:
+                        continue
+
+                    # Check if there is enough room for the Smurf header
+                    if SmurfHeaderSize > size:
+                        print(f"Warning: SMURF header overruns remaining record size in {fn}")
+                        break
+
+                    # Unpack header into named tuple
+                    rawHeader = buf[offset:offset+SmurfHeaderSize]
+                    self._header = SmurfHeader._make(hdrStruct.unpack(rawHeader))
+                    self._header.initialize(rawHeader)
+
+                    # Number of data channels is taken from the header
+                    if self._chanCount is not None:
+                        chanCount = self._chanCount
+                    else:
+                        chanCount = self._header.number_of_channels
+
+                    # Verify sizing
+                    if chanCount * SmurfChannelSize > size - SmurfHeaderSize:
+                        print(f"Warning: SMURF read data size overruns raw data size in {fn}")
+                        break
+
+                    # Read record data
+                    self._data = numpy.frombuffer(buf, dtype=numpy.int32, count=chanCount,
+                                                  offset=offset + SmurfHeaderSize).copy()
+                    self._currCount += 1
+                    self._totCount += 1
 
-                while self._nextRecord():
                     yield (self._header, self._data)
 
             print(f"Processed {self._currCount} data records from {self._currFName}")
 
         print(f"Processed a total of {self._totCount} data records")
 
+    @property
+    def currFName(self):
+        return self._currFName
+
     @property
     def currCount(self):
         return self._currCount
@@ -279,12 +1191,153 @@ class SmurfStreamReader(object):
     def totCount(self):
         return self._totCount
 
+    @property
+    def frameStats(self):
+        """
+        Frame loss, duplicate and out-of-order statistics of the frames
+        returned by the last call to readAll, see frameStatistics.
+        """
+        if self._frameStats is None:
+            self._frameStats = frameStatistics(self._frameCounter)
+        return self._frameStats
+
     @property
     def configDict(self):
         return self._config
 
-    def configValue(self, path):
-        obj = self._config
+    def _buildMetaIndex(self):
+        """
+        Index the metadata records of all the files, along with the number
+        of data records written before each of them.
+        """
+        metaPos   = []
+        metaRecs  = []
+        counters  = []
+        stamps    = []
+        self._metaBufs = {}
+        base = 0
+
+        for i, fn in enumerate(self._fileList):
+            buf = self._mapFile(fn)
+            if buf is None:
+                continue
+
+            idx    = self._indexFile(buf, fn)
+            isData = (idx['channel'] == 0) & (idx['size'] >= SmurfHeaderSize)
+            isMeta = idx['channel'] == 1
+
+            # Number of data records before each record
+            dataPos = base + numpy.cumsum(isData) - isData
+
+            metaPos.append(dataPos[isMeta])
+            metaRecs += [(i, off, size) for off, size in zip(idx['offset'][isMeta].tolist(), idx['size'][isMeta].tolist())]
+            counters.append(idx['frame_counter'][isData])
+            stamps.append(idx['timestamp'][isData])
+            self._metaBufs[i] = buf
+            base += int(isData.sum())
+
+        self._metaIndex     = metaRecs
+        self._metaPos       = numpy.concatenate(metaPos) if metaPos else numpy.zeros(0, dtype=int)
+        self._metaCounters  = numpy.concatenate(counters) if counters else numpy.zeros(0, dtype=numpy.uint32)
+        self._metaStamps    = numpy.concatenate(stamps) if stamps else numpy.zeros(0, dtype=numpy.uint64)
+        self._metaConfig    = {}
+        self._metaApplied   = 0
+
+    def _parseMetaRecord(self, rec):
+        """
+        Parse a metadata record, keeping the most recent ones in a cache
+        """
+        if rec in self._metaCache:
+            self._metaCache.move_to_end(rec)
+            return self._metaCache[rec]
+
+        fileNo, offset, size = rec
+        try:
+            data = yamlToData(self._metaBufs[fileNo][offset:offset+size].decode('utf-8'))
+        except Exception as e:
+            print(f"Warning: Error processing meta data in {self._fileList[fileNo]}: {e}")
+            data = None
+
+        self._metaCache[rec] = data
+        if len(self._metaCache) > MetaCacheSize:
+            self._metaCache.popitem(last=False)
+
+        return data
+
+    def configAt(self, frame, by='index'):
+        """
+        Return the configuration in effect at a given frame.
+
+        This does not require metaEnable. The metadata records are located
+        with the file index and only the records written before the
+        requested frame are parsed. Moving forward through the files only
+        parses the new records.
+
+        Args
+        ----
+        frame : int or float
+            The frame, see by.
+        by : str, optional, default 'index'
+            How frame is interpreted. 'index' is the position of the frame
+            in the files, 'frame' is the first frame with a frame_counter
+            at least this value and 'time' the first frame with a
+            timestamp at least this ctime, in seconds.
+
+        Returns
+        -------
+        dict
+            A copy of the configuration, which is not changed by later
+            calls.
+        """
+        return copy.deepcopy(self._configAt(frame, by))
+
+    def _configAt(self, frame, by):
+        """
+        The configuration at a frame, see configAt. The returned dict is
+        the reader's own and is updated in place by the next call.
+        """
+        if self._metaIndex is None:
+            self._buildMetaIndex()
+
+        if by == 'index':
+            pos = frame
+        elif by in ['frame', 'time']:
+            col  = self._metaCounters if by == 'frame' else self._metaStamps
+            hits = numpy.flatnonzero(col >= (frame if by == 'frame' else frame * 1e9))
+            pos  = int(hits[0]) if len(hits) else len(col)
+        else:
+            raise ValueError(f"Invalid frame type {by}, must be 'index', 'frame' or 'time'")
+
+        # Metadata records written before the data record
+        count = int(numpy.searchsorted(self._metaPos, pos, side='right'))
+
+        # Going back in time, restart from the beginning
+        if count < self._metaApplied:
+            self._metaConfig  = {}
+            self._metaApplied = 0
+
+        for rec in self._metaIndex[self._metaApplied:count]:
+            data = self._parseMetaRecord(rec)
+            if data is not None:
+                dictUpdate(self._metaConfig, copy.deepcopy(data))
+
+        self._metaApplied = count
+        return self._metaConfig
+
+    def configValue(self, path, frame=None, by='index'):
+        """
+        Return a configuration value given its path, for example
+        'AMCc.SmurfProcessor.FileWriter.DataFile'. Returns None if the
+        path does not exist.
+
+        If frame is None, the value is taken from configDict, which
+        requires metaEnable. Otherwise the value at that frame is returned,
+        see configAt.
+        """
+        if frame is None:
+            obj = self._config
+        else:
+            obj = self._configAt(frame, by)
 
         if '.' in path:
             lst = path.split('.')
@@ -297,7 +1350,7 @@ class SmurfStreamReader(object):
             else:
                 return None
 
-        return obj
+        return copy.deepcopy(obj)
 
     def __enter__(self):
         return self
@@ -327,16 +1380,19 @@ def dictUpdate(old, new):
 def yamlUpdate(old, new):
     dictUpdate(old, yamlToData(new))
 
-def yamlToData(stream):
-    """Load yaml to data structure"""
+class PyrogueLoader(getattr(yaml, 'CLoader', yaml.Loader)):
+    """
+    Yaml loader which keeps the order of the mappings. Uses the libyaml
+    based loader when it is available.
+    """
+    pass
 
-    class PyrogueLoader(yaml.Loader):
-        pass
-
-    def construct_mapping(loader, node):
-        loader.flatten_mapping(node)
-        return odict(loader.construct_pairs(node))
+def _constructMapping(loader, node):
+    loader.flatten_mapping(node)
+    return odict(loader.construct_pairs(node))
 
-    PyrogueLoader.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,construct_mapping)
+PyrogueLoader.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, _constructMapping)
 
+def yamlToData(stream):
+    """Load yaml to data structure"""
     return yaml.load(stream, Loader=PyrogueLoader)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------
+# Title      : pysmurf util capture_cache module - CaptureCache class
+#-----------------------------------------------------------------------------
+# File       : pysmurf/util/capture_cache.py
+# Created    : 2026-10-18
+#-----------------------------------------------------------------------------
+# This file is part of the pysmurf software package. It is subject to
+# the license terms in the LICENSE.txt file found in the top-level directory
+# of this distribution and at:
+#    https://confluence.slac.stanford.edu/display/ppareg/LICENSE.html.
+# No part of the pysmurf software package, including this file, may be
+# copied, modified, propagated, or distributed except according to the terms
+# contained in the LICENSE.txt file.
+#-----------------------------------------------------------------------------
+import glob
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+class CaptureCache:
+    """
+    Disk cache of the arrays returned by slow hardware measurements.
+
+    Each entry is keyed on a hash of the measurement name and of the
+    hardware state it was taken in. The arrays are stored as .npy
+    files, which are memory mapped when read back, next to a json file
+    with the state and the time of the measurement. The json file is
+    written last, so only complete entries are ever read. When the
+    cache grows over max_bytes, the least recently used entries are
+    removed.
+
+    Args
+    ----
+    directory : str
+        The directory holding the cache files.
+    max_bytes : int, optional, default 2**30
+        The maximum total size of the cached arrays.
+    """
+    def __init__(self, directory, max_bytes=2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, name, state):
+        """
+        Returns the key of a measurement.
+
+        Args
+        ----
+        name : str
+            The name of the measurement.
+        state : dict
+            The hardware state and arguments of the measurement. Numpy
+            arrays and scalars are allowed.
+
+        Returns
+        -------
+        str
+            The key, the name followed by the state hash.
+        """
+        def _default(v):
+            if isinstance(v, (np.ndarray, np.generic)):
+                return v.tolist()
+            return str(v)
+
+        blob = json.dumps(state, sort_keys=True, default=_default)
+        return f'{name}_{hashlib.sha256(blob.encode()).hexdigest()[:32]}'
+
+    def _meta_file(self, key):
+        return os.path.join(self.directory, f'{key}.json')
+
+    def _array_file(self, key, i):
+        return os.path.join(self.directory, f'{key}_{i}.npy')
+
+    def get(self, key, max_age=None):
+        """
+        Returns the arrays of an entry.
+
+        Args
+        ----
+        key : str
+            The entry key.
+        max_age : float or None, optional, default None
+            The maximum age of the entry in seconds. Older entries are
+            removed. If None, entries do not expire.
+
+        Returns
+        -------
+        list of numpy.ndarray or None
+            The arrays, memory mapped copy on write, or None if there
+            is no valid entry.
+        """
+        meta_file = self._meta_file(key)
+        try:
+            with open(meta_file) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if max_age is not None and time.time() - meta['time'] > max_age:
+            self.remove(key)
+            return None
+
+        try:
+            arrays = [np.load(self._array_file(key, i), mmap_mode='c')
+                for i in range(meta['count'])]
+        except (OSError, ValueError):
+            self.remove(key)
+            return None
+
+        # Mark as recently used for the eviction
+        os.utime(meta_file)
+
+        return arrays
+
+    def put(self, key, arrays, state=None):
+        """
+        Stores the arrays of an entry, then evicts old entries if the
+        cache is too large.
+
+        Args
+        ----
+        key : str
+            The entry key.
+        arrays : list of array
+            The arrays to store.
+        state : dict or None, optional, default None
+            The state the key was made from, stored for reference.
+        """
+        for i, a in enumerate(arrays):
+            tmp = self._array_file(key, i) + '.tmp'
+            with open(tmp, 'wb') as f:
+                np.save(f, np.asarray(a))
+            os.replace(tmp, self._array_file(key, i))
+
+        meta = {'time': time.time(), 'count': len(arrays)}
+        if state is not None:
+            meta['state'] = json.loads(json.dumps(state,
+                default=lambda v: v.tolist() if hasattr(v, 'tolist') else str(v)))
+
+        tmp = self._meta_file(key) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, self._meta_file(key))
+
+        self.evict()
+
+    def remove(self, key):
+        """
+        Removes an entry.
+
+        Args
+        ----
+        key : str
+            The entry key.
+        """
+        for fn in [self._meta_file(key)] + \
+                glob.glob(os.path.join(self.directory, f'{key}_*.npy')):
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is
+        under max_bytes.
+        """
+        entries = []
+        total = 0
+        for meta_file in glob.glob(os.path.join(self.directory, '*.json')):
+            key = os.path.basename(meta_file)[:-len('.json')]
+            try:
+                size = sum(os.path.getsize(fn) for fn in
+                    glob.glob(os.path.join(self.directory, f'{key}_*.npy')))
+                entries.append((os.path.getmtime(meta_file), size, key))
+            except OSError:
+                continue
+            total += size
+
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.remove(key)
+            total -= size
+
+    def clear(self):
+        """
+        Removes all the entries.
+        """
+        for meta_file in glob.glob(os.path.join(self.directory, '*.json')):
+            self.remove(os.path.basename(meta_file)[:-len('.json')])
@@ -13,11 +13,13 @@
 # copied, modified, propagated, or distributed except according to the terms
 # contained in the LICENSE.txt file.
 #-----------------------------------------------------------------------------
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 import glob
 import os
 import threading
 import time
+import weakref
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -25,9 +27,37 @@ from scipy import signal
 
 from pysmurf.client.base import SmurfBase
 from pysmurf.client.command.sync_group import SyncGroup as SyncGroup
+from pysmurf.client.util.capture_cache import CaptureCache
+from pysmurf.client.util.SmurfFileExporter import readExported
+from pysmurf.client.util.SmurfFileExporter import SmurfStreamExporter
+from pysmurf.client.util.SmurfFileReader import dataFileParts
+from pysmurf.client.util.SmurfFileReader import decodeSmurfHeaders
+from pysmurf.client.util.SmurfFileReader import fillFrameGaps
+from pysmurf.client.util.SmurfFileReader import frameStatistics
+from pysmurf.client.util.SmurfFileReader import SmurfHeaderTuple
 from pysmurf.client.util.SmurfFileReader import SmurfStreamReader
 from pysmurf.client.util.pub import set_action
 
+try:
+    import epics
+except ModuleNotFoundError:
+    print("smurf_util.py - epics not found.")
+
+# Frame of the legacy GCP mode data files, struct '3BxI6Q8I5Q528i'
+_gcp_frame_dtype = np.dtype([
+    ('protocol_version', 'u1'), ('crate_id', 'u1'), ('slot_number', 'u1'),
+    ('pad', 'u1'), ('number_of_channels', '<u4'),
+    ('rtm_dac_config0', '<u8'), ('rtm_dac_config1', '<u8'),
+    ('rtm_dac_config2', '<u8'), ('rtm_dac_config3', '<u8'),
+    ('rtm_dac_config4', '<u8'), ('rtm_dac_config5', '<u8'),
+    ('flux_ramp_increment', '<u4'), ('flux_ramp_start', '<u4'),
+    ('rate_since_1Hz', '<u4'), ('rate_since_TM', '<u4'),
+    ('nanoseconds', '<u4'), ('seconds', '<u4'),
+    ('fixed_rate_marker', '<u4'), ('sequence_counter', '<u4'),
+    ('tes_relay_config', '<u8'), ('mce_word', '<u8'),
+    ('user_word0', '<u8'), ('user_word1', '<u8'), ('user_word2', '<u8'),
+    ('data', '<i4', (528,))])
+
 class SmurfUtilMixin(SmurfBase):
 
     @set_action()
@@ -67,6 +97,207 @@ class SmurfUtilMixin(SmurfBase):
             The sync count.
 
         """
+        # The StreamDataWriter is shared with take_debug_data_async
+        with self._debug_data_lock:
+            data_filename, single_channel_readout = self._setup_debug_data(
+                band, channel=channel, nsamp=nsamp, filename=filename,
+                IQstream=IQstream, single_channel_readout=single_channel_readout,
+                debug=debug, rf_iq=rf_iq, write_log=write_log)
+
+            bay=self.band_to_bay(band)
+            self.set_trigger_daq(bay, 1, write_log=True) # this seems to = TriggerDM
+
+            time.sleep(.1) # maybe unnecessary
+
+            done=False
+            while not done:
+                done=True
+                for k in range(2):
+                    # see pysmurf issue 161.  This call is no longer used,
+                    # and causes take_debug_data to crash if
+                    # get_waveform_wr_addr is called before the
+                    # acquisition completes.
+                    #wr_addr = self.get_waveform_wr_addr(bay, engine=0)
+                    empty = self.get_waveform_empty(bay, engine=k)
+                    if not empty:
+                        done=False
+                time.sleep(1)
+
+            time.sleep(.25) # do we need all of these?
+
+            # Close the streamdatawriter
+            self.set_streamdatawriter_close(True)
+
+        self.log('Done taking data', self.LOG_USER)
+
+        if rf_iq:
+            self.set_rf_iq_stream_enable(band, 0)
+
+        return self._decode_debug_data(data_filename, single_channel_readout)
+
+    @set_action()
+    def take_debug_data_async(self, band, channel=None, nsamp=2**19,
+            filename=None, IQstream=1, single_channel_readout=1,
+            debug=False, rf_iq=False, write_log=True, timeout=60.,
+            close_delay=.25):
+        """Starts taking raw debugging data and returns without waiting
+        for the acquisition.
+
+        The end of the acquisition is detected with monitors on the
+        waveform engine Empty PVs instead of polling them every
+        second. The data file is then closed and decoded in a
+        background thread. The StreamDataWriter writes one file at a
+        time, so a new call waits until the previous acquisition has
+        closed its file, but not for it to be decoded. Captures on
+        several bands can be started back to back, and the decoding of
+        one overlaps with the acquisition of the next.
+
+        Args
+        ----
+        band : int
+            The band to take data on.
+        channel : int or None, optional, default None
+            The channel to take debug data on in single_channel_mode.
+        nsamp : int, optional, default 2**19
+            The number of samples to take.
+        filename : str or None, optional, default None
+            The name of the file to save to.
+        IQstream : int, optional, default 1
+            Whether to take the raw IQ stream.
+        single_channel_readout : int, optional, default 1
+            Whether to look at one channel.
+        debug : bool, optional, default False
+            Whether to take data in debug mode.
+        rf_iq : bool, optional, default False
+            Return the RF IQ. Must provide channel.
+        write_log : bool, optional, default True
+            Whether to write low-level commands to the log file.
+        timeout : float, optional, default 60.
+            The maximum time in seconds to wait for the acquisition.
+        close_delay : float, optional, default 0.25
+            Time in seconds to wait between the end of the acquisition
+            and closing the data file.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Future which resolves to the (f, df, sync) tuple returned
+            by take_debug_data.
+        """
+        bay = self.band_to_bay(band)
+        pvs = [self.waveform_engine_buffers_root.format(bay) +
+               self._empty_reg.format(k) for k in range(2)]
+
+        def _release():
+            # Close the file and restore the readout, even if the
+            # acquisition failed
+            try:
+                self.set_streamdatawriter_close(True)
+                if rf_iq:
+                    self.set_rf_iq_stream_enable(band, 0)
+            finally:
+                self._debug_data_lock.release()
+
+        def _disconnect():
+            for m in monitors:
+                m.clear_callbacks()
+                m.disconnect()
+
+        def _finish():
+            epics.ca.use_initial_context()
+
+            try:
+                # The engines report empty until the trigger takes
+                # effect
+                time.sleep(max(0, t_trigger + .1 - time.time()))
+
+                while True:
+                    updated.clear()
+                    if all(empty.get(pv, False) for pv in pvs):
+                        break
+
+                    if time.time() - t_trigger > timeout:
+                        raise TimeoutError('Timeout waiting for the ' +
+                            f'debug data acquisition on bay {bay}')
+
+                    # Read the registers if there is no monitor update
+                    if not updated.wait(.5):
+                        for k, pv in enumerate(pvs):
+                            empty[pv] = bool(self.get_waveform_empty(bay,
+                                engine=k))
+
+                time.sleep(close_delay)
+
+            finally:
+                try:
+                    _disconnect()
+                finally:
+                    _release()
+
+            self.log(f'Done taking data for {data_filename}', self.LOG_USER)
+
+            return self._decode_debug_data(data_filename,
+                single_channel_readout)
+
+        monitors = []
+        self._debug_data_lock.acquire()
+        try:
+            data_filename, single_channel_readout = self._setup_debug_data(
+                band, channel=channel, nsamp=nsamp, filename=filename,
+                IQstream=IQstream,
+                single_channel_readout=single_channel_readout,
+                debug=debug, rf_iq=rf_iq, write_log=write_log)
+
+            # Monitor the Empty PVs before triggering, so no update
+            # is missed
+            empty = {}
+            updated = threading.Event()
+            connected = set()
+
+            def _empty_changed(pvname=None, value=None, **kwargs):
+                # The first callback is the value read on connection,
+                # which can predate the trigger
+                if pvname not in connected:
+                    connected.add(pvname)
+                    return
+                empty[pvname] = bool(value)
+                updated.set()
+
+            for pv in pvs:
+                monitors.append(epics.PV(pv, callback=_empty_changed,
+                    auto_monitor=True))
+
+            self.set_trigger_daq(bay, 1, write_log=True)
+            t_trigger = time.time()
+
+            if self._debug_data_executor is None:
+                # Stop the idle workers with the object or at exit
+                self._debug_data_executor = ThreadPoolExecutor(max_workers=4)
+                weakref.finalize(self, self._debug_data_executor.shutdown,
+                    wait=False)
+
+            return self._debug_data_executor.submit(_finish)
+
+        except BaseException:
+            try:
+                _disconnect()
+            finally:
+                _release()
+            raise
+
+    def _setup_debug_data(self, band, channel=None, nsamp=2**19,
+            filename=None, IQstream=1, single_channel_readout=1,
+            debug=False, rf_iq=False, write_log=True):
+        """Configures the readout and opens the StreamDataWriter file
+        for take_debug_data, ready for the trigger.
+
+        Returns
+        -------
+        data_filename : str
+            The full path of the data file.
+        single_channel_readout : int
+            The single channel readout mode, which rf_iq changes.
+        """
         # Set proper single channel readout
         if channel is not None:
             if rf_iq:
@@ -120,35 +351,11 @@ class SmurfUtilMixin(SmurfBase):
         #self.set_streamdatawriter_open('True') # str and not bool
         self.set_streamdatawriter_open(True)
 
-        bay=self.band_to_bay(band)
-        self.set_trigger_daq(bay, 1, write_log=True) # this seems to = TriggerDM
-
-        time.sleep(.1) # maybe unnecessary
-
-        done=False
-        while not done:
-            done=True
-            for k in range(2):
-                # see pysmurf issue 161.  This call is no longer used,
-                # and causes take_debug_data to crash if
-                # get_waveform_wr_addr is called before the
-                # acquisition completes.
-                #wr_addr = self.get_waveform_wr_addr(bay, engine=0)
-                empty = self.get_waveform_empty(bay, engine=k)
-                if not empty:
-                    done=False
-            time.sleep(1)
-
-        time.sleep(.25) # do we need all of these?
-
-        # Close the streamdatawriter
-        self.set_streamdatawriter_close(True)
-
-        self.log('Done taking data', self.LOG_USER)
-
-        if rf_iq:
-            self.set_rf_iq_stream_enable(band, 0)
+        return data_filename, single_channel_readout
 
+    def _decode_debug_data(self, data_filename, single_channel_readout):
+        """Decodes a take_debug_data file.
+        """
         if single_channel_readout > 0:
             f, df, sync = self.decode_single_channel(data_filename)
         else:
@@ -168,7 +375,8 @@ class SmurfUtilMixin(SmurfBase):
     @set_action()
     def estimate_phase_delay(self, band, nsamp=2**19, make_plot=True,
             show_plot=True, save_plot=True, save_data=True, n_scan=5,
-            timestamp=None, uc_att=None, dc_att=None, freq_min=-2.4E6, freq_max=2.4E6):
+            timestamp=None, uc_att=None, dc_att=None, freq_min=-2.4E6, freq_max=2.4E6,
+            use_cache=False):
         """Estimates total system latency for requested band.
 
         Measures the analog and digital (=processing) phase delay (or
@@ -228,6 +436,11 @@ class SmurfUtilMixin(SmurfBase):
         freq_max : float, optional, default 2.4E6
            Upper bound of the frequency interval used to estimate the
            phase delay, in Hz.  From the center of the 500 MHz band.
+        use_cache : bool, optional, default False
+           If this band was already measured in this session with the
+           same attenuators, firmware and arguments, and the FPGA was
+           not reprogrammed since, sets the registers to the previous
+           estimate instead of measuring again.
 
         Returns
         -------
@@ -258,9 +471,23 @@ class SmurfUtilMixin(SmurfBase):
         uc_att0 = self.get_att_uc(band)
         dc_att0 = self.get_att_dc(band)
         if uc_att is None:
-            uc_att = self.get_att_uc(band)
+            uc_att = uc_att0
         if dc_att is None:
-            dc_att = self.get_att_dc(band)
+            dc_att = dc_att0
+
+        fw_abbrev_sha=self.get_fpga_git_hash_short()
+
+        cache_key = self._phase_delay_cache_key(band, uc_att, dc_att,
+            fw_abbrev_sha, nsamp, n_scan, freq_min, freq_max)
+        if use_cache and cache_key in self._phase_delay_cache:
+            ret = self._phase_delay_cache[cache_key]
+            self.log(f'Band {band} unchanged, using the previous phase ' +
+                     f'delay estimate : refPhaseDelay={ret[0]}, ' +
+                     f'refPhaseDelayFine={ret[1]}', self.LOG_USER)
+            self.set_ref_phase_delay(band, ret[0])
+            self.set_ref_phase_delay_fine(band, ret[1])
+            return ret
+
         self.set_att_uc(band, uc_att, write_log=True)
         self.set_att_dc(band, dc_att, write_log=True)
 
@@ -295,7 +522,6 @@ class SmurfUtilMixin(SmurfBase):
                 plt.ioff()
 
         bay=int(band/4)
-        fw_abbrev_sha=self.get_fpga_git_hash_short()
 
         self.band_off(band)
         self.flux_ramp_off()
@@ -307,7 +533,7 @@ class SmurfUtilMixin(SmurfBase):
 
         idx_cable = np.where( (freq_cable > freq_min) & (freq_cable < freq_max) )
 
-        cable_z = np.polyfit(freq_cable[idx_cable], np.unwrap(np.angle(resp_cable[idx_cable])), 1)
+        cable_z = self._phase_slope_fit(freq_cable[idx_cable], resp_cable[idx_cable])
         cable_p = np.poly1d(cable_z)
         cable_delay_us=np.abs(1.e6*cable_z[0]/2/np.pi)
 
@@ -350,7 +576,7 @@ class SmurfUtilMixin(SmurfBase):
         freq_dsp_subset=(freq_dsp_subset)*1.0E6
 
         # fit
-        dsp_z = np.polyfit(freq_dsp_subset, np.unwrap(np.angle(resp_dsp_subset)), 1)
+        dsp_z = self._phase_slope_fit(freq_dsp_subset, resp_dsp_subset)
         dsp_p = np.poly1d(dsp_z)
         dsp_delay_us=np.abs(1.e6*dsp_z[0]/2/np.pi)
 
@@ -407,7 +633,7 @@ class SmurfUtilMixin(SmurfBase):
         freq_dsp_corr_subset=(freq_dsp_corr_subset)*1.0E6
 
         # fit
-        dsp_corr_z = np.polyfit(freq_dsp_corr_subset, np.unwrap(np.angle(resp_dsp_corr_subset)), 1)
+        dsp_corr_z = self._phase_slope_fit(freq_dsp_corr_subset, resp_dsp_corr_subset)
         dsp_corr_delay_us=np.abs(1.e6*dsp_corr_z[0]/2/np.pi)
         #### done measuring total (DSP) delay with estimated correction applied
 
@@ -500,7 +726,99 @@ class SmurfUtilMixin(SmurfBase):
         self.set_att_uc(band, uc_att0, write_log=True)
         self.set_att_dc(band, dc_att0, write_log=True)
 
-        return refPhaseDelay, refPhaseDelayFine, processing_delay_us, dsp_corr_delay_us
+        ret = (refPhaseDelay, refPhaseDelayFine, processing_delay_us,
+               dsp_corr_delay_us)
+        self._phase_delay_cache[cache_key] = ret
+
+        return ret
+
+    @set_action()
+    def estimate_phase_delays(self, bands, nsamp=2**19, make_plot=False,
+            show_plot=False, save_plot=True, save_data=True, n_scan=5,
+            uc_att=None, dc_att=None, freq_min=-2.4E6, freq_max=2.4E6,
+            use_cache=True):
+        """Estimates the phase delay of several bands.
+
+        Runs :func:`estimate_phase_delay` on each band.  With
+        use_cache, bands already measured in this session with the
+        same attenuators, firmware and arguments, and not reprogrammed
+        since, are not measured again.
+
+        Args
+        ----
+        bands : list of int
+           The bands to estimate the phase delay on.
+        nsamp : int, optional, default 2**19
+           The number of samples to take.
+        make_plot : bool, optional, default False
+           Whether or not to make plots.
+        show_plot : bool, optional, default False
+           Whether or not to show plots.
+        save_plot : bool, optional, default True
+           Whether or not to save plot to file.
+        save_data : bool, optional, default True
+           Whether or not to save data to file.
+        n_scan : int, optional, default 5
+           Number of scans to do to estimate analog phase delay.
+        uc_att : int or None, optional, default None
+           UC attenuator setting to use during measurements.  If None,
+           uses currently programmed setting of each band.
+        dc_att : int or None, optional, default None
+           DC attenuator setting to use during measurements.  If None,
+           uses currently programmed setting of each band.
+        freq_min : float, optional, default -2.4E6
+           Lower bound of the frequency interval used to estimate the
+           phase delay, in Hz.
+        freq_max : float, optional, default 2.4E6
+           Upper bound of the frequency interval used to estimate the
+           phase delay, in Hz.
+        use_cache : bool, optional, default True
+           Whether to skip the bands which are unchanged since their
+           last estimate.
+
+        Returns
+        -------
+        dict
+           The (refPhaseDelay, refPhaseDelayFine, processing_delay_us,
+           dsp_corr_delay_us) tuple of each band.
+        """
+        ret = {}
+        for band in bands:
+            ret[band] = self.estimate_phase_delay(band, nsamp=nsamp,
+                make_plot=make_plot, show_plot=show_plot,
+                save_plot=save_plot, save_data=save_data, n_scan=n_scan,
+                uc_att=uc_att, dc_att=dc_att, freq_min=freq_min,
+                freq_max=freq_max, use_cache=use_cache)
+
+        return ret
+
+    def _phase_delay_cache_key(self, band, uc_att, dc_att, fw_abbrev_sha,
+            nsamp, n_scan, freq_min, freq_max):
+        """Returns the key of a band in the estimate_phase_delay cache.
+
+        The key includes the hardware cache generation, which changes
+        when the FPGA is reprogrammed, see get_hardware_constants.
+        """
+        generation = self.get_hardware_constants(band)['generation']
+        return (self.epics_root, band, uc_att, dc_att, fw_abbrev_sha,
+                generation, nsamp, n_scan, freq_min, freq_max)
+
+    def _phase_slope_fit(self, freq, resp):
+        """Fits a line to the unwrapped phase of a response.
+
+        Args
+        ----
+        freq : float array
+           The frequencies.
+        resp : complex array
+           The complex response.
+
+        Returns
+        -------
+        float array
+           The slope and offset, as returned by numpy.polyfit.
+        """
+        return np.polyfit(freq, np.unwrap(np.angle(resp)), 1)
 
     def process_data(self, filename, dtype=np.uint32):
         """ Reads a file taken with take_debug_data and processes it into data
@@ -523,20 +841,24 @@ class SmurfUtilMixin(SmurfBase):
         n_chan = 2 # number of stream channels
         #header_size = 4 # 8 bytes in 16-bit word
 
-        rawdata = np.fromfile(filename, dtype='<u4').astype(dtype)
+        # Memory map the file, copy on write so the returned arrays
+        # stay writable without touching the file
+        rawdata = np.memmap(filename, dtype='<u4', mode='c')
 
         # -1 is equiv to [] in Matlab
         rawdata = np.transpose(np.reshape(rawdata, (n_chan, -1)))
 
         if dtype==np.uint32:
+            # Views, the header rows are sliced off instead of deleted
             header = rawdata[:2, :]
-            data = np.delete(rawdata, (0,1), 0).astype(dtype)
+            data = rawdata[2:, :]
         elif dtype==np.int32:
             header = np.zeros((2,2))
             header[:,0] = rawdata[:2,0].astype(np.uint32)
             header[:,1] = rawdata[:2,1].astype(np.uint32)
-            data = np.double(np.delete(rawdata, (0,1), 0))
+            data = np.double(rawdata[2:, :].astype(dtype))
         elif dtype==np.int16:
+            rawdata = rawdata.astype(dtype)
             header1 = np.zeros((4,2))
             header1[:,0] = rawdata[:4,0].astype(np.uint16)
             header1[:,1] = rawdata[:4,1].astype(np.uint16)
@@ -581,99 +903,149 @@ class SmurfUtilMixin(SmurfBase):
         flux_ramp_strobe : numpy.ndarray
             The synchronizing pulse.
         """
-        n_proc = self.get_number_processed_channels()
-        n_chan = self.get_number_channels()
+        # The channel layout of the data must match the firmware, so
+        # check for a reprogram now rather than on the usual interval
+        hw = self.get_hardware_constants(recheck=True)
+        n_proc = hw['n_processed_channels']
+        n_chan = hw['n_channels']
+        subband_half_width_mhz = hw['subband_half_width_mhz']
 
-        n_subbands = self.get_number_sub_bands()
-        digitizer_frequency_mhz = self.get_digitizer_frequency_mhz()
-        subband_half_width_mhz = (digitizer_frequency_mhz / n_subbands)
+        if recast and hw['processed_channels'] is None:
+            raise ValueError('The processed channels are not known in ' +
+                'offline mode, decode_data needs recast=False.')
 
         header, rawdata = self.process_data(filename)
 
-        # decode strobes
-        strobes = np.floor(rawdata / (2**30))
-        data = 0x00FFFFFF & rawdata
-        ch0_strobe = np.remainder(strobes, 2)
-        flux_ramp_strobe = np.floor((strobes - ch0_strobe) / 2)
+        # decode strobes. Bit 30 marks channel 0 and bit 31 is the flux
+        # ramp strobe, the frequencies are signed 24 bit integers.
+        flux_ramp_strobe = (rawdata >> 31).astype(np.int8)
 
         # decode frequencies
-        ch0_idx = np.where(ch0_strobe[:,0] == 1)[0]
-        f_first = ch0_idx[0]
-        f_last = ch0_idx[-1]
-
-        freqs = data[f_first:f_last, 0]
-        neg = np.where(freqs >= 2**23)[0]
-        f = np.double(freqs)
-        if len(neg) > 0:
-            f[neg] = f[neg] - 2**24
-
-        if np.remainder(len(f), n_proc)!=0:
-            if truncate:
-                self.log(f'Number of points in f not a multiple of {n_proc}.' +
-                    f' Truncating f to the nearest multiple of {n_proc}.',
-                    self.LOG_USER)
-                f=f[:(len(f)-np.remainder(len(f),n_proc))]
-            else:
-                self.log(f'Number of points in f not a multiple of {n_proc}.'+
-                    ' Cannot decode', self.LOG_ERROR)
-        f = np.reshape(f, (-1, n_proc)) * subband_half_width_mhz / 2**23
+        f = self._decode_debug_stream(rawdata[:, 0], n_proc, truncate, 'f')
 
         # frequency errors
-        ch0_idx_df = np.where(ch0_strobe[:,1] == 1)[0]
-        if len(ch0_idx_df) > 0:
-            d_first = ch0_idx_df[0]
-            d_last = ch0_idx_df[-1]
-            dfreq = data[d_first:d_last, 1]
-            neg = np.where(dfreq >= 2**23)[0]
-            df = np.double(dfreq)
-            if len(neg) > 0:
-                df[neg] = df[neg] - 2**24
-
-            if np.remainder(len(df), n_proc)!=0:
-                if truncate:
-                    self.log('Number of points in df not a multiple of '+
-                        f'{n_proc}. Truncating df to the nearest multiple ' +
-                        f' of {n_proc}.', self.LOG_USER)
-                    df=df[:(len(df)-np.remainder(len(df),n_proc))]
-                else:
-                    self.log(f'Number of points in df not a multiple of {n_proc}.' +
-                        'Cannot decode', self.LOG_ERROR)
-            df = np.reshape(df, (-1, n_proc)) * subband_half_width_mhz / 2**23
+        df = self._decode_debug_stream(rawdata[:, 1], n_proc, truncate, 'df')
 
-        else:
-            df = []
+        scale = subband_half_width_mhz / 2**23
 
         if recast:
-            nsamp, nprocessed = np.shape(f)
-            nsamp_df, _ = np.shape(df)
-            if nsamp != nsamp_df:
+            nsamp = len(f)
+            if df is not None and len(df) != nsamp:
                 self.log('f and df are different sizes. Choosing the smaller'
                     ' value. Not sure why this is happening.')
-                nsamp = np.min([nsamp, nsamp_df])
+                nsamp = min(nsamp, len(df))
+
+            processed_ind = hw['processed_channels']
+            f = self._recast_debug_stream(f[:nsamp], processed_ind,
+                n_chan, scale)
+            if df is not None:
+                df = self._recast_debug_stream(df[:nsamp], processed_ind,
+                    n_chan, scale)
+        else:
+            f = f * scale
+            if df is not None:
+                df = df * scale
 
-            ftmp = np.zeros((nsamp, n_chan))
-            dftmp = np.zeros_like(ftmp)
+        if df is None:
+            df = []
 
-            processed_ind = self.get_processed_channels()
-            ftmp[:, processed_ind] = f[:nsamp]
-            dftmp[:, processed_ind] = df[:nsamp]
+        return f, df, flux_ramp_strobe
 
-            f = ftmp
-            df = dftmp
+    def _decode_debug_stream(self, stream, n_proc, truncate, name):
+        """
+        Decodes one stream of a take_debug_data file into signed
+        integers, starting at the first channel 0 strobe.
 
-        return f, df, flux_ramp_strobe
+        Args
+        ----
+        stream : numpy.ndarray
+            The uint32 words of the stream, as returned by
+            process_data.
+        n_proc : int
+            The number of processed channels.
+        truncate : bool
+            Truncates the data if the number of elements is not an
+            integer multiple of n_proc.
+        name : str
+            The name of the stream, for the log messages.
+
+        Returns
+        -------
+        numpy.ndarray or None
+            The (nsamp, n_proc) int32 array. None if the stream has
+            no channel 0 strobe.
+        """
+        ch0_idx = np.flatnonzero(stream & 0x40000000)
+        if len(ch0_idx) == 0:
+            return None
+
+        # Shift the 24 bit value to the top of the word and back, which
+        # sign extends it in a single temporary
+        data = (stream[ch0_idx[0]:ch0_idx[-1]] << 8).view(np.int32)
+        data >>= 8
+
+        if np.remainder(len(data), n_proc)!=0:
+            if truncate:
+                self.log(f'Number of points in {name} not a multiple of ' +
+                    f'{n_proc}. Truncating {name} to the nearest multiple ' +
+                    f'of {n_proc}.', self.LOG_USER)
+                data = data[:(len(data)-np.remainder(len(data),n_proc))]
+            else:
+                self.log(f'Number of points in {name} not a multiple of ' +
+                    f'{n_proc}. Cannot decode', self.LOG_ERROR)
+
+        return np.reshape(data, (-1, n_proc))
+
+    def _recast_debug_stream(self, data, processed_ind, n_chan, scale):
+        """
+        Scales decoded take_debug_data integers to MHz and places the
+        processed channels in an array of n_chan channels.
+
+        Args
+        ----
+        data : numpy.ndarray
+            The (nsamp, n_proc) int32 array from _decode_debug_stream.
+        processed_ind : numpy.ndarray
+            The channel of each column, from get_processed_channels.
+        n_chan : int
+            The total number of channels.
+        scale : float
+            The conversion from integer to MHz.
+
+        Returns
+        -------
+        numpy.ndarray
+            The (nsamp, n_chan) float array, zero for the channels which
+            are not processed.
+        """
+        out = np.zeros((len(data), n_chan))
+        out[:, processed_ind] = data
+        out *= scale
+        return out
 
     @set_action()
-    def decode_single_channel(self, filename, swapFdF=False):
+    def decode_single_channel(self, filename, swapFdF=False, decimation=1,
+            dtype=np.float64, chunk_size=2**20):
         """
         decode take_debug_data file if in singlechannel mode
 
+        The memory mapped file is decoded in chunks with integer
+        operations, so the only full size arrays are the outputs.
+
         Args
         ----
         filename : str
             Path to file to decode.
         swapFdF : bool, optional, default False
             Whether to swap f and df streams.
+        decimation : int, optional, default 1
+            Averages blocks of this many samples into each output
+            sample. The samples after the last full block are dropped.
+        dtype : numpy.dtype, optional, default numpy.float64
+            The data type of f and df. numpy.float32 halves the memory
+            of long captures.
+        chunk_size : int, optional, default 2**20
+            The number of samples decoded at a time.
 
         Returns
         -------
@@ -682,9 +1054,9 @@ class SmurfUtilMixin(SmurfBase):
             [I, Q, sync] if iq_stream_enable = True
         """
 
-        n_subbands = self.get_number_sub_bands()
-        digitizer_frequency_mhz = self.get_digitizer_frequency_mhz()
-        subband_half_width_mhz = (digitizer_frequency_mhz / n_subbands)
+        subband_half_width_mhz = \
+            self.get_hardware_constants()['subband_half_width_mhz']
+        scale = subband_half_width_mhz / 2**23
 
         if swapFdF:
             nF = 1
@@ -695,28 +1067,46 @@ class SmurfUtilMixin(SmurfBase):
 
         header, rawdata = self.process_data(filename)
 
-        # decode strobes
-        strobes = np.floor(rawdata / (2**30))
-        data = rawdata - (2**30)*strobes
-        ch0_strobe = np.remainder(strobes, 2)
-        flux_ramp_strobe = np.floor((strobes - ch0_strobe) / 2)
-
-        # decode frequencies
-        freqs = data[:,nF]
-        neg = np.where(freqs >= 2**23)[0]
-        f = np.double(freqs)
-        if len(neg) > 0:
-            f[neg] = f[neg] - 2**24
-
-        f = np.transpose(f) * subband_half_width_mhz / 2**23
+        decimation = int(decimation)
+        n_samp = len(rawdata) // decimation * decimation
+        n_out = n_samp // decimation
+
+        f = np.empty(n_out, dtype=dtype)
+        df = np.empty(n_out, dtype=dtype)
+        flux_ramp_strobe = np.empty((n_out, 2), dtype=np.int8)
+
+        # Scratch buffers, reused for every chunk
+        chunk = max(int(chunk_size) // decimation, 1) * decimation
+        buf = np.empty(chunk, dtype=np.uint32)
+        val = buf.view(np.int32)
+
+        for start in range(0, n_samp, chunk):
+            stop = min(start + chunk, n_samp)
+            n = stop - start
+            out = slice(start // decimation, stop // decimation)
+
+            for k, dest in [(nF, f), (nDF, df)]:
+                # Each stream is contiguous in the file
+                words = rawdata[start:stop, k]
+
+                # decode strobes, the flux ramp strobe is bit 31
+                np.right_shift(words, 31, out=buf[:n])
+                if decimation > 1:
+                    flux_ramp_strobe[out, k] = \
+                        buf[:n].reshape(-1, decimation).max(axis=1)
+                else:
+                    flux_ramp_strobe[out, k] = buf[:n]
 
-        dfreqs = data[:,nDF]
-        neg = np.where(dfreqs >= 2**23)[0]
-        df = np.double(dfreqs)
-        if len(neg) > 0:
-            df[neg] = df[neg] - 2**24
+                # decode frequencies, sign extending the 24 bit values
+                np.left_shift(words, 8, out=buf[:n])
+                val[:n] >>= 8
+                if decimation > 1:
+                    dest[out] = val[:n].reshape(-1, decimation).mean(axis=1)
+                else:
+                    dest[out] = val[:n]
 
-        df = np.transpose(df) * subband_half_width_mhz / 2**23
+        f *= scale
+        df *= scale
 
         return f, df, flux_ramp_strobe
 
@@ -1013,13 +1403,19 @@ class SmurfUtilMixin(SmurfBase):
                          return_header=False,
                          return_tes_bias=False, write_log=True,
                          n_max=2048, make_freq_mask=False,
-                         gcp_mode=False):
+                         gcp_mode=False, start=None, stop=None,
+                         range_type='index', fill_gaps=False,
+                         use_index=False):
         """
         Loads data taken with the function stream_data_on.
         Gives back the resonator data in units of phase. Also
         can optionally return the header (which has things
         like the TES bias).
 
+        Only the requested channels and samples are read from the
+        file, so loading a few channels or a short time range out of a
+        large file is cheap.
+
         Args
         ----
         datafile : str
@@ -1040,12 +1436,30 @@ class SmurfUtilMixin(SmurfBase):
         write_log : bool, optional, default True
             Whether to write outputs to the log file.
         n_max : int, optional, default 2048
-            The number of elements to read in before appending the
-            datafile. This is just for speed.
+            Unused. Kept for backwards compatibility.
         make_freq_mask : bool, optional, default False
             Whether to write a text file with resonator frequencies.
         gcp_mode (bool) : Indicates that the data was written in GCP mode. This
             is the legacy data mode which was depracatetd in Rogue 4.
+        start : int, float or None, optional, default None
+            The first sample to read, in units given by range_type. If
+            None, reads from the beginning of the file.
+        stop : int, float or None, optional, default None
+            Read up to this sample (not included), in units given by
+            range_type. If None, reads to the end of the file.
+        range_type : str, optional, default 'index'
+            The units of start and stop. 'index' is the sample number
+            in the file, 'frame' is the header frame counter and 'time'
+            is the header timestamp as a ctime in seconds.
+        fill_gaps : bool, optional, default False
+            Whether to return the data on a uniform frame counter grid,
+            sorted and with the lost frames set to NaN. The timestamps
+            of the lost frames are interpolated. The header and TES
+            bias only hold the frames found in the file.
+        use_index : bool, optional, default False
+            Whether to keep the index of the file records in a hidden
+            sidecar file next to the data file, so later reads of the
+            same file do not scan it again.
 
         Ret:
         ----
@@ -1070,101 +1484,53 @@ class SmurfUtilMixin(SmurfBase):
         if channel is not None:
             self.log(f'Only reading channel {channel}')
 
-        # Flag to indicate we are about the read the fist frame from the disk
-        # The number of channel will be extracted from the first frame and the
-        # data structures will be build based on that
-        first_read = True
-        with SmurfStreamReader(datafile,
-                isRogue=True, metaEnable=True) as file:
-            for header, data in file.records():
-                if first_read:
-                    # Update flag, so that we don't do this code again
-                    first_read = False
-
-                    # Read in all used channels by default
-                    if channel is None:
-                        channel = np.arange(header.number_of_channels)
-
-                    channel = np.ravel(np.asarray(channel))
-                    n_chan = len(channel)
-
-                    # Indexes for input channels
-                    channel_mask = np.zeros(n_chan, dtype=int)
-                    for i, c in enumerate(channel):
-                        channel_mask[i] = c
-
-                    #initialize data structure
-                    phase=list()
-                    for _,_ in enumerate(channel):
-                        phase.append(list())
-                    for i,_ in enumerate(channel):
-                        phase[i].append(data[i])
-                    t = [header.timestamp]
-                    if return_header or return_tes_bias:
-                        tmp_tes_bias = np.array(header.tesBias)
-                        tes_bias = np.zeros((0,16))
-
-                    # Get header values if requested
-                    if return_header or return_tes_bias:
-                        tmp_header_dict = {}
-                        header_dict = {}
-                        for i, h in enumerate(header._fields):
-                            tmp_header_dict[h] = np.array(header[i])
-                            header_dict[h] = np.array([],
-                                                      dtype=type(header[i]))
-                        tmp_header_dict['tes_bias'] = np.array([header.tesBias])
-
-
-                    # Already loaded 1 element
-                    counter = 1
-                else:
-                    for i in range(n_chan):
-                        phase[i].append(data[i])
-                    t.append(header.timestamp)
-
-                    if return_header or return_tes_bias:
-                        for i, h in enumerate(header._fields):
-                            tmp_header_dict[h] = np.append(tmp_header_dict[h],
-                                                       header[i])
-                        tmp_tes_bias = np.vstack((tmp_tes_bias, header.tesBias))
-
-                    if counter % n_max == n_max - 1:
-                        if write_log:
-                            self.log(f'{counter+1} elements loaded')
-
-                        if return_header:
-                            for k in header_dict.keys():
-                                header_dict[k] = np.append(header_dict[k],
-                                                           tmp_header_dict[k])
-                                tmp_header_dict[k] = \
-                                    np.array([],
-                                             dtype=type(header_dict[k][0]))
-                            print(np.shape(tes_bias), np.shape(tmp_tes_bias))
-                            tes_bias = np.vstack((tes_bias, tmp_tes_bias))
-                            tmp_tes_bias = np.zeros((0, 16))
-
-                        elif return_tes_bias:
-                            tes_bias = np.vstack((tes_bias, tmp_tes_bias))
-                            tmp_tes_bias = np.zeros((0, 16))
-
-                    counter += 1
-
-        phase=np.array(phase)
-        t=np.array(t)
+        # The number of samples limits the stop index directly, for the
+        # other range types it is applied to the selected samples.
+        if nsamp is not None and range_type == 'index':
+            first = 0 if start is None else start
+            stop = first + nsamp if stop is None else min(stop, first + nsamp)
 
-        if return_header:
-            for k in header_dict.keys():
-                header_dict[k] = np.append(header_dict[k],
-                    tmp_header_dict[k])
-            tes_bias = np.vstack((tes_bias, tmp_tes_bias))
-            tes_bias = np.transpose(tes_bias)
+        with SmurfStreamReader(datafile, isRogue=True,
+                               useIndex=use_index) as file:
+            header, data = file.readAll(start=start, stop=stop,
+                                        by=range_type, channels=channel)
 
-        elif return_tes_bias:
-            tes_bias = np.vstack((tes_bias, tmp_tes_bias))
-            tes_bias = np.transpose(tes_bias)
+        if nsamp is not None and range_type != 'index':
+            header = header[:nsamp]
+            data = data[:nsamp]
+
+        if write_log:
+            self.log(f'{len(header)} elements loaded')
+
+        # Check the frame counters for dropped or out of order frames
+        stats = frameStatistics(header['frame_counter'])
+        if (stats['frameLossCnt'] > 0 or stats['frameOutOrderCnt'] > 0 or
+                stats['frameDuplicateCnt'] > 0):
+            self.log(f"{datafile} : {stats['frameLossCnt']} frames lost in " +
+                f"{len(stats['gapStart'])} gaps, " +
+                f"{stats['frameOutOrderCnt']} out of order frames, " +
+                f"{stats['frameDuplicateCnt']} duplicate frames.",
+                self.LOG_ERROR)
+
+        t = header['timestamp'].astype(np.int64)
+
+        if fill_gaps and len(t) > 0:
+            grid, data, valid = fillFrameGaps(header['frame_counter'], data)
+
+            # Interpolate relative to the first timestamp to keep the
+            # nanosecond resolution in float64
+            _, dt, _ = fillFrameGaps(header['frame_counter'], (t - t[0])[:, None])
+            t = t[0] + np.interp(grid, grid[valid], dt[valid, 0]).astype(np.int64)
+
+        # Only the selected channels and samples are copied
+        phase = np.array(data.T, dtype=float, order='C')
+
+        if return_header or return_tes_bias:
+            header_dict = self._stream_header_dict(decodeSmurfHeaders(header))
+            tes_bias = header_dict['tes_bias']
 
         # rotate and transform to phase
-        phase = phase.astype(float) / 2**15 * np.pi
+        phase *= np.pi / 2**15
 
         if np.size(phase) == 0:
             self.log("Only 1 element in datafile. This is often an indication" +
@@ -1184,13 +1550,136 @@ class SmurfUtilMixin(SmurfBase):
             phase.resize(array_size, phase.shape[1])
 
         if return_header:
-            header_dict['tes_bias'] = tes_bias
             return t, phase, mask, header_dict
         elif return_tes_bias:
             return t, phase, mask, tes_bias
         else:
             return t, phase, mask
 
+    @set_action()
+    def export_stream_data(self, datafile, outfile=None, file_format=None,
+                           chunk_frames=8192, write_log=True):
+        """
+        Converts data taken with stream_data_on to chunked, compressed
+        per-channel columns in an HDF5 or Zarr file, which can be read
+        with read_exported_stream_data. The channel mask is stored with
+        the data.
+
+        Exporting a file which is still being written, or which got
+        new roll over parts, only converts the new frames.
+
+        Args
+        ----
+        datafile : str
+            The full path to the data to export.
+        outfile : str or None, optional, default None
+            The output file. If None, the .dat extension of datafile is
+            replaced by .h5 (or .zarr if file_format is 'zarr').
+        file_format : str or None, optional, default None
+            Either 'hdf5' or 'zarr'. If None, it is guessed from the
+            extension of outfile.
+        chunk_frames : int, optional, default 8192
+            The number of frames in each chunk.
+        write_log : bool, optional, default True
+            Whether to write outputs to the log file.
+
+        Returns
+        -------
+        outfile : str
+            The path to the exported file.
+        """
+        files = dataFileParts(datafile)
+        if len(files) == 0:
+            raise FileNotFoundError(f'No data file found for {datafile}')
+
+        if outfile is None:
+            ext = '.zarr' if file_format == 'zarr' else '.h5'
+            outfile = datafile.split('.dat')[0] + ext
+
+        try:
+            mask = self.make_mask_lookup(datafile.split('.dat')[0] +
+                                         '_mask.txt')
+        except OSError:
+            self.log(f'No mask file found for {datafile}')
+            mask = None
+
+        exporter = SmurfStreamExporter(files, outfile, fileFormat=file_format,
+                                       chunkFrames=chunk_frames)
+        n_frames = exporter.export(mask=mask)
+
+        if write_log:
+            self.log(f'Exported {n_frames} new frames to {outfile}')
+
+        return outfile
+
+    @set_action()
+    def read_exported_stream_data(self, filename, channel=None, start=None,
+                                  stop=None, return_header=False):
+        """
+        Loads data converted with export_stream_data. Gives back the
+        same outputs as read_stream_data.
+
+        Args
+        ----
+        filename : str
+            The full path to the exported file.
+        channel : int or int array or None, optional, default None
+            Channels to load. Only the requested channels are read from
+            the file.
+        start : int or None, optional, default None
+            The first sample to read.
+        stop : int or None, optional, default None
+            Read up to this sample, not included.
+        return_header : bool, optional, default False
+            Whether to also return the header columns.
+
+        Returns
+        -------
+        t : numpy.ndarray
+            The timestamp data.
+        d : numpy.ndarray
+            The resonator data in units of radians.
+        m : numpy.ndarray or None
+            The mask that maps smurf num to gcp num.
+        h : dict
+            The header columns. Only returned if return_header is True.
+        """
+        header, data, mask = readExported(filename, channels=channel,
+                                          start=start, stop=stop)
+
+        t = header['timestamp'].astype(np.int64)
+        phase = np.array(data.T, dtype=float, order='C')
+        phase *= np.pi / 2**15
+
+        if return_header:
+            return t, phase, mask, self._stream_header_dict(header)
+        else:
+            return t, phase, mask
+
+    @staticmethod
+    def _stream_header_dict(header_columns):
+        """
+        Builds the header dictionary returned by read_stream_data from
+        the header columns decoded by decodeSmurfHeaders.
+
+        Args
+        ----
+        header_columns : dict
+            The decoded header columns.
+
+        Returns
+        -------
+        dict
+            One int64 array per SmurfHeader field, and the (16, n)
+            float array of TES bias values ('tes_bias').
+        """
+        header_dict = {k: np.asarray(header_columns[k]).astype(np.int64)
+            for k in SmurfHeaderTuple._fields}
+        header_dict['tes_bias'] = \
+            np.transpose(header_columns['tes_bias']).astype(float)
+
+        return header_dict
+
     @set_action()
     def read_stream_data_gcp_save(self, datafile, channel=None,
             unwrap=True, downsample=1, nsamp=None):
@@ -1209,9 +1698,10 @@ class SmurfUtilMixin(SmurfBase):
         unwrap : bool, optional, default True
             Whether to unwrap units of 2pi.
         downsample : int, optional, default 1
-            The amount to downsample.
+            The amount to downsample. Every downsample-th sample is
+            kept, after unwrapping.
         nsamp : int or None, optional, default None
-            The number of samples to read.
+            The number of samples to read, before downsampling.
 
         Returns
         -------
@@ -1222,7 +1712,6 @@ class SmurfUtilMixin(SmurfBase):
         m : numpy.ndarray
             The maskfile that maps smurf num to gcp num.
         """
-        import struct
         try:
             datafile = glob.glob(datafile+'*')[-1]
         except ValueError:
@@ -1233,21 +1722,6 @@ class SmurfUtilMixin(SmurfBase):
         if channel is not None:
             self.log(f'Only reading channel {channel}')
 
-
-        keys = ['protocol_version','crate_id','slot_number','number_of_channels',
-                'rtm_dac_config0', 'rtm_dac_config1', 'rtm_dac_config2',
-                'rtm_dac_config3', 'rtm_dac_config4', 'rtm_dac_config5',
-                'flux_ramp_increment','flux_ramp_start', 'rate_since_1Hz',
-                'rate_since_TM', 'nanoseconds', 'seconds', 'fixed_rate_marker',
-                'sequence_counter', 'tes_relay_config', 'mce_word',
-                'user_word0', 'user_word1', 'user_word2'
-                ]
-
-        data_keys = [f'data{i}' for i in range(528)]
-
-        keys.extend(data_keys)
-        keys_dict = dict(zip(keys, range(len(keys))))
-
         # Read in all channels by default
         if channel is None:
             n_channels = self.get_number_channels()
@@ -1255,57 +1729,46 @@ class SmurfUtilMixin(SmurfBase):
 
         channel = np.ravel(np.asarray(channel))
         n_chan = len(channel)
+        downsample = max(int(downsample), 1)
 
-        # Indices for input channels
-        channel_mask = np.zeros(n_chan, dtype=int)
-        for i, c in enumerate(channel):
-            channel_mask[i] = keys_dict[f'data{c}']
-
-        eval_n_samp = False
+        # The frames have a fixed size, map the whole file as an array
+        # of records. A partial frame at the end of the file is ignored.
+        n_frames = os.path.getsize(datafile) // _gcp_frame_dtype.itemsize
         if nsamp is not None:
-            eval_n_samp = True
-
-        # Make holder arrays for phase and timestamp
-        phase = np.zeros((n_chan,0))
-        timestamp2 = np.array([])
-        counter = 0
-        n = 20000  # Number of elements to load at a time
-        tmp_phase = np.zeros((n_chan, n))
-        tmp_timestamp2 = np.zeros(n)
-        with open(datafile, mode='rb') as file:
-            while True:
-                chunk = file.read(2240)  # Frame size is 2240
-                if not chunk:
-                    # If frame is incomplete - meaning end of file
-                    phase = np.hstack((phase, tmp_phase[:,:counter%n]))
-                    timestamp2 = np.append(timestamp2, tmp_timestamp2[:counter%n])
-                    break
-                elif eval_n_samp:
-                    if counter >= nsamp:
-                        phase = np.hstack((phase, tmp_phase[:,:counter%n]))
-                        timestamp2 = np.append(timestamp2,
-                                               tmp_timestamp2[:counter%n])
-                        break
-                frame = struct.Struct('3BxI6Q8I5Q528i').unpack(chunk)
-
-                # Extract detector data
-                for i, c in enumerate(channel_mask):
-                    tmp_phase[i,counter%n] = frame[c]
+            n_frames = min(n_frames, nsamp)
+        frames = np.memmap(datafile, dtype=_gcp_frame_dtype, mode='r',
+                           shape=(n_frames,)) if n_frames else \
+            np.zeros(0, dtype=_gcp_frame_dtype)
+
+        # Decode, unwrap and downsample one block of frames at a time, so
+        # only the output is held in memory. The blocks are a multiple of
+        # the downsampling factor so the kept samples are evenly spaced.
+        n = 20000 // downsample * downsample or downsample
+        n_out = -(-n_frames // downsample)
+        phase = np.empty((n_chan, n_out))
+        timestamp2 = np.empty(n_out)
+        last = None
+        for start in range(0, n_frames, n):
+            block = frames[start:start+n]
+            block_phase = block['data'][:, channel].T * (np.pi / 2**15)
+
+            if unwrap:
+                # Continue from the last unwrapped sample of the
+                # previous block
+                if last is not None:
+                    block_phase = np.unwrap(np.hstack((last, block_phase)),
+                                            axis=1)[:, 1:]
+                else:
+                    block_phase = np.unwrap(block_phase, axis=1)
+                last = block_phase[:, -1:]
 
-                # Timestamp data
-                tmp_timestamp2[counter%n] = frame[keys_dict['rtm_dac_config5']]
+            out = slice(start // downsample, -(-(start + len(block)) // downsample))
+            phase[:, out] = block_phase[:, ::downsample]
+            timestamp2[out] = block['rtm_dac_config5'][::downsample]
 
-                # Store the data in a useful array and reset tmp arrays
-                if counter % n == n - 1 :
-                    self.log(f'{counter+1} elements loaded')
-                    phase = np.hstack((phase, tmp_phase))
-                    timestamp2 = np.append(timestamp2, tmp_timestamp2)
-                    tmp_phase = np.zeros((n_chan, n))
-                    tmp_timestamp2 = np.zeros(n)
-                counter = counter + 1
+            self.log(f'{start + len(block)} elements loaded')
 
         phase = np.squeeze(phase)
-        phase = phase.astype(float) / 2**15 * np.pi # where is decimal?  Is it in rad?
 
         rootpath = os.path.dirname(datafile)
         filename = os.path.basename(datafile)
@@ -1453,32 +1916,231 @@ class SmurfUtilMixin(SmurfBase):
         write_log : bool, optional, default False
             Whether to write outputs to log.
         """
+        return self._read_stream_data_daq_bays([bay], hw_trigger=hw_trigger,
+            write_log=write_log, data_length=data_length)[bay]
+
+    def _read_stream_data_daq_bays(self, bays, hw_trigger=False,
+            write_log=False, data_length=None):
+        """
+        Triggers the DAQ of several bays at once and reads their
+        streams.
+
+        Args
+        ----
+        bays : list of int
+            The AMC bay numbers.
+        hw_trigger : bool, optional, default False
+            Whether to trigger the start of the acquistion with a
+            hardware trigger.
+        write_log : bool, optional, default False
+            Whether to write outputs to log.
+        data_length : int or None, optional, default None
+            The number of samples to read. If None, reads the whole
+            stream PVs.
+
+        Returns
+        -------
+        dict
+            The (stream0, stream1) tuple of each bay.
+        """
         # Ask mitch why this is what it is...
-        if bay == 0:
-            stream0 = self.epics_root + ":AMCc:Stream0"
-            stream1 = self.epics_root + ":AMCc:Stream1"
-        else:
-            stream0 = self.epics_root + ":AMCc:Stream2"
-            stream1 = self.epics_root + ":AMCc:Stream3"
+        streams = [2*bay + i for bay in bays for i in range(2)]
+        data = self.read_stream_pvs(streams, data_length=data_length,
+            hw_trigger=hw_trigger, write_log=write_log)
+
+        return {bay: (data[2*i], data[2*i + 1])
+                for i, bay in enumerate(bays)}
+
+    @set_action()
+    def read_stream_pvs(self, streams=None, data_length=None,
+            hw_trigger=False, out=None, write_log=False):
+        """
+        Triggers the DAQ and reads the DDR stream PVs, AMCc:Stream0
+        to AMCc:Stream3, as numpy arrays. Streams 0 and 1 hold the
+        two DAQ mux lanes of bay 0, streams 2 and 3 those of bay
+        1. The DAQ mux must be set up first, see setup_daq_mux.
+
+        The PVs are monitored by a SyncGroup which is kept between
+        calls, so only the first read of a set of streams waits for
+        the PVs to connect. This is much faster than writing the
+        data to a file with take_debug_data.
+
+        Args
+        ----
+        streams : list of int or None, optional, default None
+            The streams to read. If None, reads all four streams.
+        data_length : int or None, optional, default None
+            The number of points to read from each stream. If None,
+            reads the whole PVs.
+        hw_trigger : bool, optional, default False
+            Whether to trigger the start of the acquistion with a
+            hardware trigger.
+        out : numpy.ndarray or None, optional, default None
+            A (len(streams), data_length) array to write the data
+            to. Use to reuse the same buffer for repeated reads. If
+            None, a new array is returned.
+        write_log : bool, optional, default False
+            Whether to write outputs to log.
 
-        pvs = [stream0, stream1]
-        sg  = SyncGroup(pvs, skip_first=True)
+        Returns
+        -------
+        numpy.ndarray
+            The (len(streams), data_length) stream data.
+        """
+        if streams is None:
+            streams = range(4)
+        streams = [int(s) for s in np.ravel(streams)]
+
+        pvs = [f'{self.epics_root}:AMCc:Stream{s}' for s in streams]
+        key = (tuple(pvs), data_length)
+        if key not in self._stream_sync_groups:
+            sg = SyncGroup(pvs, skip_first=True, count=data_length)
+            for pv in sg.pvs:
+                pv.wait_for_connection(timeout=sg.timeout)
+            self._stream_sync_groups[key] = sg
+        sg = self._stream_sync_groups[key]
+        sg.clear()
 
         # trigger PV
-        if not hw_trigger:
-            self.set_trigger_daq(bay, 1, write_log=write_log)
-        else:
-            self.set_arm_hw_trigger(bay, 1, write_log=write_log)
+        for bay in sorted({s//2 for s in streams}):
+            if not hw_trigger:
+                self.set_trigger_daq(bay, 1, write_log=write_log)
+            else:
+                self.set_arm_hw_trigger(bay, 1, write_log=write_log)
 
         time.sleep(.1)
         sg.wait()
 
-        vals = sg.get_values()
+        vals = [np.asarray(v) for v in
+                map(sg.get_values().get, pvs)]
+
+        if out is None:
+            n = min(len(v) for v in vals)
+            out = np.empty((len(streams), n), dtype=vals[0].dtype)
+        for i, v in enumerate(vals):
+            out[i] = v[:out.shape[1]]
+
+        return out
+
+    @set_action()
+    def read_daq_data_batch(self, bands, converter='adc',
+            data_length=2**19, n_scan=1, hw_trigger=False,
+            save_data=False, timestamp=None, return_data=True):
+        """
+        Reads data directly off the ADCs or DACs of several bands.
+
+        Each bay has one DAQ mux, which captures one converter at a
+        time. The bands are taken in rounds, where the DAQ mux of each
+        bay is set up for one of its bands and all the bays are
+        triggered together. The data of a round are converted in the
+        background while the next round is taken.
+
+        Args
+        ----
+        bands : list of int
+            The bands.  Assumes the converter number is band%4.
+        converter : str, optional, default 'adc'
+            Either 'adc' or 'dac'.
+        data_length : int, optional, default 2**19
+            The number of samples.
+        n_scan : int, optional, default 1
+            The number of captures of each band.
+        hw_trigger : bool, optional, default False
+            Whether to use the hardware trigger. If False, uses an
+            internal trigger.
+        save_data : bool, optional, default False
+            Whether to save the raw data in time stamped files, one
+            per band. The scans are written to the files as they are
+            taken, with shape (n_scan, 2, data_length).
+        timestamp : int or None, optional, default None
+            ctime to timestamp the data with (if saved to file). If
+            None, it gets the time stamp right before acquiring data.
+        return_data : bool, optional, default True
+            Whether to return the data. If False with save_data, no
+            scan is kept in memory once written.
+
+        Returns
+        -------
+        dict
+            The complex data of each band, of length data_length if
+            n_scan is 1 and of shape (n_scan, data_length) otherwise.
+            The file names of the raw data if return_data is False.
+        """
+        if converter.lower() not in ['adc', 'dac']:
+            raise ValueError("converter must be 'adc' or 'dac'")
+
+        if timestamp is None:
+            timestamp = self.get_timestamp()
+
+        bands = [int(b) for b in np.ravel(bands)]
+
+        # One band per bay in each round
+        by_bay = {}
+        for band in bands:
+            by_bay.setdefault(self.band_to_bay(band), []).append(band)
+        rounds = [
+            {bay: b[i] for bay, b in by_bay.items() if i < len(b)}
+            for i in range(max(len(b) for b in by_bay.values()))]
+
+        ret = {}
+        files = {}
+        raw = {}
+
+        def _store(band, n, res):
+            if return_data:
+                ret[band][n] = res[1] + 1.j * res[0]
+            if save_data:
+                raw[band][n] = res
+
+        pending = []
+        with ThreadPoolExecutor() as pool:
+            for n in range(n_scan):
+                for r in rounds:
+                    for bay, band in r.items():
+                        self.setup_daq_mux(converter, band%4, data_length,
+                            band=band)
+
+                    res = self._read_stream_data_daq_bays(list(r),
+                        hw_trigger=hw_trigger, data_length=data_length)
+
+                    # The previous round was converted while this one
+                    # was taken. Keep at most two rounds in memory.
+                    for job in pending:
+                        job.result()
+                    pending = []
+
+                    for bay, band in r.items():
+                        if n == 0:
+                            if return_data:
+                                ret[band] = np.zeros((n_scan, data_length),
+                                    dtype=complex)
+                            if save_data:
+                                files[band] = os.path.join(self.output_dir,
+                                    f'{timestamp}_{converter}{band}.npy')
+                                raw[band] = np.lib.format.open_memmap(
+                                    files[band], mode='w+',
+                                    dtype=np.asarray(res[bay][0]).dtype,
+                                    shape=(n_scan, 2, data_length))
+                        pending.append(pool.submit(_store, band, n,
+                            res[bay]))
+
+            for job in pending:
+                job.result()
+
+        for band in raw:
+            raw[band].flush()
+            self.log(f'Saved raw {converter} data to {files[band]}',
+                self.LOG_USER)
+            self.pub.register_file(files[band], converter, format='npy')
+        raw.clear()
 
-        r0 = vals[pvs[0]]
-        r1 = vals[pvs[1]]
+        if not return_data:
+            return files
 
-        return r0, r1
+        if n_scan == 1:
+            ret = {band: d[0] for band, d in ret.items()}
+
+        return ret
 
     @set_action()
     def check_adc_saturation(self, band):
@@ -1592,7 +2254,8 @@ class SmurfUtilMixin(SmurfBase):
                 plt.ioff()
 
             import scipy.signal as signal
-            digitizer_frequency_mhz = self.get_digitizer_frequency_mhz()
+            digitizer_frequency_mhz = \
+                self.get_hardware_constants()['digitizer_frequency_mhz']
             f, p_adc = signal.welch(dat, fs=digitizer_frequency_mhz,
                 nperseg=data_length/2, return_onesided=False, detrend=False)
             f_plot = f
@@ -1696,7 +2359,8 @@ class SmurfUtilMixin(SmurfBase):
                 plt.ioff()
 
             import scipy.signal as signal
-            digitizer_frequency_mhz = self.get_digitizer_frequency_mhz()
+            digitizer_frequency_mhz = \
+                self.get_hardware_constants()['digitizer_frequency_mhz']
             f, p_dac = signal.welch(dat, fs=digitizer_frequency_mhz,
                 nperseg=data_length/2, return_onesided=False, detrend=False)
             f_plot = f
@@ -2388,13 +3052,219 @@ class SmurfUtilMixin(SmurfBase):
         ----
         channelorderfile : str or None, optional, default None
             Path to a file that contains one channel per line.
+
+        Returns
+        -------
+        processed_channels : int array or None
+            The processed channels, in increasing order. None in
+            offline mode, where the channel order is not known.
         """
+        if channel_orderfile is None:
+            processed_channels = \
+                self.get_hardware_constants()['processed_channels']
+            if processed_channels is None:
+                return None
+            return processed_channels.copy()
+
         n_proc = self.get_number_processed_channels()
         n_chan = self.get_number_channels()
         n_cut = (n_chan - n_proc)//2
         return np.sort(self.get_channel_order(
             channel_orderfile=channel_orderfile)[n_cut:-n_cut])
 
+    # Minimum time between checks of the FPGA uptime, in seconds
+    _hardware_cache_check_sec = 60.
+
+    # Allowed lag of the FPGA uptime behind the wall clock between two
+    # checks, in seconds
+    _hardware_cache_uptime_slack_sec = 5.
+
+    def get_hardware_constants(self, band=None, recheck=False):
+        """
+        Returns the firmware constants of a band, which are needed to
+        decode data.
+
+        The values are read once and cached for the session, so
+        decoding in a loop does not cost epics round trips. The cache
+        is dropped when the epics root changes, when the FPGA is
+        reprogrammed, and by clear_hardware_cache. A reprogram is
+        detected by the FPGA uptime counter falling behind the cached
+        uptime plus the wall time elapsed since it was read. The FPGA
+        uptime is checked at most every _hardware_cache_check_sec
+        seconds, unless recheck is True.
+
+        Args
+        ----
+        band : int or None, optional, default None
+            Which band. If None, assumes all bands are the same, as
+            the underlying get functions.
+        recheck : bool, optional, default False
+            Whether to check the FPGA uptime for a reprogram now,
+            instead of on the usual interval.
+
+        Returns
+        -------
+        dict
+            The number of channels ('n_channels'), of processed
+            channels ('n_processed_channels') and of subbands
+            ('n_subbands'), the digitizer frequency
+            ('digitizer_frequency_mhz'), the subband half width
+            ('subband_half_width_mhz'), the channel order
+            ('channel_order'), the processed channels
+            ('processed_channels') and the cache generation
+            ('generation'), which increases each time the cache is
+            dropped. The arrays must not be modified, and are None in
+            offline mode.
+        """
+        cache = self._hardware_cache
+        now = time.time()
+
+        if cache.get('epics_root') != self.epics_root:
+            self.clear_hardware_cache()
+        elif (recheck or
+                now - cache.get('checked', 0) > self._hardware_cache_check_sec):
+            uptime = self.get_fpga_uptime()
+            last_uptime = cache.get('uptime')
+            if (uptime is not None and last_uptime is not None and
+                    uptime < last_uptime + (now - cache['checked']) -
+                    self._hardware_cache_uptime_slack_sec):
+                self.log('FPGA was reprogrammed. Clearing hardware cache.',
+                    self.LOG_INFO)
+                self.clear_hardware_cache()
+            else:
+                cache['uptime'] = uptime
+                cache['checked'] = now
+
+        if band not in cache['values']:
+            n_chan = self.get_number_channels(band)
+            n_proc = self.get_number_processed_channels(band)
+            n_subbands = self.get_number_sub_bands(band)
+            digitizer_frequency_mhz = self.get_digitizer_frequency_mhz(band)
+            n_cut = (n_chan - n_proc)//2
+
+            # The channel order needs the firmware
+            if self.offline:
+                channel_order = None
+                processed_channels = None
+            else:
+                channel_order = self.get_channel_order(band)
+                processed_channels = np.sort(channel_order[n_cut:-n_cut])
+
+            cache['values'][band] = {
+                'n_channels' : n_chan,
+                'n_processed_channels' : n_proc,
+                'n_subbands' : n_subbands,
+                'digitizer_frequency_mhz' : digitizer_frequency_mhz,
+                'subband_half_width_mhz' : digitizer_frequency_mhz/n_subbands,
+                'channel_order' : channel_order,
+                'processed_channels' : processed_channels,
+                'generation' : cache['generation']
+            }
+
+        return cache['values'][band]
+
+    def clear_hardware_cache(self):
+        """
+        Clears the firmware constants cached by get_hardware_constants.
+        Called by set_defaults_pv, call after changing the firmware
+        outside of this session.
+        """
+        generation = self._hardware_cache.get('generation', 0) + 1
+        self._hardware_cache.clear()
+        self._hardware_cache['generation'] = generation
+        self._hardware_cache['epics_root'] = self.epics_root
+        self._hardware_cache['values'] = {}
+        self._hardware_cache['uptime'] = self.get_fpga_uptime()
+        self._hardware_cache['checked'] = time.time()
+
+    def enable_capture_cache(self, max_age=3600., max_bytes=2**30,
+            directory=None):
+        """
+        Enables the cache of the slow sweeps of full_band_resp,
+        find_freq and eta_scan. A sweep is only taken again if the
+        attenuators, band center, firmware or sweep arguments changed
+        or if the cached sweep is older than max_age. Pass
+        force_refresh=True to these functions to ignore the cache.
+
+        Args
+        ----
+        max_age : float, optional, default 3600.
+            The maximum age of a cached sweep in seconds.
+        max_bytes : int, optional, default 2**30
+            The maximum size of the cache on disk. The least recently
+            used sweeps are removed first.
+        directory : str or None, optional, default None
+            The cache directory. If None, uses capture_cache in the
+            output directory.
+        """
+        if directory is None:
+            directory = os.path.join(self.output_dir, 'capture_cache')
+        self._capture_cache = CaptureCache(directory, max_bytes=max_bytes)
+        self._capture_cache_max_age = max_age
+        self.log(f'Capture cache enabled in {directory}', self.LOG_USER)
+
+    def disable_capture_cache(self, clear=False):
+        """
+        Disables the sweep cache set up by enable_capture_cache.
+
+        Args
+        ----
+        clear : bool, optional, default False
+            Whether to also remove the cached sweeps from disk.
+        """
+        if self._capture_cache is not None and clear:
+            self._capture_cache.clear()
+        self._capture_cache = None
+
+    def _cached_capture(self, name, band, params, capture,
+            force_refresh=False):
+        """
+        Returns the arrays of a sweep from the capture cache, or takes
+        the sweep and caches it.
+
+        Args
+        ----
+        name : str
+            The sweep name.
+        band : int
+            The band of the sweep.
+        params : dict
+            The sweep arguments which change its result.
+        capture : callable
+            Takes the sweep, returns a tuple of arrays.
+        force_refresh : bool, optional, default False
+            Whether to take the sweep even if it is cached. The new
+            sweep replaces the cached one.
+
+        Returns
+        -------
+        tuple
+            The arrays returned by capture.
+        """
+        if self._capture_cache is None:
+            return capture()
+
+        # The hardware state the sweep depends on
+        state = dict(params)
+        state.update(epics_root=self.epics_root, band=int(band),
+            att_uc=self.get_att_uc(band), att_dc=self.get_att_dc(band),
+            band_center_mhz=self.get_band_center_mhz(band),
+            fw_sha=self.get_fpga_git_hash_short())
+        key = self._capture_cache.key(name, state)
+
+        if not force_refresh:
+            arrays = self._capture_cache.get(key,
+                max_age=self._capture_cache_max_age)
+            if arrays is not None:
+                self.log(f'{name} band {band}: using cached sweep {key}',
+                    self.LOG_USER)
+                return tuple(arrays)
+
+        arrays = capture()
+        self._capture_cache.put(key, arrays, state=state)
+
+        return arrays
+
     def get_subband_from_channel(self, band, channel, channelorderfile=None,
             yml=None):
         """Returns subband number given a channel number
@@ -2414,8 +3284,13 @@ class SmurfUtilMixin(SmurfBase):
             The subband the channel lives in.
         """
 
-        n_subbands = self.get_number_sub_bands(band, yml=yml)
-        n_channels = self.get_number_channels(band, yml=yml)
+        if yml is None:
+            hw = self.get_hardware_constants(band)
+            n_subbands = hw['n_subbands']
+            n_channels = hw['n_channels']
+        else:
+            n_subbands = self.get_number_sub_bands(band, yml=yml)
+            n_channels = self.get_number_channels(band, yml=yml)
 
         n_chanpersubband = n_channels / n_subbands
 
@@ -2425,7 +3300,10 @@ class SmurfUtilMixin(SmurfBase):
         if channel < 0:
             raise ValueError('channel number is less than zero!')
 
-        chanOrder = self.get_channel_order(band,channelorderfile)
+        if channelorderfile is None:
+            chanOrder = self.get_hardware_constants(band)['channel_order']
+        else:
+            chanOrder = self.get_channel_order(band,channelorderfile)
         idx = np.where(chanOrder == channel)[0]
 
         subband = idx // n_chanpersubband
@@ -2448,6 +3326,10 @@ class SmurfUtilMixin(SmurfBase):
             #bandCenterMHz = 3.75 + 0.5*(band + 1)
             digitizer_frequency_mhz = 614.4
             n_subbands = 128
+        elif yml is None:
+            hw = self.get_hardware_constants(band)
+            digitizer_frequency_mhz = hw['digitizer_frequency_mhz']
+            n_subbands = hw['n_subbands']
         else:
             digitizer_frequency_mhz = self.get_digitizer_frequency_mhz(band,
                 yml=yml)
@@ -232,3 +232,117 @@ def utf8_to_str(d):
         The string associated with input d.
     """
     return ''.join([str(s, encoding='UTF-8') for s in d])
+
+
+class WelchSpectra:
+    """ Welch estimates of the power spectra of two signals and of
+    their cross spectrum.
+
+    Gives the same results as scipy.signal.welch and scipy.signal.csd
+    with a Hann window, half overlapping segments, constant detrending
+    and density scaling. Each segment is transformed once and used for
+    all three spectra, and the window and buffers are reused between
+    calls with the same segment length. Real signals use real input
+    FFTs and return one sided spectra, complex signals return two
+    sided spectra.
+
+    Args
+    ----
+    nperseg : int
+        The length of each segment.
+    fs : float
+        The sampling frequency.
+    """
+    def __init__(self, nperseg, fs):
+        from scipy.signal import get_window
+
+        self.nperseg = int(nperseg)
+        self.fs = fs
+        self.window = get_window('hann', self.nperseg)
+        self.scale = 1.0 / (fs * np.sum(self.window**2))
+        self._buffers = {}
+
+    def _buffer(self, name, dtype):
+        """ Returns a reusable array of nperseg elements.
+        """
+        key = (name, np.dtype(dtype))
+        if key not in self._buffers:
+            self._buffers[key] = np.empty(self.nperseg, dtype=dtype)
+        return self._buffers[key]
+
+    def spectra(self, x, y):
+        """ Estimates the spectra.
+
+        Args
+        ----
+        x : array
+            The first signal.
+        y : array
+            The second signal, the same length as x.
+
+        Returns
+        -------
+        f : float array
+            The frequencies, in the fft order.
+        pxx : float array
+            The power spectrum of x.
+        pyy : float array
+            The power spectrum of y.
+        pxy : complex array
+            The cross spectrum, conj(X) Y.
+        """
+        import scipy.fft
+
+        nperseg = self.nperseg
+        step = nperseg - nperseg // 2
+        n_seg = (len(x) - nperseg) // step + 1
+        onesided = np.isrealobj(x) and np.isrealobj(y)
+
+        if onesided:
+            fft = scipy.fft.rfft
+            f = scipy.fft.rfftfreq(nperseg, 1 / self.fs)
+            dtype = float
+        else:
+            fft = scipy.fft.fft
+            f = scipy.fft.fftfreq(nperseg, 1 / self.fs)
+            dtype = complex
+
+        pxx = np.zeros(len(f))
+        pyy = np.zeros(len(f))
+        pxy = np.zeros(len(f), dtype=complex)
+        bx = self._buffer('x', dtype)
+        by = self._buffer('y', dtype)
+
+        for i in range(n_seg):
+            seg = slice(i * step, i * step + nperseg)
+
+            bx[:] = x[seg]
+            bx -= bx.mean()
+            bx *= self.window
+            fx = fft(bx)
+
+            by[:] = y[seg]
+            by -= by.mean()
+            by *= self.window
+            fy = fft(by)
+
+            pxx += fx.real**2 + fx.imag**2
+            pyy += fy.real**2 + fy.imag**2
+            np.conjugate(fx, out=fx)
+            fx *= fy
+            pxy += fx
+
+        scale = self.scale / n_seg
+        pxx *= scale
+        pyy *= scale
+        pxy *= scale
+
+        # The one sided spectra fold the negative frequencies, except
+        # for the DC and Nyquist bins
+        if onesided:
+            last = -1 if nperseg % 2 == 0 else None
+            pxx[1:last] *= 2
+            pyy[1:last] *= 2
+            pxy[1:last] *= 2
+
+        return f, pxx, pyy, pxy
@@ -0,0 +1,63 @@
+import struct
+
+import numpy as np
+
+from pysmurf.client.util import SmurfFileReader as sfr
+
+###
+# Helpers writing small synthetic SMuRF data files for the offline
+# tests.
+###
+
+
+def make_header(frame_counter, n_chan, timestamp=0, tes_bias=None):
+    """
+    Pack a 128 byte SMuRF header
+    """
+    if tes_bias is None:
+        tes_bias = [0] * 16
+
+    # 20 bit TES bias values, packed back to back
+    packed = 0
+    for i, v in enumerate(tes_bias):
+        packed |= (v & 0xFFFFF) << (20 * i)
+
+    hdr = bytearray(struct.pack(sfr.SmurfHeaderPack,
+                                1, 2, 3, 0, n_chan, timestamp, 0, 0, 0, 0, 0,
+                                0, frame_counter, 0, 0, 0, 0, 0, 0, 0, 0))
+    hdr[8:48] = packed.to_bytes(40, 'little')
+    return bytes(hdr)
+
+
+def make_record(payload, channel=0):
+    """
+    Prepend a Rogue header to a payload
+    """
+    return struct.pack('<' + sfr.RogueHeaderPack, len(payload) + 4, 0, 0,
+                       channel) + payload
+
+
+def write_rogue_file(path, frame_counters, n_chan=4, meta=None, tes_bias=None):
+    """
+    Write a data file with one frame per frame counter. The data of
+    channel c in frame i is 100 * i + c. If meta is given, it is written
+    as a metadata record before the first frame. The tes_bias values are
+    written in every header.
+    """
+    with open(path, 'wb') as f:
+        if meta is not None:
+            f.write(make_record(meta.encode('utf-8'), channel=1))
+
+        for i, fc in enumerate(frame_counters):
+            data = np.arange(n_chan, dtype=np.int32) + 100 * i
+            f.write(make_record(make_header(fc, n_chan, timestamp=10**9 * i,
+                                            tes_bias=tes_bias)
+                                + data.tobytes()))
+
+
+def write_mask(path, n_chan=4):
+    """
+    Write the channel mask of a data file, channel c of band 0 for
+    each of the n_chan data channels.
+    """
+    np.savetxt(path, np.arange(n_chan), fmt='%i')
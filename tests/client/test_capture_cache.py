@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+
+from pysmurf.client.util.capture_cache import CaptureCache
+
+###
+# Offline tests of the CaptureCache disk cache.
+###
+
+
+def test_key(tmp_path):
+    cache = CaptureCache(str(tmp_path))
+    state = {'band': 0, 'att_uc': 12, 'freq': np.arange(3)}
+
+    # The key depends on the state, not on the order of the keys
+    assert cache.key('sweep', state) == \
+        cache.key('sweep', dict(reversed(list(state.items()))))
+    assert cache.key('sweep', state) != cache.key('sweep', dict(state, att_uc=14))
+    assert cache.key('sweep', state) != cache.key('other', state)
+
+
+def test_put_get(tmp_path):
+    cache = CaptureCache(str(tmp_path))
+    key = cache.key('sweep', {'band': 0})
+    freq = np.linspace(-250, 250, 11)
+    resp = np.exp(1.j * freq)
+
+    assert cache.get(key) is None
+    cache.put(key, (freq, resp), state={'band': 0})
+
+    f, r = cache.get(key)
+    assert np.array_equal(f, freq)
+    assert np.array_equal(r, resp)
+
+    # The arrays are copy on write, the entry is unchanged
+    f[0] = 0
+    assert np.array_equal(cache.get(key)[0], freq)
+
+
+def test_max_age(tmp_path):
+    cache = CaptureCache(str(tmp_path))
+    cache.put('old', [np.zeros(4)])
+
+    assert cache.get('old', max_age=60) is not None
+    assert cache.get('old', max_age=-1) is None
+
+    # The expired entry is removed
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_incomplete_entry(tmp_path):
+    cache = CaptureCache(str(tmp_path))
+    cache.put('key', [np.zeros(4), np.ones(4)])
+    os.remove(os.path.join(str(tmp_path), 'key_1.npy'))
+
+    assert cache.get('key') is None
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_evict(tmp_path):
+    size = np.zeros(1000).nbytes
+    cache = CaptureCache(str(tmp_path), max_bytes=int(2.5 * size))
+
+    for i, key in enumerate(['a', 'b']):
+        cache.put(key, [np.zeros(1000)])
+        os.utime(os.path.join(str(tmp_path), f'{key}.json'), (i, i))
+
+    # Reading a marks it as recently used, b is evicted
+    cache.get('a')
+    cache.put('c', [np.zeros(1000)])
+
+    assert cache.get('a') is not None
+    assert cache.get('b') is None
+    assert cache.get('c') is not None
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+import pysmurf.client
+
+###
+# Offline tests of the SmurfCommandMixin staged channel writes. The
+# channel registers are held in arrays by the test.
+###
+
+
+@pytest.fixture
+def smurf_control():
+    S = pysmurf.client.SmurfControl(offline=True)
+    S.get_number_channels = lambda *args, **kwargs: 8
+    S.registers = {}
+    S.writes = []
+
+    for reg in ['amplitude_scale', 'feedback_enable', 'eta_phase', 'eta_mag',
+                'center_frequency']:
+        S.registers[reg] = np.arange(8.)
+
+        def _get(band, reg=reg, **kwargs):
+            return S.registers[reg].copy()
+
+        def _set(band, val, reg=reg, **kwargs):
+            S.writes.append(reg)
+            S.registers[reg] = np.array(val)
+
+        setattr(S, f'get_{reg}_array', _get)
+        setattr(S, f'set_{reg}_array', _set)
+
+    S._caput = lambda pv, val, **kwargs: S.writes.append(pv)
+    return S
+
+
+def test_staged_channel_writes_commit(smurf_control):
+    S = smurf_control
+    with S.staged_channel_writes(0):
+        for channel in [1, 3, 5]:
+            S.set_amplitude_scale_channel(0, channel, 12)
+            S.set_feedback_enable_channel(0, channel, 1)
+        S.set_eta_phase_degree_channel(0, 3, -90.)
+
+        # Nothing is written until the end of the block
+        assert S.writes == []
+
+    # One write per register, the other channels are unchanged
+    assert sorted(S.writes) == ['amplitude_scale', 'eta_phase',
+                                'feedback_enable']
+    assert np.array_equal(S.registers['amplitude_scale'],
+                          [0, 12, 2, 12, 4, 12, 6, 7])
+    assert np.array_equal(S.registers['feedback_enable'],
+                          [0, 1, 2, 1, 4, 1, 6, 7])
+    assert np.array_equal(S.registers['eta_phase'],
+                          [0, 1, 2, -90, 4, 5, 6, 7])
+
+    # The writes are direct again after the block
+    S.writes = []
+    S.set_amplitude_scale_channel(0, 1, 0)
+    assert len(S.writes) == 1 and S.writes[0] != 'amplitude_scale'
+
+
+def test_staged_channel_writes_discard(smurf_control):
+    S = smurf_control
+    with pytest.raises(RuntimeError):
+        with S.staged_channel_writes(0):
+            S.set_amplitude_scale_channel(0, 1, 12)
+            raise RuntimeError('relock')
+
+    assert S.writes == []
+    assert np.array_equal(S.registers['amplitude_scale'], np.arange(8.))
+
+    # The discarded values are not written by a later commit
+    assert S.commit_staged_channels() == 0
+
+
+def test_stage_channels_other_band(smurf_control):
+    S = smurf_control
+
+    # Only the band of the block is staged
+    with S.staged_channel_writes(0):
+        S.set_amplitude_scale_channel(1, 2, 12)
+        assert len(S.writes) == 1
+
+    with pytest.raises(ValueError):
+        S.stage_channels(0, 1, unknown=1)
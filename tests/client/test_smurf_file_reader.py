@@ -0,0 +1,279 @@
+import os
+import threading
+
+import numpy as np
+
+from pysmurf.client.util import SmurfFileReader as sfr
+from smurf_data import make_header, make_record, write_rogue_file
+
+###
+# Offline tests of the SmurfFileReader module, on small synthetic
+# Rogue data files.
+###
+
+
+def test_read_all_matches_records(tmp_path):
+    fn = str(tmp_path / 'data.dat')
+    tes_bias = [1, -2, 3, -4] + [0] * 11 + [-524288]
+    write_rogue_file(fn, [5, 6, 8, 9, 7], meta='Root:\n  Count: 1\n',
+                     tes_bias=tes_bias)
+
+    with sfr.SmurfStreamReader(fn, metaEnable=True) as reader:
+        header, data = reader.readAll()
+        config = reader.configDict
+
+    with sfr.SmurfStreamReader(fn, metaEnable=True) as reader:
+        records = [(h, d.copy()) for h, d in reader.records()]
+        assert reader.configDict == config
+
+    assert config == {'Root': {'Count': 1}}
+    assert len(records) == len(header)
+    assert np.array_equal(data, np.array([d for _, d in records]))
+
+    columns = sfr.decodeSmurfHeaders(header)
+    for i, (h, _) in enumerate(records):
+        for k in sfr.SmurfHeaderTuple._fields:
+            assert columns[k][i] == getattr(h, k), k
+        assert columns['external_time'][i] == h.external_time
+        assert list(columns['tes_bias'][i]) == h.tesBias
+
+
+def test_decode_smurf_headers_raw(tmp_path):
+    tes_bias = list(range(-8, 8))
+    raw = make_header(3, 4, timestamp=42, tes_bias=tes_bias)
+
+    # Raw bytes, an (n, 128) uint8 array and a structured array
+    # decode the same
+    for headers in [raw * 2, np.frombuffer(raw * 2, dtype=np.uint8).reshape(2, -1),
+                    np.frombuffer(raw * 2, dtype=sfr.SmurfHeaderDtype)]:
+        columns = sfr.decodeSmurfHeaders(headers)
+        assert np.array_equal(columns['frame_counter'], [3, 3])
+        assert np.array_equal(columns['timestamp'], [42, 42])
+        assert np.array_equal(columns['number_of_channels'], [4, 4])
+        assert columns['tes_bias'].shape == (2, 16)
+        assert np.array_equal(columns['tes_bias'][1], tes_bias)
+
+
+def test_frame_statistics():
+    stats = sfr.frameStatistics(np.array([1, 2, 5, 5, 4, 8], dtype=np.uint32))
+
+    assert stats['frameCnt'] == 6
+    assert stats['frameLossCnt'] == 3
+    assert stats['frameOutOrderCnt'] == 1
+    assert stats['frameDuplicateCnt'] == 1
+    assert np.array_equal(stats['gapStart'], [3, 6])
+    assert np.array_equal(stats['gapSize'], [1, 2])
+
+
+def test_frame_statistics_wrap():
+    fc = (2**32 - 2 + np.arange(5)) % 2**32
+    stats = sfr.frameStatistics(fc.astype(np.uint32))
+
+    assert stats['frameLossCnt'] == 0
+    assert stats['frameOutOrderCnt'] == 0
+
+
+def test_frame_statistics_empty():
+    stats = sfr.frameStatistics(np.zeros(0, dtype=np.uint32))
+
+    assert stats['frameCnt'] == 0
+    assert stats['frameLossCnt'] == 0
+    assert stats['frameOutOrderCnt'] == 0
+    assert stats['frameDuplicateCnt'] == 0
+    assert len(stats['gapStart']) == 0
+    assert len(stats['gapSize']) == 0
+
+
+def test_frame_stats_empty_range(tmp_path):
+    fn = str(tmp_path / 'data.dat')
+    write_rogue_file(fn, range(10))
+
+    with sfr.SmurfStreamReader(fn) as reader:
+        header, data = reader.readAll(start=20, stop=30)
+        stats = reader.frameStats
+
+    assert len(header) == 0
+    assert data.shape[0] == 0
+    assert stats['frameCnt'] == 0
+    assert stats['frameLossCnt'] == 0
+
+
+def test_index_sidecar_reuse(tmp_path):
+    fn = str(tmp_path / 'data.dat')
+    write_rogue_file(fn, range(20))
+
+    with sfr.SmurfStreamReader(fn, useIndex=True) as reader:
+        header, data = reader.readAll()
+
+    sidecar = sfr.indexFileName(fn)
+    with np.load(sidecar) as npz:
+        key = npz['key']
+
+    # A second read uses the saved index
+    with sfr.SmurfStreamReader(fn, useIndex=True) as reader:
+        header2, data2 = reader.readAll()
+
+    with np.load(sidecar) as npz:
+        assert np.array_equal(npz['key'], key)
+
+    assert np.array_equal(header, header2)
+    assert np.array_equal(data, data2)
+
+
+def test_index_sidecar_grown_file(tmp_path):
+    fn = str(tmp_path / 'data.dat')
+    write_rogue_file(fn, range(20))
+
+    with sfr.SmurfStreamReader(fn, useIndex=True) as reader:
+        reader.readAll()
+
+    # Appending frames invalidates the sidecar
+    write_rogue_file(fn, range(30))
+
+    with sfr.SmurfStreamReader(fn, useIndex=True) as reader:
+        header, data = reader.readAll()
+
+    assert len(header) == 30
+    assert np.array_equal(header['frame_counter'], np.arange(30))
+
+    with np.load(sfr.indexFileName(fn)) as npz:
+        assert npz['key'][0] == len(open(fn, 'rb').read())
+        assert len(npz['index']) == 30
+
+
+def test_index_sidecar_past_end(tmp_path):
+    fn = str(tmp_path / 'data.dat')
+    write_rogue_file(fn, range(20))
+
+    with sfr.SmurfStreamReader(fn, useIndex=True) as reader:
+        reader.readAll()
+
+    # A sidecar which does not fit the mapped data is rebuilt
+    with np.load(sfr.indexFileName(fn)) as npz:
+        key, idx = npz['key'], npz['index'].copy()
+    idx['offset'][-1] += 1000
+    sfr._saveIndex(fn, key, idx)
+
+    with sfr.SmurfStreamReader(fn, useIndex=True) as reader:
+        header, _ = reader.readAll()
+
+    assert np.array_equal(header['frame_counter'], np.arange(20))
+
+
+def test_index_sidecar_not_saved_while_growing(tmp_path):
+    fn = str(tmp_path / 'data.dat')
+    write_rogue_file(fn, range(20))
+
+    reader = sfr.SmurfStreamReader(fn, useIndex=True)
+    buf = reader._mapFile(fn)
+
+    # The file grows between the mapping and the stat
+    with open(fn, 'ab') as f:
+        f.write(make_record(make_header(20, 4) + bytes(16)))
+    reader._mapStat[fn] = os.stat(fn)
+
+    idx = reader._indexFile(buf, fn)
+
+    assert len(idx) == 20
+    assert not os.path.exists(sfr.indexFileName(fn))
+
+
+def test_blocks(tmp_path):
+    fn = str(tmp_path / 'data.dat')
+    write_rogue_file(fn, range(10))
+    write_rogue_file(fn + '.1', range(10, 25))
+    files = sfr.dataFileParts(fn)
+
+    with sfr.SmurfStreamReader(files) as reader:
+        header, data = reader.readAll(channels=[3, 0], start=2)
+
+    # The blocks continue across the parts, only the last one is short
+    with sfr.SmurfStreamReader(files) as reader:
+        blocks = [(h.copy(), d.copy()) for h, d in
+                  reader.blocks(4, channels=[3, 0], start=2)]
+
+    assert [len(h) for h, _ in blocks] == [4] * 5 + [3]
+    assert np.array_equal(np.concatenate([h for h, _ in blocks]), header)
+    assert np.array_equal(np.concatenate([d for _, d in blocks]), data)
+
+
+def test_follow_rollover(tmp_path):
+    fn = str(tmp_path / 'data.dat')
+    write_rogue_file(fn, range(10))
+    write_rogue_file(fn + '.1', range(10, 25))
+
+    # An incomplete record at the end of the last part is not returned
+    with open(fn + '.1', 'ab') as f:
+        f.write(make_record(make_header(25, 4) + bytes(16))[:-8])
+
+    reader = sfr.SmurfStreamReader(fn)
+    counters = []
+    data = []
+    for h, d in reader.follow(pollInterval=.01, timeout=.2):
+        counters.append(h['frame_counter'])
+        data.append(d)
+
+    assert np.array_equal(np.concatenate(counters), np.arange(25))
+    assert np.concatenate(data).shape == (25, 4)
+
+
+def test_follow_from_end(tmp_path):
+    fn = str(tmp_path / 'data.dat')
+    write_rogue_file(fn, range(10))
+
+    def _append():
+        with open(fn, 'ab') as f:
+            f.write(make_record(make_header(10, 4) + bytes(16)))
+
+    # Only the frames written after the start are returned
+    writer = threading.Timer(.1, _append)
+    writer.start()
+
+    reader = sfr.SmurfStreamReader(fn)
+    frames = reader.follow(pollInterval=.01, timeout=2, fromEnd=True)
+    header, data = next(frames)
+    frames.close()
+    writer.join()
+
+    assert np.array_equal(header['frame_counter'], [10])
+
+
+def test_read_all_parallel(tmp_path):
+    fn = str(tmp_path / 'data.dat')
+    write_rogue_file(fn, range(10))
+    write_rogue_file(fn + '.1', range(10, 25))
+    files = sfr.dataFileParts(fn)
+
+    # The parallel decode matches the serial one, across the parts
+    for kwargs in [{}, {'channels': [1, 3], 'start': 5, 'stop': 20}]:
+        with sfr.SmurfStreamReader(files) as reader:
+            header, data = reader.readAll(**kwargs)
+        with sfr.SmurfStreamReader(files) as reader:
+            header2, data2 = reader.readAll(processes=2, **kwargs)
+
+        assert np.array_equal(header, header2)
+        assert np.array_equal(data, data2)
+
+
+def test_config_at(tmp_path):
+    fn = str(tmp_path / 'data.dat')
+    write_rogue_file(fn, range(5), meta='Root:\n  Count: 1\n')
+
+    # A second metadata record, after the first five frames
+    with open(fn, 'ab') as f:
+        f.write(make_record(b'Root:\n  Count: 2\n', channel=1))
+        for fc in range(5, 10):
+            f.write(make_record(make_header(fc, 4) + bytes(16)))
+
+    reader = sfr.SmurfStreamReader(fn)
+    first = reader.configAt(2)
+    second = reader.configAt(7)
+
+    # The results do not share the reader's state
+    assert first == {'Root': {'Count': 1}}
+    assert second == {'Root': {'Count': 2}}
+    assert reader.configValue('Root.Count', frame=7) == 2
+    assert reader.configValue('Root.Count', frame=0) == 1
+
+    first['Root']['Count'] = 5
+    assert reader.configAt(2) == {'Root': {'Count': 1}}
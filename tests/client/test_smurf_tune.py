@@ -0,0 +1,220 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import pysmurf.client
+
+###
+# Offline tests of the SmurfTuneMixin.tune steps selection, where the
+# tuning steps are replaced by functions which only record their calls,
+# and of the eta estimates.
+###
+
+
+@pytest.fixture
+def smurf_control():
+    S = pysmurf.client.SmurfControl(offline=True)
+    S._bands = [0, 1]
+    S._amplitude_scale = {0: 12, 1: 12}
+    S._fraction_full_scale = .5
+    S._default_tune = 'default_tune.npy'
+    S.calls = []
+
+    def _record(name):
+        def _step(*args, **kwargs):
+            S.calls.append((name,) + args)
+        return _step
+
+    for name in ['load_tune', 'find_freq', 'setup_notches', 'retune_drifted',
+                 'tune_band_serial', 'track_and_check']:
+        setattr(S, name, _record(name))
+
+    S.stages = []
+    S.run_band_pipelines = lambda bands, stages: S.stages.extend(
+        s[0] for s in stages)
+
+    return S
+
+
+@pytest.mark.parametrize('load_tune, incremental_retune, expected', [
+    (False, False, ['find_freq', 'setup_notches']),
+    (False, True, ['find_freq', 'setup_notches']),
+    (True, False, ['load_tune']),
+    (True, True, ['load_tune', 'retune_drifted']),
+])
+def test_tune_steps(smurf_control, load_tune, incremental_retune, expected):
+    S = smurf_control
+    S.tune(load_tune=load_tune, incremental_retune=incremental_retune,
+           track_and_check=False)
+
+    assert sorted(set(c[0] for c in S.calls)) == sorted(expected)
+    if load_tune:
+        assert S.calls[0] == ('load_tune', 'default_tune.npy')
+
+    # Every band is tuned once by each step
+    for step in set(expected) - {'load_tune'}:
+        assert [c[1] for c in S.calls if c[0] == step] == [0, 1]
+
+
+def test_tune_retune_and_track(smurf_control):
+    S = smurf_control
+    S.tune(load_tune=True, retune=True)
+
+    assert [c[0] for c in S.calls] == ['load_tune'] + \
+        ['tune_band_serial'] * 2 + ['track_and_check'] * 2
+
+
+@pytest.mark.parametrize('load_tune, incremental_retune, expected', [
+    (False, False, ['find_freq', 'setup_notches', 'track_and_check']),
+    (False, True, ['find_freq', 'setup_notches', 'track_and_check']),
+    (True, False, ['track_and_check']),
+    (True, True, ['retune_drifted', 'track_and_check']),
+])
+def test_tune_concurrent_stages(smurf_control, load_tune, incremental_retune,
+                                expected):
+    S = smurf_control
+    S.tune(load_tune=load_tune, incremental_retune=incremental_retune,
+           concurrent=True)
+
+    assert S.stages == expected
+
+    # The bands are only tuned through run_band_pipelines
+    assert [c[0] for c in S.calls] == (['load_tune'] if load_tune else [])
+
+
+def test_run_band_pipelines_locks(tmp_path):
+    S = pysmurf.client.SmurfControl(offline=True)
+    S.tune_dir = str(tmp_path)
+    lock = threading.Lock()
+    active = []
+    overlaps = []
+    deferred = []
+
+    def _stage(name, resources):
+        def _run(band):
+            bay = S.band_to_bay(band)
+            with lock:
+                for other, other_bay, other_resources in active:
+                    # The exclusive flux ramp excludes any other flux
+                    # ramp stage
+                    if ('flux_ramp' in resources and
+                            {'flux_ramp', 'flux_ramp_off'} & other_resources) or \
+                            ('flux_ramp' in other_resources and
+                             {'flux_ramp', 'flux_ramp_off'} & resources) or \
+                            ('bay' in resources and 'bay' in other_resources and
+                             bay == other_bay):
+                        overlaps.append((name, band, other))
+                entry = (name, bay, resources)
+                active.append(entry)
+            deferred.append(S._save_tune_deferred)
+            S.save_tune()
+            time.sleep(.02)
+            with lock:
+                active.remove(entry)
+        return (name, tuple(resources), _run)
+
+    stages = [_stage('notches', {'flux_ramp_off'}),
+              _stage('serial', {'bay', 'flux_ramp_off'}),
+              _stage('free', set()),
+              _stage('track', {'bay', 'flux_ramp'})]
+
+    timing = S.run_band_pipelines([0, 1, 4, 5], stages)
+
+    assert overlaps == []
+    assert deferred == [True] * 16
+    assert not S._save_tune_deferred
+    assert set(timing[0]) == {'notches', 'serial', 'free', 'track'}
+
+    # The tuning is only saved once, at the end
+    assert len(os.listdir(tmp_path)) == 1
+
+
+def test_run_band_pipelines_unknown_resource():
+    S = pysmurf.client.SmurfControl(offline=True)
+    with pytest.raises(ValueError):
+        S.run_band_pipelines([0], [('x', 'dac', lambda band: None)])
+
+
+def _resonator_sweeps(f_sweep, centers):
+    """
+    Responses of resonators at centers across f_sweep, with an offset
+    and a rotation which change between resonators
+    """
+    resp = []
+    for k, f0 in enumerate(centers):
+        x = (f_sweep - f0) / .02
+        resp.append(np.exp(1.j * k) * (1 - .9 / (1 + 2.j * x)) + .1 * k)
+    return np.array(resp)
+
+
+def _eta_reference(f_sweep, resp, delta_freq, lock_max_derivative):
+    """
+    The per resonator eta estimate of eta_estimator
+    """
+    a_resp = np.abs(resp)
+    if lock_max_derivative:
+        deriv = np.abs(np.diff(a_resp))
+        idx = np.ravel(np.where(deriv == np.max(deriv)))[0]
+    else:
+        idx = np.ravel(np.where(a_resp == np.min(a_resp)))[0]
+    f0 = f_sweep[idx]
+
+    try:
+        left = np.where(f_sweep < f0 - delta_freq)[0][-1]
+    except IndexError:
+        left = 0
+
+    try:
+        right = np.where(f_sweep > f0 + delta_freq)[0][0]
+    except IndexError:
+        right = len(f_sweep)-1
+
+    return (f_sweep[right]-f_sweep[left])/(resp[right]-resp[left])
+
+
+@pytest.mark.parametrize('lock_max_derivative', [False, True])
+def test_eta_estimator_batch(lock_max_derivative):
+    f_sweep = np.arange(-.3, .3, .002)
+
+    # Including resonances at the ends of the sweep
+    centers = [-.3, -.295, -.1, 0, .05, .123, .295, .3]
+    resp = _resonator_sweeps(f_sweep, centers)
+
+    eta, eta_mag, eta_phase, peak_freq = \
+        pysmurf.client.SmurfControl.eta_estimator_batch(
+            f_sweep, resp, lock_max_derivative=lock_max_derivative)
+
+    expected = [_eta_reference(f_sweep, r, .01, lock_max_derivative)
+                for r in resp]
+    np.testing.assert_allclose(eta, expected)
+    np.testing.assert_allclose(eta_mag, np.abs(expected))
+    np.testing.assert_allclose(eta_phase, np.angle(expected, deg=True))
+    np.testing.assert_allclose(peak_freq,
+                               f_sweep[np.argmin(np.abs(resp), axis=1)])
+
+    # One sweep frequency array per resonator
+    freq = f_sweep + np.arange(len(centers))[:, None]
+    eta, _, _, _ = pysmurf.client.SmurfControl.eta_estimator_batch(
+        freq, resp, lock_max_derivative=lock_max_derivative)
+    expected = [_eta_reference(f, r, .01, lock_max_derivative)
+                for f, r in zip(freq, resp)]
+    np.testing.assert_allclose(eta, expected)
+
+
+def test_eta_estimator():
+    S = pysmurf.client.SmurfControl(offline=True)
+    f_sweep = np.arange(-.3, .3, .002)
+    resp = _resonator_sweeps(f_sweep, [.05])[0]
+
+    S.freq_to_subband = lambda band, freq: (3, 0.)
+    S.fast_eta_scan = lambda *args: (f_sweep, resp)
+    S.get_subband_centers = lambda band, as_offset=False: \
+        (np.arange(4), 5000. + np.arange(4))
+
+    f, r, eta = S.eta_estimator(0, 5003.)
+
+    np.testing.assert_allclose(f, f_sweep + 5003.)
+    assert eta == pytest.approx(_eta_reference(f_sweep, resp, .01, False))
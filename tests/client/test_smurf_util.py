@@ -0,0 +1,354 @@
+import os
+import types
+
+import numpy as np
+import pytest
+
+import pysmurf.client
+from pysmurf.client.command import sync_group
+from pysmurf.client.util import smurf_util
+from pysmurf.client.util.SmurfFileReader import indexFileName
+from smurf_data import make_header, make_record, write_mask, write_rogue_file
+
+###
+# Offline tests of the SmurfUtilMixin data file readers, on small
+# synthetic data files.
+###
+
+
+@pytest.fixture
+def smurf_control():
+    S = pysmurf.client.SmurfControl(offline=True)
+    S.get_number_channels = lambda *args, **kwargs: 512
+    return S
+
+
+@pytest.fixture
+def datafile(tmp_path):
+    fn = str(tmp_path / 'data.dat')
+    tes_bias = [-3, 5] + [0] * 13 + [7]
+    write_rogue_file(fn, range(10), tes_bias=tes_bias)
+    write_mask(str(tmp_path / 'data_mask.txt'))
+    return fn
+
+
+def test_read_stream_data_header(smurf_control, datafile):
+    t, d, m, h = smurf_control.read_stream_data(datafile, return_header=True)
+
+    assert d.shape == (4, 10)
+    assert t.dtype == np.int64
+
+    for k, v in h.items():
+        if k == 'tes_bias':
+            assert v.dtype == float
+            assert v.shape == (16, 10)
+        else:
+            assert v.dtype == np.int64, k
+            assert v.shape == (10,), k
+
+    assert np.array_equal(h['frame_counter'], np.arange(10))
+    assert np.array_equal(h['tes_bias'][:, 0], [-3, 5] + [0] * 13 + [7])
+
+
+@pytest.fixture
+def hardware(smurf_control):
+    S = smurf_control
+    S.get_number_processed_channels = lambda *args, **kwargs: 416
+    S.get_number_sub_bands = lambda *args, **kwargs: 128
+    S.get_digitizer_frequency_mhz = lambda *args, **kwargs: 614.4
+    S.uptime = 1000.
+    S.get_fpga_uptime = lambda *args, **kwargs: S.uptime
+    return S
+
+
+def test_processed_channels_offline(hardware):
+    assert hardware.get_processed_channels() is None
+
+
+def test_hardware_constants_reprogram(hardware):
+    S = hardware
+    values = S.get_hardware_constants(0)
+    assert values['subband_half_width_mhz'] == 614.4 / 128
+
+    # Cached until the next uptime check
+    assert S.get_hardware_constants(0) is values
+
+    # The uptime kept up with the wall clock
+    S._hardware_cache['checked'] -= 2000
+    S.uptime = 3000.
+    assert S.get_hardware_constants(0) is values
+
+    # Reprogrammed: the uptime is higher than the cached one, but not
+    # by the time elapsed since it was read
+    S._hardware_cache['checked'] -= 2000
+    S.uptime = 3500.
+    assert S.get_hardware_constants(0) is not values
+
+
+def test_hardware_constants_recheck(hardware):
+    S = hardware
+    values = S.get_hardware_constants(0)
+
+    # A reprogram is seen at once with recheck
+    S.uptime = 10.
+    assert S.get_hardware_constants(0) is values
+    assert S.get_hardware_constants(0, recheck=True) is not values
+
+
+def test_decode_data_offline_recast(hardware):
+    with pytest.raises(ValueError):
+        hardware.decode_data('data.dat')
+
+
+def test_phase_delay_cache_key_reprogram(hardware):
+    S = hardware
+    args = (0, 10, 12, 'abc', 2**19, 5, -2.4E6, 2.4E6)
+    key = S._phase_delay_cache_key(*args)
+    assert S._phase_delay_cache_key(*args) == key
+
+    # A reprogram invalidates the previous estimates
+    S._hardware_cache['checked'] -= 2000
+    S.uptime = 10.
+    assert S._phase_delay_cache_key(*args) != key
+
+
+def test_read_exported_stream_data_header(smurf_control, datafile, tmp_path):
+    pytest.importorskip('h5py')
+    S = smurf_control
+
+    outfile = S.export_stream_data(datafile, outfile=str(tmp_path / 'data.h5'))
+    t, d, m, h = S.read_stream_data(datafile, return_header=True)
+    te, de, me, he = S.read_exported_stream_data(outfile, return_header=True)
+
+    assert np.array_equal(t, te)
+    assert np.array_equal(d, de)
+    assert sorted(h.keys()) == sorted(he.keys())
+    for k in h:
+        assert he[k].dtype == h[k].dtype, k
+        assert np.array_equal(he[k], h[k]), k
+
+
+def test_export_zarr_live(smurf_control, datafile, tmp_path, capsys):
+    pytest.importorskip('zarr')
+    S = smurf_control
+    outfile = str(tmp_path / 'data.zarr')
+
+    # A run which is still written ends with an incomplete record
+    with open(datafile, 'ab') as f:
+        f.write(make_record(make_header(10, 4) + bytes(16))[:-8])
+
+    S.export_stream_data(datafile, outfile=outfile)
+    assert 'Warning' not in capsys.readouterr().out
+
+    t, d, m, h = S.read_stream_data(datafile, return_header=True)
+    te, de, me, he = S.read_exported_stream_data(outfile, return_header=True)
+
+    assert np.array_equal(t, te)
+    assert np.array_equal(d, de)
+    for k in h:
+        assert np.array_equal(he[k], h[k]), k
+
+
+def test_read_stream_data_use_index(smurf_control, datafile):
+    t, d, m = smurf_control.read_stream_data(datafile, use_index=True)
+    assert os.path.exists(indexFileName(datafile))
+
+    # The second read uses the sidecar
+    t2, d2, m2 = smurf_control.read_stream_data(datafile, use_index=True,
+                                                start=2, stop=5)
+    assert np.array_equal(t2, t[2:5])
+    assert np.array_equal(d2, d[:, 2:5])
+
+
+class FakePV:
+    """
+    Stands in for epics.PV in the take_debug_data_async tests
+    """
+    created = []
+
+    def __init__(self, pvname, callback=None, auto_monitor=False):
+        self.pvname = pvname
+        self.connected = True
+        FakePV.created.append(self)
+
+    def clear_callbacks(self):
+        pass
+
+    def disconnect(self):
+        self.connected = False
+
+
+@pytest.fixture
+def debug_data(smurf_control, monkeypatch):
+    S = smurf_control
+    fake_epics = types.SimpleNamespace(
+        PV=FakePV, ca=types.SimpleNamespace(use_initial_context=lambda: None))
+    monkeypatch.setattr(smurf_util, 'epics', fake_epics, raising=False)
+    FakePV.created = []
+
+    S.calls = []
+    S._setup_debug_data = lambda *args, **kwargs: ('data.dat', 1)
+    S.set_streamdatawriter_close = lambda *args, **kwargs: \
+        S.calls.append('close')
+    S.set_trigger_daq = lambda *args, **kwargs: S.calls.append('trigger')
+    S.get_waveform_empty = lambda *args, **kwargs: True
+    S._decode_debug_data = lambda *args: 'decoded'
+    return S
+
+
+def test_take_debug_data_async(debug_data):
+    S = debug_data
+    future = S.take_debug_data_async(0, close_delay=0)
+
+    assert future.result(timeout=10) == 'decoded'
+    assert S.calls == ['trigger', 'close']
+    assert len(FakePV.created) == 2
+    assert not any(pv.connected for pv in FakePV.created)
+
+    # The next acquisition can start
+    assert S._debug_data_lock.acquire(blocking=False)
+
+
+def test_take_debug_data_async_trigger_error(debug_data):
+    S = debug_data
+
+    def _fail(*args, **kwargs):
+        raise RuntimeError('trigger')
+    S.set_trigger_daq = _fail
+
+    with pytest.raises(RuntimeError):
+        S.take_debug_data_async(0)
+
+    # The monitors, the file and the lock are released
+    assert len(FakePV.created) == 2
+    assert not any(pv.connected for pv in FakePV.created)
+    assert S.calls == ['close']
+    assert S._debug_data_lock.acquire(blocking=False)
+
+
+@pytest.mark.parametrize('save_data', [False, True])
+def test_read_daq_data_batch(smurf_control, tmp_path, save_data):
+    S = smurf_control
+    S.output_dir = str(tmp_path)
+    mux = {}
+    triggers = []
+    scans = {}
+
+    def _setup_daq_mux(converter, converter_number, data_length, band=0):
+        mux[S.band_to_bay(band)] = band
+
+    def _read_bays(bays, hw_trigger=False, data_length=2**19):
+        triggers.append(list(bays))
+        ret = {}
+        for bay in bays:
+            band = mux[bay]
+            n = scans.get(band, 0)
+            scans[band] = n + 1
+            ret[bay] = (np.full(data_length, 10 * band + n, dtype=np.int16),
+                        np.full(data_length, -band, dtype=np.int16))
+        return ret
+
+    S.setup_daq_mux = _setup_daq_mux
+    S._read_stream_data_daq_bays = _read_bays
+
+    ret = S.read_daq_data_batch([0, 1, 4], data_length=8, n_scan=2,
+                                save_data=save_data, timestamp=123)
+
+    # One band per bay in each trigger
+    assert triggers == [[0, 1], [0], [0, 1], [0]]
+
+    for band in [0, 1, 4]:
+        assert ret[band].shape == (2, 8)
+        for n in range(2):
+            assert np.all(ret[band][n] == -band + 1.j * (10 * band + n))
+
+        if save_data:
+            raw = np.load(str(tmp_path / f'123_adc{band}.npy'))
+            assert raw.shape == (2, 2, 8)
+            assert np.array_equal(raw[:, 1] + 1.j * raw[:, 0], ret[band])
+
+
+def test_cached_capture(smurf_control, tmp_path):
+    S = smurf_control
+    S.att_uc = 12
+    S.get_att_uc = lambda band: S.att_uc
+    S.get_att_dc = lambda band: 0
+    S.get_band_center_mhz = lambda band: 4250.
+    S.get_fpga_git_hash_short = lambda: 'abc'
+    captures = []
+
+    def _capture():
+        captures.append(S.att_uc)
+        return np.arange(4) + S.att_uc, np.ones(4)
+
+    # Disabled by default
+    S._cached_capture('sweep', 0, {'n_scan': 5}, _capture)
+    S.enable_capture_cache(directory=str(tmp_path))
+
+    S._cached_capture('sweep', 0, {'n_scan': 5}, _capture)
+    freq, _ = S._cached_capture('sweep', 0, {'n_scan': 5}, _capture)
+    assert captures == [12, 12]
+    assert np.array_equal(freq, np.arange(4) + 12)
+
+    # A new hardware state or argument takes the sweep again
+    S.att_uc = 14
+    S._cached_capture('sweep', 0, {'n_scan': 5}, _capture)
+    S._cached_capture('sweep', 0, {'n_scan': 3}, _capture)
+    S._cached_capture('sweep', 0, {'n_scan': 3}, _capture,
+                      force_refresh=True)
+    assert captures == [12, 12, 14, 14, 14]
+
+
+class FakeStreamPV:
+    """
+    Stands in for the epics.PV monitors of the stream PVs. The value
+    of stream s after the n-th trigger is n * 1000 + s + arange(count).
+    """
+    created = []
+
+    def __init__(self, pvname, callback=None, auto_monitor=False,
+                 count=None):
+        self.pvname = pvname
+        self.callback = callback
+        self.count = count
+        self.updates = 0
+        FakeStreamPV.created.append(self)
+
+        # The value read on connection
+        callback(pvname=pvname, value=np.zeros(4))
+
+    def wait_for_connection(self, timeout=None):
+        return True
+
+    def update(self):
+        self.updates += 1
+        stream = int(self.pvname[-1])
+        self.callback(pvname=self.pvname,
+                      value=self.updates * 1000 + stream + np.arange(self.count))
+
+
+def test_read_stream_pvs(smurf_control, monkeypatch):
+    S = smurf_control
+    monkeypatch.setattr(sync_group, 'epics',
+                        types.SimpleNamespace(PV=FakeStreamPV), raising=False)
+    FakeStreamPV.created = []
+    triggers = []
+
+    def _trigger(bay, val, write_log=False):
+        triggers.append(bay)
+        for pv in FakeStreamPV.created:
+            if int(pv.pvname[-1]) // 2 == bay:
+                pv.update()
+    S.set_trigger_daq = _trigger
+
+    data = S.read_stream_pvs(streams=[1, 2], data_length=8)
+    assert triggers == [0, 1]
+    assert [pv.count for pv in FakeStreamPV.created] == [8, 8]
+    assert np.array_equal(data, [1001 + np.arange(8), 1002 + np.arange(8)])
+
+    # The monitors are kept, and the output buffer reused
+    out = np.zeros((2, 8), dtype=int)
+    data = S.read_stream_pvs(streams=[1, 2], data_length=8, out=out)
+    assert data is out
+    assert len(FakeStreamPV.created) == 2
+    assert np.array_equal(data, [2001 + np.arange(8), 2002 + np.arange(8)])
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+from scipy import signal
+
+from pysmurf.client.util.tools import WelchSpectra
+
+###
+# Offline tests of the pysmurf.client.util.tools helpers.
+###
+
+
+@pytest.mark.parametrize('nperseg', [64, 63])
+@pytest.mark.parametrize('complex_data', [False, True])
+def test_welch_spectra(nperseg, complex_data):
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=1000)
+    y = np.roll(x, 3) + rng.normal(size=1000)
+    if complex_data:
+        x = x + 1.j * rng.normal(size=1000)
+        y = y + 1.j * rng.normal(size=1000)
+
+    welch = WelchSpectra(nperseg, fs=2.4e6)
+
+    # The buffers are reused between calls
+    for _ in range(2):
+        f, pxx, pyy, pxy = welch.spectra(x, y)
+
+        fe, pxxe = signal.welch(x, fs=2.4e6, nperseg=nperseg)
+        _, pyye = signal.welch(y, fs=2.4e6, nperseg=nperseg)
+        _, pxye = signal.csd(x, y, fs=2.4e6, nperseg=nperseg)
+
+        np.testing.assert_allclose(f, fe)
+        np.testing.assert_allclose(pxx, pxxe, rtol=1e-10)
+        np.testing.assert_allclose(pyy, pyye, rtol=1e-10)
+        np.testing.assert_allclose(pxy, pxye, rtol=1e-10, atol=1e-12 * abs(pxye).max())